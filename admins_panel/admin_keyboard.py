@@ -3,11 +3,26 @@ from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKe
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import Command
-from database.models import User, UserTeams
+from aiogram.exceptions import TelegramBadRequest
+from database.models import User, UserTeams, BroadcastJob
+from database.requests import (
+    create_broadcast_job,
+    get_broadcast_job,
+    get_broadcast_job_counts,
+    get_recent_broadcast_jobs,
+    reachable_user_condition,
+    count_unreachable_users,
+    MAX_DELIVERY_FAILURES,
+)
 from database.engine import async_session_factory
 import os
+import time
 from sqlalchemy.ext.asyncio import AsyncSession
 from scheduler import get_reminder_scheduler
+from broadcast import get_broadcast_runner
+from metrics import handler_metrics
+from database.middleware import session_stats
+from drafts import get_draft_metrics
 from sqlalchemy import select, func
 
 # Пароль для админ-панели
@@ -31,6 +46,7 @@ def get_admin_keyboard():
         [InlineKeyboardButton(text="🏆 Проверка рекордов", callback_data="admin_records")],
         [InlineKeyboardButton(text="📸 Управление напоминаниями", callback_data="admin_reminders")],
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton(text="⏱ Производительность", callback_data="admin_perf")],
         [InlineKeyboardButton(text="🗑 Очистить данные", callback_data="admin_clear")],
         [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_refresh")],
         [InlineKeyboardButton(text="❌ Закрыть панель", callback_data="admin_close")]
@@ -320,6 +336,41 @@ async def admin_show_teams(callback: CallbackQuery):
     except Exception as e:
         await callback.answer(f"Ошибка: {str(e)}")
 
+@router.callback_query(F.data == "admin_perf")
+async def admin_show_performance(callback: CallbackQuery):
+    """Показывает самые нагруженные обработчики этого процесса"""
+    try:
+        top = handler_metrics.top_handlers(limit=10)
+        if top:
+            uptime = time.monotonic() - handler_metrics.started_at
+            perf_text = f"⏱ Производительность (за {uptime / 3600:.1f} ч, по суммарному времени)\n\n"
+            for i, (event_type, name, stats) in enumerate(top, 1):
+                count = stats.latency.count
+                perf_text += (
+                    f"{i}. {name.rsplit('.', 1)[-1]} ({event_type})\n"
+                    f"   вызовов: {count}, ошибок: {stats.errors / count:.0%}\n"
+                    f"   среднее: {stats.latency.sum / count * 1000:.0f} мс, p95: ≤{stats.latency.quantile(0.95) * 1000:.0f} мс\n"
+                    f"   БД: {stats.db_seconds / count * 1000:.0f} мс ({stats.db_queries / count:.1f} запр.), "
+                    f"API: {stats.api_seconds / count * 1000:.0f} мс ({stats.api_calls / count:.1f} выз.)\n\n"
+                )
+        else:
+            perf_text = "⏱ Производительность\n\nОбработчики еще не вызывались.\n\n"
+        perf_text += (
+            f"Сессии БД: обновлений {session_stats.requested}, "
+            f"сессий создано {session_stats.opened}, с запросами {session_stats.used}"
+        )
+        perf_text += "\n\nЧерновики (чтений / записей / удалений / просрочено / отклонено, макс. размер):\n"
+        for name, counters in get_draft_metrics().items():
+            perf_text += (
+                f"{name}: {counters['loads']} / {counters['saves']} / {counters['clears']} / "
+                f"{counters['expired']} / {counters['rejected']}, {counters['max_bytes_seen'] / 1024:.1f} КБ\n"
+            )
+
+        await callback.message.edit_text(perf_text, reply_markup=get_back_to_admin_keyboard())
+        await callback.answer()
+    except Exception as e:
+        await callback.answer(f"Ошибка: {str(e)}")
+
 @router.callback_query(F.data == "admin_close")
 async def admin_close_panel(callback: CallbackQuery):
     """Закрывает админ-панель"""
@@ -395,6 +446,7 @@ def get_broadcast_keyboard():
     """Клавиатура управления рассылкой"""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📝 Создать рассылку", callback_data="broadcast_create")],
+        [InlineKeyboardButton(text="📋 История рассылок", callback_data="broadcast_jobs")],
         [InlineKeyboardButton(text="📊 Статистика пользователей", callback_data="broadcast_stats")],
         [InlineKeyboardButton(text="⬅️ Назад к панели", callback_data="admin_back")]
     ])
@@ -442,6 +494,31 @@ async def admin_show_reminders(callback: CallbackQuery):
     )
     await callback.answer()
 
+REMINDERS_PAGE_SIZE = 10
+
+def _format_reminder_users(rows) -> str:
+    """Строки со списком пользователей, ожидающих напоминания"""
+    lines = ""
+    for tg_id, last_reminder, _ in rows:
+        if last_reminder:
+            last_date = last_reminder.strftime('%d.%m.%Y')
+            lines += f"• ID {tg_id} (последнее: {last_date})\n"
+        else:
+            lines += f"• ID {tg_id} (никогда)\n"
+    return lines
+
+def get_reminders_status_keyboard(page: int, has_next: bool):
+    """Клавиатура статуса напоминаний с листанием списка"""
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="⬅️", callback_data=f"reminders_status_page_{page - 1}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="➡️", callback_data=f"reminders_status_page_{page + 1}"))
+    
+    buttons = [navigation] if navigation else []
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад к панели", callback_data="admin_back")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 @router.callback_query(F.data == "reminders_status")
 async def show_reminders_status(callback: CallbackQuery):
     """Показывает статус напоминаний для всех пользователей"""
@@ -452,9 +529,10 @@ async def show_reminders_status(callback: CallbackQuery):
             await callback.answer("❌ Планировщик не инициализирован!")
             return
         
-        status_list = await scheduler.get_users_reminder_status()
+        # Счетчики — одним агрегирующим запросом, список — только первая страница
+        summary = await scheduler.get_reminder_status_summary()
         
-        if not status_list:
+        if not summary.get('total'):
             await callback.message.edit_text(
                 "📊 **СТАТУС НАПОМИНАНИЙ**\n\n"
                 "❌ Нет зарегистрированных пользователей.",
@@ -463,35 +541,54 @@ async def show_reminders_status(callback: CallbackQuery):
             )
             return
         
-        # Подсчитываем статистику
-        total_users = len(status_list)
-        need_reminder = sum(1 for user in status_list if user['needs_reminder'])
-        have_reminder = total_users - need_reminder
-        
+        need_reminder = summary['due']
         status_text = (
             "📊 **СТАТУС НАПОМИНАНИЙ**\n\n"
-            f"👥 Всего пользователей: **{total_users}**\n"
+            f"👥 Всего пользователей: **{summary['total']}**\n"
             f"🔔 Нужно напоминание: **{need_reminder}**\n"
-            f"✅ Получали недавно: **{have_reminder}**\n\n"
+            f"✅ Получали недавно: **{summary['scheduled']}**\n"
+            f"📭 Без доработок: **{summary['without_improvements']}**\n"
+            f"🚫 Недоступны: **{summary['unreachable']}**\n\n"
         )
         
+        has_next = False
         if need_reminder > 0:
+            rows, has_next = await scheduler.get_users_needing_reminder_page(0, REMINDERS_PAGE_SIZE)
             status_text += "🔔 **Пользователи, нуждающиеся в напоминании:**\n"
-            for user in status_list[:10]:  # Показываем первых 10
-                if user['needs_reminder']:
-                    if user['last_reminder']:
-                        from datetime import datetime
-                        last_date = user['last_reminder'].strftime('%d.%m.%Y')
-                        status_text += f"• ID {user['tg_id']} (последнее: {last_date})\n"
-                    else:
-                        status_text += f"• ID {user['tg_id']} (никогда)\n"
+            status_text += _format_reminder_users(rows)
             
-            if need_reminder > 10:
-                status_text += f"... и еще {need_reminder - 10} пользователей\n"
+            if need_reminder > REMINDERS_PAGE_SIZE:
+                status_text += f"... и еще {need_reminder - REMINDERS_PAGE_SIZE} пользователей\n"
         
         await callback.message.edit_text(
             status_text,
-            reply_markup=get_back_to_admin_keyboard(),
+            reply_markup=get_reminders_status_keyboard(0, has_next),
+            parse_mode="Markdown"
+        )
+        await callback.answer()
+        
+    except Exception as e:
+        await callback.answer(f"Ошибка: {str(e)}")
+
+@router.callback_query(F.data.startswith("reminders_status_page_"))
+async def show_reminders_status_page(callback: CallbackQuery):
+    """Показывает страницу списка пользователей, нуждающихся в напоминании"""
+    try:
+        scheduler = get_reminder_scheduler()
+        
+        if scheduler is None:
+            await callback.answer("❌ Планировщик не инициализирован!")
+            return
+        
+        page = max(int(callback.data.replace("reminders_status_page_", "")), 0)
+        rows, has_next = await scheduler.get_users_needing_reminder_page(page, REMINDERS_PAGE_SIZE)
+        
+        status_text = f"🔔 **НУЖНО НАПОМИНАНИЕ** (стр. {page + 1})\n\n"
+        status_text += _format_reminder_users(rows) if rows else "Пользователей на этой странице нет.\n"
+        
+        await callback.message.edit_text(
+            status_text,
+            reply_markup=get_reminders_status_keyboard(page, has_next),
             parse_mode="Markdown"
         )
         await callback.answer()
@@ -585,9 +682,9 @@ async def send_reminder_to_user_process(message: Message, state: FSMContext):
 # ==================== ОБРАБОТЧИКИ РАССЫЛКИ ====================
 
 async def get_all_users():
-    """Получает всех пользователей из базы данных"""
+    """Получает всех пользователей, которым можно отправлять сообщения"""
     async with async_session_factory() as session:
-        result = await session.execute(select(User.tg_id))
+        result = await session.execute(select(User.tg_id).where(reachable_user_condition()))
         return [row[0] for row in result.all()]
 
 @router.callback_query(F.data == "admin_broadcast")
@@ -698,67 +795,24 @@ async def broadcast_confirm_sending(callback: CallbackQuery, state: FSMContext):
             await state.clear()
             return
         
-        # Обновляем сообщение с информацией о начале рассылки
+        # Сохраняем рассылку и получателей в БД — дальше её ведет фоновый воркер,
+        # который переживает перезапуск бота и не отправляет сообщение дважды
+        async with async_session_factory() as session:
+            job, recipients_count = await create_broadcast_job(
+                message_text, "Markdown", callback.message.chat.id, callback.message.message_id, session
+            )
+        
+        await state.clear()
         await callback.message.edit_text(
-            f"📤 **ОТПРАВКА РАССЫЛКИ**\n\n"
-            f"👥 Получателей: **{users_count}**\n"
+            f"📤 **ОТПРАВКА РАССЫЛКИ #{job.id}**\n\n"
+            f"👥 Получателей: **{recipients_count}**\n"
             f"📝 Сообщение: **{len(message_text)}** символов\n\n"
             "⏳ Начинаем отправку...",
+            reply_markup=get_broadcast_job_keyboard(job),
             parse_mode="Markdown"
         )
-        
-        await state.set_state(AdminBroadcast.sending_messages)
-        
-        # Отправляем сообщения
-        success_count = 0
-        error_count = 0
-        
-        for i, user_id in enumerate(users, 1):
-            try:
-                await callback.bot.send_message(
-                    chat_id=user_id,
-                    text=message_text,
-                    parse_mode="Markdown"
-                )
-                success_count += 1
-                
-                # Обновляем прогресс каждые 10 сообщений
-                if i % 10 == 0 or i == users_count:
-                    progress_text = (
-                        f"📤 **ОТПРАВКА РАССЫЛКИ**\n\n"
-                        f"👥 Получателей: **{users_count}**\n"
-                        f"📝 Сообщение: **{len(message_text)}** символов\n\n"
-                        f"✅ Отправлено: **{success_count}**\n"
-                        f"❌ Ошибок: **{error_count}**\n"
-                        f"📊 Прогресс: **{i}/{users_count}** ({(i/users_count*100):.1f}%)"
-                    )
-                    await callback.message.edit_text(
-                        progress_text,
-                        parse_mode="Markdown"
-                    )
-                
-            except Exception as e:
-                error_count += 1
-                print(f"Ошибка отправки пользователю {user_id}: {e}")
-        
-        # Финальное сообщение с результатами
-        final_text = (
-            f"✅ **РАССЫЛКА ЗАВЕРШЕНА**\n\n"
-            f"👥 Всего получателей: **{users_count}**\n"
-            f"✅ Успешно отправлено: **{success_count}**\n"
-            f"❌ Ошибок: **{error_count}**\n"
-            f"📊 Процент успеха: **{(success_count/users_count*100):.1f}%**\n\n"
-            "Рассылка завершена!"
-        )
-        
-        await callback.message.edit_text(
-            final_text,
-            reply_markup=get_back_to_admin_keyboard(),
-            parse_mode="Markdown"
-        )
-        
-        await state.clear()
-        await callback.answer("✅ Рассылка завершена!")
+        get_broadcast_runner().submit(job.id)
+        await callback.answer("📤 Рассылка запущена")
         
     except Exception as e:
         await callback.message.edit_text(
@@ -771,6 +825,153 @@ async def broadcast_confirm_sending(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         await callback.answer("❌ Ошибка рассылки!")
 
+def render_broadcast_progress(job: BroadcastJob, counts: dict):
+    """Текст и клавиатура с прогрессом рассылки"""
+    total = sum(counts.values())
+    sent = counts.get("sent", 0)
+    errors = counts.get("blocked", 0) + counts.get("failed", 0) + counts.get("unknown", 0)
+    processed = sent + errors
+    percent = processed / total * 100 if total else 100.0
+    
+    title = {
+        "running": "📤 **ОТПРАВКА РАССЫЛКИ",
+        "paused": "⏸ **РАССЫЛКА НА ПАУЗЕ",
+        "cancelled": "⛔ **РАССЫЛКА ОТМЕНЕНА",
+        "done": "✅ **РАССЫЛКА ЗАВЕРШЕНА",
+    }.get(job.status, "📢 **РАССЫЛКА")
+    
+    text = (
+        f"{title} #{job.id}**\n\n"
+        f"👥 Получателей: **{total}**\n"
+        f"📝 Сообщение: **{len(job.text)}** символов\n\n"
+        f"✅ Отправлено: **{sent}**\n"
+        f"❌ Ошибок: **{errors}**\n"
+        f"📊 Прогресс: **{processed}/{total}** ({percent:.1f}%)"
+    )
+    if job.status == "done" and total:
+        text += f"\n📊 Процент успеха: **{(sent/total*100):.1f}%**"
+    return text, get_broadcast_job_keyboard(job)
+
+def get_broadcast_job_keyboard(job: BroadcastJob):
+    """Клавиатура управления конкретной рассылкой"""
+    buttons = []
+    if job.status == "running":
+        buttons.append([
+            InlineKeyboardButton(text="⏸ Пауза", callback_data=f"broadcast_job_pause_{job.id}"),
+            InlineKeyboardButton(text="⛔ Отменить", callback_data=f"broadcast_job_cancel_{job.id}")
+        ])
+    elif job.status == "paused":
+        buttons.append([
+            InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"broadcast_job_resume_{job.id}"),
+            InlineKeyboardButton(text="⛔ Отменить", callback_data=f"broadcast_job_cancel_{job.id}")
+        ])
+    buttons.append([InlineKeyboardButton(text="🔄 Обновить", callback_data=f"broadcast_job_view_{job.id}")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад к панели", callback_data="admin_back")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+async def _show_broadcast_job(callback: CallbackQuery, job_id: int):
+    """Показывает прогресс рассылки в текущем сообщении и привязывает к нему обновления"""
+    async with async_session_factory() as session:
+        job = await get_broadcast_job(job_id, session)
+        if job is None:
+            await callback.answer("❌ Рассылка не найдена!")
+            return
+        job.admin_chat_id = callback.message.chat.id
+        job.progress_message_id = callback.message.message_id
+        await session.commit()
+        counts = await get_broadcast_job_counts(job_id, session)
+    
+    text, reply_markup = render_broadcast_progress(job, counts)
+    try:
+        await callback.message.edit_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    await callback.answer()
+
+@router.callback_query(F.data == "broadcast_jobs")
+async def broadcast_show_jobs(callback: CallbackQuery):
+    """Показывает последние рассылки"""
+    try:
+        async with async_session_factory() as session:
+            jobs = await get_recent_broadcast_jobs(session, limit=5)
+        
+        if not jobs:
+            await callback.message.edit_text(
+                "📋 **ИСТОРИЯ РАССЫЛОК**\n\n"
+                "Рассылок еще не было.",
+                reply_markup=get_back_to_admin_keyboard(),
+                parse_mode="Markdown"
+            )
+            await callback.answer()
+            return
+        
+        status_names = {
+            "running": "📤 идет",
+            "paused": "⏸ на паузе",
+            "cancelled": "⛔ отменена",
+            "done": "✅ завершена",
+        }
+        buttons = [
+            [InlineKeyboardButton(
+                text=f"#{job.id} · {job.created_at.strftime('%d.%m %H:%M') if job.created_at else ''} · "
+                     f"{status_names.get(job.status, job.status)}",
+                callback_data=f"broadcast_job_view_{job.id}"
+            )]
+            for job in jobs
+        ]
+        buttons.append([InlineKeyboardButton(text="⬅️ Назад к панели", callback_data="admin_back")])
+        
+        await callback.message.edit_text(
+            "📋 **ИСТОРИЯ РАССЫЛОК**\n\n"
+            "Выберите рассылку, чтобы посмотреть прогресс или управлять ею:",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+            parse_mode="Markdown"
+        )
+        await callback.answer()
+        
+    except Exception as e:
+        await callback.answer(f"Ошибка: {str(e)}")
+
+@router.callback_query(F.data.startswith("broadcast_job_view_"))
+async def broadcast_view_job(callback: CallbackQuery):
+    """Показывает прогресс рассылки"""
+    try:
+        job_id = int(callback.data.replace("broadcast_job_view_", ""))
+        await _show_broadcast_job(callback, job_id)
+    except Exception as e:
+        await callback.answer(f"Ошибка: {str(e)}")
+
+@router.callback_query(F.data.startswith("broadcast_job_pause_"))
+async def broadcast_pause_job(callback: CallbackQuery):
+    """Ставит рассылку на паузу"""
+    try:
+        job_id = int(callback.data.replace("broadcast_job_pause_", ""))
+        await get_broadcast_runner().pause(job_id)
+        await _show_broadcast_job(callback, job_id)
+    except Exception as e:
+        await callback.answer(f"Ошибка: {str(e)}")
+
+@router.callback_query(F.data.startswith("broadcast_job_resume_"))
+async def broadcast_resume_job(callback: CallbackQuery):
+    """Продолжает рассылку после паузы"""
+    try:
+        job_id = int(callback.data.replace("broadcast_job_resume_", ""))
+        await get_broadcast_runner().resume(job_id)
+        await _show_broadcast_job(callback, job_id)
+    except Exception as e:
+        await callback.answer(f"Ошибка: {str(e)}")
+
+@router.callback_query(F.data.startswith("broadcast_job_cancel_"))
+async def broadcast_cancel_job(callback: CallbackQuery):
+    """Отменяет рассылку (уже отправленные сообщения остаются)"""
+    try:
+        job_id = int(callback.data.replace("broadcast_job_cancel_", ""))
+        await get_broadcast_runner().cancel(job_id)
+        await _show_broadcast_job(callback, job_id)
+    except Exception as e:
+        await callback.answer(f"Ошибка: {str(e)}")
+
 @router.callback_query(F.data == "broadcast_cancel")
 async def broadcast_cancel_sending(callback: CallbackQuery, state: FSMContext):
     """Отменяет рассылку"""
@@ -808,21 +1009,27 @@ async def broadcast_show_stats(callback: CallbackQuery):
         async with async_session_factory() as session:
             # Подсчитываем пользователей с командами
             teams_result = await session.execute(
-                select(func.count(User.id)).where(User.team_id.isnot(None))
+                select(func.count(User.id)).where(User.team_id.isnot(None), reachable_user_condition())
             )
             users_with_teams = teams_result.scalar() or 0
             
             # Подсчитываем пользователей без команд
             users_without_teams = users_count - users_with_teams
+            
+            # Пользователи, которые не получат рассылку
+            unreachable = await count_unreachable_users(session)
         
         stats_text = (
             "📊 **СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ**\n\n"
             f"👥 Всего пользователей: **{users_count}**\n"
             f"👥 С командами: **{users_with_teams}**\n"
             f"👤 Без команд: **{users_without_teams}**\n\n"
+            f"🚫 Пропускаются: **{unreachable['blocked'] + unreachable['failing']}**\n"
+            f"   • заблокировали бота: **{unreachable['blocked']}**\n"
+            f"   • {MAX_DELIVERY_FAILURES}+ ошибок доставки подряд: **{unreachable['failing']}**\n\n"
             "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
-            "💡 Все пользователи получат рассылку\n"
-            "💡 Рассылка отправляется всем зарегистрированным пользователям"
+            "💡 Рассылка отправляется всем доступным пользователям\n"
+            "💡 Пропущенные снова получают сообщения после /start"
         )
         
         await callback.message.edit_text(
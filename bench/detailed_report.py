@@ -0,0 +1,183 @@
+"""Бенчмарк детального Excel-отчёта: исходный построитель на pandas против потокового
+
+Оба варианта получают одни и те же синтетические результаты. «Строки» — подготовка
+данных листов (DataFrame у исходного, iter_detailed_report_rows у потокового),
+«отчёт» — весь путь до готового xlsx. Пиковая память меряется tracemalloc.
+
+Запуск из корня проекта: python -m bench.detailed_report [количество результатов]
+"""
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Dict, Optional, Union
+
+import pandas as pd
+
+from calculator import FLLCalculator
+from score_storage import MemoryScoreStorage
+
+
+@dataclass
+class SyntheticResult:
+    id: int
+    mission_scores: Dict[str, int]
+    total_score: int
+    max_possible_score: int
+    created_at: Union[datetime, str]
+    name: Optional[str] = None
+
+
+def make_results(calculator: FLLCalculator, count: int, seed: int = 1):
+    """Результаты с датами и как datetime, и как ISO-строки, неизвестными миссиями и нулевым максимумом"""
+    rnd = random.Random(seed)
+    mission_ids = list(calculator.missions)
+    started = datetime(2025, 1, 1)
+    results = []
+    for i in range(count):
+        scores = {}
+        for mission_id in mission_ids:
+            if rnd.random() < 0.8:
+                max_points = calculator.missions[mission_id]['max_points']
+                scores[mission_id] = rnd.randrange(0, max_points + 1, 5)
+        if i % 50 == 0:
+            scores['mission_unknown'] = 3
+        created_at = started + timedelta(minutes=i)
+        results.append(SyntheticResult(
+            id=i + 1,
+            mission_scores=scores,
+            total_score=sum(scores.values()),
+            max_possible_score=0 if i % 97 == 0 else calculator.get_max_possible_score(),
+            created_at=created_at.isoformat() if i % 2 else created_at,
+            name=None if i % 3 else f"Результат {i}",
+        ))
+    return results
+
+
+def _date_str(created_at) -> str:
+    if hasattr(created_at, 'strftime'):
+        return created_at.strftime('%d.%m.%Y %H:%M')
+    return datetime.fromisoformat(created_at).strftime('%d.%m.%Y %H:%M')
+
+
+def baseline_frames(calculator: FLLCalculator, results):
+    """Листы так, как их строил исходный generate_detailed_excel_report: четыре прохода и DataFrame на лист"""
+    missions = calculator.missions
+    stats_data = []
+    for result in results:
+        date_str = _date_str(result.created_at)
+        percentage = (result.total_score / result.max_possible_score * 100) if result.max_possible_score > 0 else 0
+        stats_data.append({
+            'Дата': date_str,
+            'Общий балл': result.total_score,
+            'Максимальный балл': result.max_possible_score,
+            'Процент выполнения': f"{percentage:.1f}%",
+            'Название': result.name or f"Результат от {date_str}"
+        })
+
+    summary_rows = []
+    for result in results:
+        date_str = _date_str(result.created_at)
+        done_missions = [
+            missions.get(m_id, {}).get('name', m_id)
+            for m_id, score in result.mission_scores.items() if score > 0
+        ]
+        percentage = (result.total_score / result.max_possible_score * 100) if result.max_possible_score > 0 else 0
+        summary_rows.append({
+            'Дата': date_str,
+            'Общий балл': result.total_score,
+            'Выполнено миссий': len(done_missions),
+            'Список выполненных миссий': ', '.join(done_missions) if done_missions else '-',
+            'Максимальный балл': result.max_possible_score,
+            'Процент выполнения': f"{percentage:.1f}%"
+        })
+
+    missions_data = []
+    for result in results:
+        date_str = _date_str(result.created_at)
+        for mission_id, score in result.mission_scores.items():
+            mission_name = missions.get(mission_id, {}).get('name', mission_id)
+            max_points = missions.get(mission_id, {}).get('max_points', 0)
+            missions_data.append({
+                'Дата': date_str,
+                'Миссия': mission_name,
+                'Балл': score,
+                'Максимум': max_points,
+                'Процент': f"{(score / max_points * 100):.1f}%" if max_points > 0 else "0%"
+            })
+
+    pivot_data = []
+    for mission_id, mission_data in missions.items():
+        mission_scores = [result.mission_scores[mission_id] for result in results
+                          if mission_id in result.mission_scores]
+        if mission_scores:
+            avg_score = sum(mission_scores) / len(mission_scores)
+            max_score = max(mission_scores)
+            min_score = min(mission_scores)
+        else:
+            avg_score = max_score = min_score = 0
+        pivot_data.append({
+            'Миссия': mission_data['name'],
+            'Максимальный балл': mission_data['max_points'],
+            'Средний балл': f"{avg_score:.1f}",
+            'Максимальный достигнутый': max_score,
+            'Минимальный достигнутый': min_score,
+            'Количество попыток': len(mission_scores)
+        })
+
+    return [
+        ('Общая статистика', pd.DataFrame(stats_data)),
+        ('Сводка', pd.DataFrame(summary_rows)),
+        ('Разбивка по миссиям', pd.DataFrame(missions_data)),
+        ('Сводка по миссиям', pd.DataFrame(pivot_data)),
+    ]
+
+
+def baseline_report(calculator: FLLCalculator, results, output):
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        for sheet_name, frame in baseline_frames(calculator, results):
+            frame.to_excel(writer, sheet_name=sheet_name, index=False)
+
+
+def streaming_rows(calculator: FLLCalculator, results):
+    return sum(1 for _ in calculator.iter_detailed_report_rows(results))
+
+
+def streaming_report(calculator: FLLCalculator, results, output):
+    calculator.write_detailed_excel_report_stream(results, output)
+
+
+def measure(func, *args, repeat: int = 3):
+    """Лучшее время из repeat запусков (секунды) и пиковая память отдельного запуска (MiB)"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 2**20
+
+
+def main(count: int = 10000):
+    calculator = FLLCalculator(score_storage=MemoryScoreStorage())
+    results = make_results(calculator, count)
+    print(f"Результатов: {count}")
+    print(f"{'':<10} {'строки':>14} {'память':>10} {'отчёт':>14} {'память':>10}")
+    for name, rows_func, report_func in (
+            ("исходный", baseline_frames, baseline_report),
+            ("потоковый", streaming_rows, streaming_report),
+    ):
+        rows_seconds, rows_peak = measure(rows_func, calculator, results)
+        report_seconds, report_peak = measure(lambda: report_func(calculator, results, BytesIO()), repeat=1)
+        print(f"{name:<10} {rows_seconds * 1000:>11.0f} ms {rows_peak:>6.1f} MiB "
+              f"{report_seconds * 1000:>11.0f} ms {report_peak:>6.1f} MiB")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,35 @@
+"""Микробенчмарк клавиатур миссий: построение заново против кеша
+
+Запуск из корня проекта: python -m bench.mission_keyboards
+"""
+import timeit
+
+from calculator import FLLCalculator
+from score_storage import MemoryScoreStorage
+
+
+def measure(func, number: int) -> float:
+    """Среднее время одного вызова в микросекундах (лучший из 5 повторов)"""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main(number: int = 2000):
+    calculator = FLLCalculator(score_storage=MemoryScoreStorage())
+    rebuild = {}
+    cached = {}
+    for mission_id in calculator.missions:
+        rebuild[mission_id] = measure(lambda: calculator._build_mission_keyboard(mission_id), number)
+        calculator.get_mission_keyboard(mission_id)
+        cached[mission_id] = measure(lambda: calculator.get_mission_keyboard(mission_id), number)
+
+    for mission_id in calculator.missions:
+        print(f"{mission_id:<12} rebuild {rebuild[mission_id]:8.2f} us   cached {cached[mission_id]:6.2f} us")
+    print(f"Миссий: {len(calculator.missions)}")
+    print(f"rebuild: среднее {sum(rebuild.values()) / len(rebuild):.1f} us "
+          f"({min(rebuild.values()):.1f}-{max(rebuild.values()):.1f} us)")
+    print(f"cached:  среднее {sum(cached.values()) / len(cached):.2f} us "
+          f"({min(cached.values()):.2f}-{max(cached.values()):.2f} us)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Бенчмарк записи в SQLite: журнал DELETE + synchronous=FULL против профиля SQLITE_PRAGMAS
+
+Нагрузка похожа на бота: сохранения калькулятора, фото, заявки на рекорды и
+чтения истории, до 50 операций одновременно, у каждой своя сессия и commit.
+База создается во временном каталоге (по умолчанию — рядом с проектом,
+чтобы мерить ту же файловую систему, что и у mydatabase.db).
+
+Запуск из корня проекта: python -m bench.sqlite_writes [пользователей] [раундов]
+"""
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from database.engine import SQLITE_PRAGMAS
+from database.models import Base, SubmittedRecord, User, UserTeams
+from database.requests import get_user_fll_results, mark_photo_received, save_fll_result
+
+BASELINE_PRAGMAS = {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": "5000"}
+CONCURRENCY = 50
+
+
+def create_engine_with_pragmas(path: str, pragmas: dict):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if value:
+                cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
+async def prepare(session_factory, users: int):
+    async with session_factory() as session:
+        team = UserTeams(team="bench", city="bench", number=1, password="bench")
+        session.add(team)
+        await session.flush()
+        session.add_all(User(tg_id=1000 + i, team_id=team.id) for i in range(users))
+        await session.commit()
+        return team.id
+
+
+async def run_profile(name: str, pragmas: dict, users: int, rounds: int, directory: str):
+    engine = create_engine_with_pragmas(f"{directory}/{name}.db", pragmas)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    team_id = await prepare(session_factory, users)
+
+    rnd = random.Random(1)
+    operations = []
+    for round_number in range(rounds):
+        for i in range(users):
+            operations.append(("save", 1000 + i, round_number))
+            operations.append(("photo", 1000 + i, round_number))
+            operations.append(("record", 1000 + i, round_number))
+            operations.append(("read", 1000 + i, round_number))
+    rnd.shuffle(operations)
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    writes = 0
+
+    async def run(operation):
+        nonlocal writes
+        kind, user_tg_id, round_number = operation
+        async with semaphore, session_factory() as session:
+            if kind == "save":
+                scores = {f"mission_{m}": rnd.randrange(0, 40, 5) for m in range(1, 18)}
+                await save_fll_result(user_tg_id, scores, sum(scores.values()), 700, session=session)
+            elif kind == "photo":
+                await mark_photo_received(user_tg_id, datetime.now(), session)
+            elif kind == "record":
+                session.add(SubmittedRecord(
+                    record_id=f"{user_tg_id}_{round_number}", user_tg_id=user_tg_id, team_id=team_id,
+                    username="bench", first_name="bench", date="01.01.2025", score=100,
+                    video_data={"file_id": "bench"},
+                ))
+                await session.commit()
+            else:
+                await get_user_fll_results(user_tg_id, session=session)
+                return
+        writes += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run(operation) for operation in operations))
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+    print(f"{name:<9} {writes} записей за {elapsed:.1f} s — {writes / elapsed:.0f} writes/s")
+
+
+async def main(users: int = 300, rounds: int = 3):
+    with tempfile.TemporaryDirectory(prefix="sqlite_bench_", dir=".") as directory:
+        await run_profile("baseline", BASELINE_PRAGMAS, users, rounds, directory)
+        await run_profile("profile", SQLITE_PRAGMAS, users, rounds, directory)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(int(arg) for arg in sys.argv[1:3])))
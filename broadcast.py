@@ -0,0 +1,433 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+)
+
+from sqlalchemy import select
+
+from database.engine import async_session_factory
+from database.models import BroadcastJob
+from database.requests import (
+    claim_broadcast_recipients,
+    get_broadcast_job,
+    get_broadcast_job_counts,
+    record_delivery_results,
+    release_unconfirmed_recipients,
+    save_broadcast_results,
+    set_broadcast_job_status,
+)
+
+
+class TokenBucket:
+    """Асинхронный token bucket: не больше rate событий в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после RetryAfter от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        """Ждёт, пока не появится свободный токен"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+                self._updated = max(now, self._updated)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PerChatLimiter:
+    """Минимальный интервал между сообщениями в один чат"""
+
+    def __init__(self, interval: float = 1.0, max_chats: int = 10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next_allowed: Dict[int, float] = {}
+
+    async def acquire(self, chat_id: int):
+        now = time.monotonic()
+        if len(self._next_allowed) > self.max_chats:
+            # Забываем чаты, для которых ограничение уже истекло
+            self._next_allowed = {k: v for k, v in self._next_allowed.items() if v > now}
+        next_allowed = self._next_allowed.get(chat_id, 0.0)
+        self._next_allowed[chat_id] = max(now, next_allowed) + self.interval
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+
+
+# Общие лимиты бота: ~30 сообщений в секунду всего и ~1 в секунду в один чат.
+# Лимиты действуют в пределах процесса; массовые отправки (рассылки и напоминания)
+# в webhook-режиме выполняет только ведущий воркер, поэтому общий лимит не умножается
+telegram_rate_limiter = TokenBucket(rate=float(os.getenv("TELEGRAM_RATE_LIMIT", 30)))
+telegram_chat_limiter = PerChatLimiter(interval=float(os.getenv("TELEGRAM_CHAT_INTERVAL", 1.0)))
+
+
+# Итог доставки одному получателю
+SEND_OK = "sent"
+SEND_BLOCKED = "blocked"
+SEND_FAILED = "failed"
+
+
+@dataclass
+class BroadcastStats:
+    """Прогресс рассылки"""
+    total: int
+    sent: int = 0
+    blocked: int = 0
+    failed: int = 0
+    retries: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    @property
+    def errors(self) -> int:
+        return self.blocked + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+
+async def send_with_limits(send: Callable[[int], Awaitable], chat_id: int, max_retries: int = 3,
+                           rate_limiter: TokenBucket = telegram_rate_limiter,
+                           chat_limiter: PerChatLimiter = telegram_chat_limiter,
+                           stats: Optional[BroadcastStats] = None) -> str:
+    """Отправляет одно сообщение с учётом лимитов и повторами; возвращает SEND_*"""
+    attempt = 0
+    while True:
+        await chat_limiter.acquire(chat_id)
+        await rate_limiter.acquire()
+        try:
+            await send(chat_id)
+            return SEND_OK
+        except TelegramRetryAfter as e:
+            # Флуд-контроль действует на весь бот — притормаживаем всех отправителей
+            rate_limiter.pause(e.retry_after)
+        except TelegramForbiddenError:
+            # Бот заблокирован пользователем — повторять бессмысленно
+            return SEND_BLOCKED
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e):
+                # Пользователь удалил аккаунт или ни разу не писал боту
+                return SEND_BLOCKED
+            print(f"Ошибка отправки пользователю {chat_id}: {e}")
+            return SEND_FAILED
+        except TelegramNetworkError as e:
+            if attempt >= max_retries:
+                print(f"Ошибка отправки пользователю {chat_id}: {e}")
+                return SEND_FAILED
+            await asyncio.sleep(2 ** attempt)
+        attempt += 1
+        if stats is not None:
+            stats.retries += 1
+        if attempt > max_retries:
+            return SEND_FAILED
+
+
+class BroadcastEngine:
+    """Рассылка сообщений с ограниченным числом параллельных отправителей
+
+    Все отправители делят общий token bucket (лимит Telegram на бота) и
+    ограничение на частоту сообщений в один чат. RetryAfter приостанавливает
+    всю рассылку на указанное Telegram время, после чего сообщение
+    отправляется повторно. Прогресс сообщается не чаще раза в
+    progress_interval секунд.
+    """
+
+    def __init__(self, concurrency: int = 10, progress_interval: float = 3.0, max_retries: int = 3,
+                 rate_limiter: TokenBucket = telegram_rate_limiter,
+                 chat_limiter: PerChatLimiter = telegram_chat_limiter):
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter
+        self.chat_limiter = chat_limiter
+
+    async def run(self, chat_ids: Iterable[int], send: Callable[[int], Awaitable],
+                  on_progress: Optional[Callable[[BroadcastStats], Awaitable]] = None,
+                  on_result: Optional[Callable[[int, str], Awaitable]] = None) -> BroadcastStats:
+        """Отправляет send(chat_id) каждому получателю и возвращает итоговую статистику"""
+        chat_ids = list(chat_ids)
+        stats = BroadcastStats(total=len(chat_ids))
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait(chat_id)
+
+        async def worker():
+            while True:
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                status = await send_with_limits(
+                    send, chat_id, self.max_retries, self.rate_limiter, self.chat_limiter, stats
+                )
+                if status == SEND_OK:
+                    stats.sent += 1
+                elif status == SEND_BLOCKED:
+                    stats.blocked += 1
+                else:
+                    stats.failed += 1
+                if on_result is not None:
+                    await on_result(chat_id, status)
+
+        async def reporter():
+            last_processed = -1
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                if stats.processed != last_processed:
+                    last_processed = stats.processed
+                    try:
+                        await on_progress(stats)
+                    except Exception as e:
+                        print(f"Ошибка обновления прогресса рассылки: {e}")
+
+        reporter_task = asyncio.create_task(reporter()) if on_progress is not None else None
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(chat_ids)))))
+        finally:
+            if reporter_task is not None:
+                reporter_task.cancel()
+        return stats
+
+    async def send_text(self, bot: Bot, chat_ids: Iterable[int], text: str, parse_mode: Optional[str] = None,
+                        on_progress: Optional[Callable[[BroadcastStats], Awaitable]] = None,
+                        on_result: Optional[Callable[[int, str], Awaitable]] = None) -> BroadcastStats:
+        """Рассылает текстовое сообщение"""
+        async def send(chat_id: int):
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+
+        return await self.run(chat_ids, send, on_progress=on_progress, on_result=on_result)
+
+
+broadcast_engine = BroadcastEngine(
+    concurrency=int(os.getenv("BROADCAST_CONCURRENCY", 10)),
+    progress_interval=float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 3)),
+)
+
+
+class BroadcastJobRunner:
+    """Фоновое выполнение рассылок, сохранённых в БД
+
+    Рассылка идёт пачками по batch_size получателей: пачка сначала
+    помечается в БД как sending, затем отправляется, затем сохраняются
+    итоги. Между пачками проверяется статус рассылки, поэтому пауза и
+    отмена срабатывают не позже чем через одну пачку. После перезапуска
+    незавершённые рассылки продолжаются с того же места, а получатели,
+    оставшиеся в sending, повторно не получают сообщение.
+
+    Отправляет только запущенный экземпляр (start() вызывает ведущий
+    процесс): в остальных воркерах submit и resume лишь меняют статус в БД,
+    а ведущий раз в poll_interval секунд подхватывает рассылки в статусе
+    running, которые у него не выполняются. Так рассылка не остаётся
+    «running» навсегда, если упал воркер, и общий лимит Telegram
+    соблюдается одним процессом.
+    """
+
+    def __init__(self, bot: Bot, engine: BroadcastEngine, batch_size: int = 50,
+                 progress_interval: float = 3.0, poll_interval: float = 5.0):
+        self.bot = bot
+        self.engine = engine
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.poll_interval = poll_interval
+        self._tasks: Dict[int, asyncio.Task] = {}
+        # Проверка «рассылка здесь не выполняется», сброс её пачки в sending и запуск
+        # идут под одной блокировкой: иначе опрос и resume могли бы сбросить пачку
+        # у только что запущенного воркера
+        self._submit_lock = asyncio.Lock()
+        # Рассылки, которые сейчас запускаются под этой блокировкой: submit() их пропускает
+        self._starting = set()
+        self._started = False
+        self._stopping = False
+        self._poll_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Продолжает прерванные рассылки и начинает подхватывать новые"""
+        self._started = True
+        await self._pick_up_jobs()
+        self._poll_task = asyncio.create_task(self._poll_jobs())
+
+    async def _pick_up_jobs(self):
+        """Запускает рассылки в статусе running, которые здесь не выполняются"""
+        async with self._submit_lock, async_session_factory() as session:
+            query = await session.execute(select(BroadcastJob.id).where(BroadcastJob.status == "running"))
+            for job_id in query.scalars().all():
+                if job_id in self._tasks:
+                    continue
+                # Рассылки выполняет только этот процесс, значит, пачка в sending
+                # осталась от прерванного запуска
+                self._starting.add(job_id)
+                try:
+                    released = await release_unconfirmed_recipients(job_id, session)
+                finally:
+                    self._starting.discard(job_id)
+                if released:
+                    print(f"Рассылка {job_id}: {released} получателей без подтверждения доставки пропущены")
+                self.submit(job_id)
+
+    async def _poll_jobs(self):
+        while not self._stopping:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self._pick_up_jobs()
+            except Exception as e:
+                print(f"Ошибка проверки рассылок: {e}")
+
+    async def stop(self, timeout: float = 10.0):
+        """Останавливает воркеры, дав им дописать текущую пачку"""
+        self._stopping = True
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def is_active(self, job_id: int) -> bool:
+        return job_id in self._tasks
+
+    def submit(self, job_id: int):
+        """Запускает выполнение рассылки в фоне (если она ещё не выполняется)
+
+        В незапущенном экземпляре ничего не делает: рассылку подхватит ведущий.
+        """
+        if not self._started or self._stopping or job_id in self._tasks or job_id in self._starting:
+            return
+        task = asyncio.create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def pause(self, job_id: int):
+        async with async_session_factory() as session:
+            await set_broadcast_job_status(job_id, "paused", session)
+
+    async def resume(self, job_id: int):
+        async with self._submit_lock, async_session_factory() as session:
+            if self._started and job_id not in self._tasks:
+                # Воркера нет — пачка в sending осталась от прерванного запуска
+                self._starting.add(job_id)
+                try:
+                    await release_unconfirmed_recipients(job_id, session)
+                    await set_broadcast_job_status(job_id, "running", session)
+                finally:
+                    self._starting.discard(job_id)
+            else:
+                await set_broadcast_job_status(job_id, "running", session)
+            self.submit(job_id)
+
+    async def cancel(self, job_id: int):
+        async with async_session_factory() as session:
+            await set_broadcast_job_status(job_id, "cancelled", session)
+        if job_id not in self._tasks:
+            await self.update_progress(job_id)
+
+    async def _run(self, job_id: int):
+        last_progress = 0.0
+        try:
+            while not self._stopping:
+                async with async_session_factory() as session:
+                    job = await get_broadcast_job(job_id, session)
+                    if job is None or job.status != "running":
+                        break
+                    batch = await claim_broadcast_recipients(job_id, self.batch_size, session)
+                    if not batch:
+                        await set_broadcast_job_status(job_id, "done", session)
+                        break
+
+                async def send(chat_id: int):
+                    await self.bot.send_message(chat_id=chat_id, text=job.text, parse_mode=job.parse_mode)
+
+                statuses: Dict[int, str] = {}
+
+                async def collect(chat_id: int, status: str):
+                    statuses[chat_id] = status
+
+                await self.engine.run(batch, send, on_result=collect)
+
+                async with async_session_factory() as session:
+                    await save_broadcast_results(job_id, statuses, session)
+                    await record_delivery_results(statuses, session)
+
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    await self.update_progress(job_id)
+        except Exception as e:
+            print(f"Ошибка рассылки {job_id}: {e}")
+        await self.update_progress(job_id)
+
+    async def update_progress(self, job_id: int):
+        """Обновляет сообщение с прогрессом рассылки у админа"""
+        from admins_panel.admin_keyboard import render_broadcast_progress
+
+        try:
+            async with async_session_factory() as session:
+                job = await get_broadcast_job(job_id, session)
+                counts = await get_broadcast_job_counts(job_id, session)
+            if job is None or job.progress_message_id is None:
+                return
+            text, reply_markup = render_broadcast_progress(job, counts)
+            await self.bot.edit_message_text(
+                text=text,
+                chat_id=job.admin_chat_id,
+                message_id=job.progress_message_id,
+                reply_markup=reply_markup,
+                parse_mode="Markdown"
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                print(f"Ошибка обновления прогресса рассылки {job_id}: {e}")
+        except Exception as e:
+            print(f"Ошибка обновления прогресса рассылки {job_id}: {e}")
+
+
+# Глобальный экземпляр фоновых рассылок
+broadcast_runner: BroadcastJobRunner = None
+
+
+def get_broadcast_runner() -> BroadcastJobRunner:
+    """Получает экземпляр фоновых рассылок"""
+    return broadcast_runner
+
+
+def init_broadcast_runner(bot: Bot) -> BroadcastJobRunner:
+    """Инициализирует фоновые рассылки"""
+    global broadcast_runner
+    broadcast_runner = BroadcastJobRunner(
+        bot,
+        broadcast_engine,
+        batch_size=int(os.getenv("BROADCAST_BATCH_SIZE", 50)),
+        progress_interval=float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 3)),
+        poll_interval=float(os.getenv("BROADCAST_POLL_INTERVAL", 5)),
+    )
+    return broadcast_runner
@@ -1,12 +1,19 @@
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-import pandas as pd
+from openpyxl import Workbook
 from io import BytesIO
+from itertools import chain
 from datetime import datetime
 import json
 
+from score_storage import ScoreStorage, create_score_storage
+
+
+# Листы детального отчёта в порядке следования в книге
+DETAILED_REPORT_SHEETS = ('Общая статистика', 'Сводка', 'Разбивка по миссиям', 'Сводка по миссиям')
+
 
 class FLLCalculator:
-    def __init__(self):
+    def __init__(self, score_storage: ScoreStorage = None):
         # Глобальный максимум сезона (итог должен быть 700)
         self.global_max_total = 700
         self.missions = {
@@ -57,47 +64,93 @@ class FLLCalculator:
             # Парковка самокатов: 20 баллов за каждый; максимум 4 шт = 80 баллов
             "mission_7": {"points_per_unit": 20, "max_units": 4, "unit_label": "шт"},
         }
-        self.user_scores = {}
+        # Незавершённые результаты пользователей (по умолчанию — LRU в памяти с TTL)
+        self.score_storage = score_storage or create_score_storage()
+        # Клавиатуры миссий зависят только от таблиц выше — строим один раз на миссию
+        self._mission_keyboards = {}
+        # Ряды главной клавиатуры: (миссия, очки) / ("total", итог) / "static"
+        self._main_rows = {}
+
+    async def _get_scores(self, user_id):
+        """Получает очки пользователя одним обращением к хранилищу"""
+        if not user_id:
+            return {}
+        return await self.score_storage.get(user_id) or {}
     
-    def get_main_keyboard(self, user_id=None):
+    async def get_main_keyboard(self, user_id=None):
         """Главная клавиатура калькулятора"""
         buttons = []
+        scores = await self._get_scores(user_id)
         
-        for mission_id, mission_data in self.missions.items():
-            current_score = self.get_mission_score(user_id, mission_id) if user_id else 0
-            button = InlineKeyboardButton(
-                text=f"{mission_data['name']} ({current_score}/{mission_data['max_points']})",
-                callback_data=f"calc_{mission_id}"
-            )
-            buttons.append([button])
+        # Ряды миссий кешируются по (миссия, очки): заново строится только ряд изменившейся миссии,
+        # а итог считается в том же проходе
+        total_score = 0
+        for mission_id in self.missions:
+            current_score = scores.get(mission_id, 0)
+            total_score += current_score
+            buttons.append(self._get_mission_row(mission_id, current_score))
         
         # Кнопки управления
-        total_score = self.get_total_score(user_id) if user_id else 0
-        max_total = self.get_max_possible_score()
-        
-        control_buttons = [
-            InlineKeyboardButton(text=f"📊 Итого: {total_score}/{max_total}", callback_data="calc_total"),
-            InlineKeyboardButton(text="🔄 Сбросить", callback_data="calc_reset")
-        ]
-        buttons.append(control_buttons)
-        
-        # Новые кнопки для сохранения и просмотра результатов
-        save_results_button = [InlineKeyboardButton(text="💾 Сохранить результаты", callback_data="calc_save")]
-        my_results_button = [InlineKeyboardButton(text="📋 Мои результаты", callback_data="calc_my_results")]
-        buttons.append(save_results_button)
-        buttons.append(my_results_button)
-        
-        # Изменяем callback_data для кнопки "Назад"
-        back_button = [InlineKeyboardButton(text="◀️ Назад в меню", callback_data="menu_pt")]
-        buttons.append(back_button)
+        buttons.append(self._get_control_row(total_score))
+        buttons.extend(self._get_main_static_rows())
         
         return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    def _get_mission_row(self, mission_id, current_score):
+        """Ряд главной клавиатуры для миссии с заданными очками (кешируется)"""
+        key = (mission_id, current_score)
+        row = self._main_rows.get(key)
+        if row is None:
+            mission_data = self.missions[mission_id]
+            row = self._main_rows[key] = [InlineKeyboardButton(
+                text=f"{mission_data['name']} ({current_score}/{mission_data['max_points']})",
+                callback_data=f"calc_{mission_id}"
+            )]
+        return row
+
+    def _get_control_row(self, total_score):
+        """Ряд с итогом и сбросом (кешируется по значению итога)"""
+        key = ("total", total_score)
+        row = self._main_rows.get(key)
+        if row is None:
+            max_total = self.get_max_possible_score()
+            row = self._main_rows[key] = [
+                InlineKeyboardButton(text=f"📊 Итого: {total_score}/{max_total}", callback_data="calc_total"),
+                InlineKeyboardButton(text="🔄 Сбросить", callback_data="calc_reset")
+            ]
+        return row
+
+    def _get_main_static_rows(self):
+        """Неизменные нижние ряды главной клавиатуры"""
+        rows = self._main_rows.get("static")
+        if rows is None:
+            rows = []
+            # Новые кнопки для сохранения и просмотра результатов
+            save_results_button = [InlineKeyboardButton(text="💾 Сохранить результаты", callback_data="calc_save")]
+            my_results_button = [InlineKeyboardButton(text="📋 Мои результаты", callback_data="calc_my_results")]
+            rows.append(save_results_button)
+            rows.append(my_results_button)
+            
+            # Изменяем callback_data для кнопки "Назад"
+            back_button = [InlineKeyboardButton(text="◀️ Назад в меню", callback_data="menu_pt")]
+            rows.append(back_button)
+            self._main_rows["static"] = rows
+        return rows
     
     def get_mission_keyboard(self, mission_id):
-        """Клавиатура для конкретной миссии"""
-        if mission_id not in self.missions:
-            return None
-            
+        """Клавиатура для конкретной миссии (кешируется, не изменяйте возвращаемый объект)"""
+        keyboard = self._mission_keyboards.get(mission_id)
+        if keyboard is None and mission_id in self.missions:
+            keyboard = self._mission_keyboards[mission_id] = self._build_mission_keyboard(mission_id)
+        return keyboard
+
+    def invalidate_mission_keyboards(self):
+        """Сбрасывает кеш клавиатур миссий (после изменения missions или пресетов)"""
+        self._mission_keyboards.clear()
+        self._main_rows.clear()
+
+    def _build_mission_keyboard(self, mission_id):
+        """Строит клавиатуру для конкретной миссии"""
         mission = self.missions[mission_id]
         max_points = mission["max_points"]
         
@@ -235,42 +288,34 @@ class FLLCalculator:
         ]
         return InlineKeyboardMarkup(inline_keyboard=buttons)
     
-    def set_mission_score(self, user_id, mission_id, score):
+    async def set_mission_score(self, user_id, mission_id, score):
         """Устанавливает очки за миссию"""
         if not user_id or mission_id not in self.missions:
             return False
-            
-        if user_id not in self.user_scores:
-            self.user_scores[user_id] = {}
         
         max_points = self.missions[mission_id]["max_points"]
         if 0 <= score <= max_points:
-            self.user_scores[user_id][mission_id] = score
+            await self.score_storage.set_score(user_id, mission_id, score)
             return True
         return False
     
-    def get_mission_score(self, user_id, mission_id):
+    async def get_mission_score(self, user_id, mission_id):
         """Получает очки за миссию"""
-        if (user_id and 
-            user_id in self.user_scores and 
-            mission_id in self.user_scores[user_id]):
-            return self.user_scores[user_id][mission_id]
-        return 0
+        return (await self._get_scores(user_id)).get(mission_id, 0)
     
-    def get_total_score(self, user_id):
+    async def get_total_score(self, user_id):
         """Вычисляет общий счет"""
-        if not user_id or user_id not in self.user_scores:
-            return 0
-        return sum(self.user_scores[user_id].values())
+        return sum((await self._get_scores(user_id)).values())
     
-    def reset_scores(self, user_id):
+    async def reset_scores(self, user_id):
         """Сбрасывает все очки пользователя"""
-        if user_id and user_id in self.user_scores:
-            self.user_scores[user_id] = {}
+        if user_id:
+            await self.score_storage.delete(user_id)
     
-    def get_score_breakdown(self, user_id):
+    async def get_score_breakdown(self, user_id):
         """Возвращает детальную разбивку очков"""
-        if not user_id or user_id not in self.user_scores:
+        scores = await self._get_scores(user_id)
+        if not scores:
             breakdown = "🏆 **Детальная разбивка очков:**\n\n"
             for mission_id, mission_data in self.missions.items():
                 breakdown += f"⭕ {mission_data['name']}: 0/{mission_data['max_points']}\n"
@@ -284,7 +329,7 @@ class FLLCalculator:
         total = 0
         
         for mission_id, mission_data in self.missions.items():
-            score = self.get_mission_score(user_id, mission_id)
+            score = scores.get(mission_id, 0)
             total += score
             status = "✅" if score > 0 else "⭕"
             breakdown += f"{status} {mission_data['name']}: {score}/{mission_data['max_points']}\n"
@@ -298,11 +343,9 @@ class FLLCalculator:
         
         return breakdown
     
-    def get_user_scores_dict(self, user_id):
+    async def get_user_scores_dict(self, user_id):
         """Возвращает словарь с очками пользователя для сохранения"""
-        if not user_id or user_id not in self.user_scores:
-            return {}
-        return self.user_scores[user_id].copy()
+        return dict(await self._get_scores(user_id))
     
     def get_max_possible_score(self):
         """Возвращает максимально возможный счет"""
@@ -356,128 +399,116 @@ class FLLCalculator:
         
         return report
     
-    def generate_detailed_excel_report(self, results):
-        """Генерирует детальный отчёт в формате Excel"""
-        if not results:
-            return None
+    def iter_detailed_report_rows(self, results):
+        """Строки детального отчёта: пары (лист, строка) за один проход по results
+
+        results обходится один раз и может быть генератором (например, потоком
+        строк из БД): в памяти остаются только агрегаты сводки по миссиям.
+        По этим строкам строится и отчёт в памяти, и отчёт в файл.
+        """
+        stats_sheet, summary_sheet, missions_sheet, pivot_sheet = DETAILED_REPORT_SHEETS
+        yield stats_sheet, ['Дата', 'Общий балл', 'Максимальный балл', 'Процент выполнения', 'Название']
+        yield summary_sheet, ['Дата', 'Общий балл', 'Выполнено миссий', 'Список выполненных миссий',
+                              'Максимальный балл', 'Процент выполнения']
+        missions_header_written = False
         
-        # Создаём Excel файл в памяти
-        output = BytesIO()
+        # Агрегаты для сводки по миссиям: [сумма, максимум, минимум, количество]
+        mission_stats = {mission_id: [0, 0, 0, 0] for mission_id in self.missions}
+        # Название, максимум и агрегаты миссии — одним поиском на строку разбивки
+        mission_info = {
+            mission_id: (mission['name'], mission['max_points'], mission_stats[mission_id])
+            for mission_id, mission in self.missions.items()
+        }
+        # Баллы повторяются, поэтому процент форматируется один раз на (максимум, балл)
+        percent_cache = {}
         
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Лист 1: Общая статистика
-            stats_data = []
-            for result in results:
-                # Обрабатываем как строку ISO, так и объект datetime
-                if hasattr(result.created_at, 'strftime'):
-                    date_str = result.created_at.strftime('%d.%m.%Y %H:%M')
-                else:
-                    # Если это строка ISO, преобразуем в datetime
-                    from datetime import datetime
-                    created_at = datetime.fromisoformat(result.created_at)
-                    date_str = created_at.strftime('%d.%m.%Y %H:%M')
-                
-                percentage = (result.total_score / result.max_possible_score * 100) if result.max_possible_score > 0 else 0
-                stats_data.append({
-                    'Дата': date_str,
-                    'Общий балл': result.total_score,
-                    'Максимальный балл': result.max_possible_score,
-                    'Процент выполнения': f"{percentage:.1f}%",
-                    'Название': result.name or f"Результат от {date_str}"
-                })
-            
-            stats_df = pd.DataFrame(stats_data)
-            stats_df.to_excel(writer, sheet_name='Общая статистика', index=False)
-            
-            # Добавляем расширенную сводку по результатам (лист 'Сводка')
-            if results:
-                summary_rows = []
-                for result in results:
-                    # Дата
-                    if hasattr(result.created_at, 'strftime'):
-                        date_str = result.created_at.strftime('%d.%m.%Y %H:%M')
-                    else:
-                        from datetime import datetime
-                        created_at = datetime.fromisoformat(result.created_at)
-                        date_str = created_at.strftime('%d.%m.%Y %H:%M')
-                    # Количество выполненных миссий
-                    done_missions = [
-                        self.missions.get(m_id, {}).get('name', m_id)
-                        for m_id, score in result.mission_scores.items() if score > 0
-                    ]
-                    num_done = len(done_missions)
-                    done_str = ', '.join(done_missions) if done_missions else '-'
-                    percentage = (result.total_score / result.max_possible_score * 100) if result.max_possible_score > 0 else 0
-                    summary_rows.append({
-                        'Дата': date_str,
-                        'Общий балл': result.total_score,
-                        'Выполнено миссий': num_done,
-                        'Список выполненных миссий': done_str,
-                        'Максимальный балл': result.max_possible_score,
-                        'Процент выполнения': f"{percentage:.1f}%"
-                    })
-                summary_df = pd.DataFrame(summary_rows)
-                summary_df.to_excel(writer, sheet_name='Сводка', index=False)
+        for result in results:
+            # Обрабатываем как строку ISO, так и объект datetime — один раз на результат
+            if hasattr(result.created_at, 'strftime'):
+                created_at = result.created_at
+            else:
+                created_at = datetime.fromisoformat(result.created_at)
+            date_str = created_at.strftime('%d.%m.%Y %H:%M')
+            percentage = (result.total_score / result.max_possible_score * 100) if result.max_possible_score > 0 else 0
             
-            # Лист 2: Детальная разбивка по миссиям
-            missions_data = []
-            for result in results:
-                # Обрабатываем как строку ISO, так и объект datetime
-                if hasattr(result.created_at, 'strftime'):
-                    date_str = result.created_at.strftime('%d.%m.%Y %H:%M')
+            done_missions = []
+            if result.mission_scores and not missions_header_written:
+                yield missions_sheet, ['Дата', 'Миссия', 'Балл', 'Максимум', 'Процент']
+                missions_header_written = True
+            for mission_id, score in result.mission_scores.items():
+                info = mission_info.get(mission_id)
+                if info is None:
+                    mission_name, max_points, stats = mission_id, 0, None
                 else:
-                    # Если это строка ISO, преобразуем в datetime
-                    from datetime import datetime
-                    created_at = datetime.fromisoformat(result.created_at)
-                    date_str = created_at.strftime('%d.%m.%Y %H:%M')
-                
-                for mission_id, score in result.mission_scores.items():
-                    mission_name = self.missions.get(mission_id, {}).get('name', mission_id)
-                    max_points = self.missions.get(mission_id, {}).get('max_points', 0)
-                    missions_data.append({
-                        'Дата': date_str,
-                        'Миссия': mission_name,
-                        'Балл': score,
-                        'Максимум': max_points,
-                        'Процент': f"{(score / max_points * 100):.1f}%" if max_points > 0 else "0%"
-                    })
-            
-            missions_df = pd.DataFrame(missions_data)
-            missions_df.to_excel(writer, sheet_name='Разбивка по миссиям', index=False)
-            
-            # Лист 3: Сводная таблица по миссиям
-            pivot_data = []
-            for mission_id, mission_data in self.missions.items():
-                mission_name = mission_data['name']
-                max_points = mission_data['max_points']
+                    mission_name, max_points, stats = info
+                if score > 0:
+                    done_missions.append(mission_name)
                 
-                # Собираем все баллы за эту миссию
-                mission_scores = []
-                for result in results:
-                    if mission_id in result.mission_scores:
-                        mission_scores.append(result.mission_scores[mission_id])
-                
-                if mission_scores:
-                    avg_score = sum(mission_scores) / len(mission_scores)
-                    max_score = max(mission_scores)
-                    min_score = min(mission_scores)
-                else:
-                    avg_score = max_score = min_score = 0
+                percent = percent_cache.get((max_points, score))
+                if percent is None:
+                    percent = percent_cache[(max_points, score)] = (
+                        f"{(score / max_points * 100):.1f}%" if max_points > 0 else "0%"
+                    )
+                yield missions_sheet, [date_str, mission_name, score, max_points, percent]
                 
-                pivot_data.append({
-                    'Миссия': mission_name,
-                    'Максимальный балл': max_points,
-                    'Средний балл': f"{avg_score:.1f}",
-                    'Максимальный достигнутый': max_score,
-                    'Минимальный достигнутый': min_score,
-                    'Количество попыток': len(mission_scores)
-                })
+                if stats is not None:
+                    if stats[3] == 0:
+                        stats[1] = stats[2] = score
+                    elif score > stats[1]:
+                        stats[1] = score
+                    elif score < stats[2]:
+                        stats[2] = score
+                    stats[0] += score
+                    stats[3] += 1
             
-            pivot_df = pd.DataFrame(pivot_data)
-            pivot_df.to_excel(writer, sheet_name='Сводка по миссиям', index=False)
+            yield stats_sheet, [
+                date_str, result.total_score, result.max_possible_score,
+                f"{percentage:.1f}%", result.name or f"Результат от {date_str}"
+            ]
+            yield summary_sheet, [
+                date_str, result.total_score, len(done_missions),
+                ', '.join(done_missions) if done_missions else '-',
+                result.max_possible_score, f"{percentage:.1f}%"
+            ]
         
+        yield pivot_sheet, ['Миссия', 'Максимальный балл', 'Средний балл', 'Максимальный достигнутый',
+                            'Минимальный достигнутый', 'Количество попыток']
+        for mission_id, mission_data in self.missions.items():
+            total, max_score, min_score, count = mission_stats[mission_id]
+            avg_score = total / count if count else 0
+            yield pivot_sheet, [mission_data['name'], mission_data['max_points'], f"{avg_score:.1f}",
+                                max_score, min_score, count]
+    
+    def generate_detailed_excel_report(self, results):
+        """Генерирует детальный отчёт в формате Excel"""
+        if not results:
+            return None
+        
+        # Создаём Excel файл в памяти
+        output = BytesIO()
+        self.write_detailed_excel_report_stream(results, output)
         output.seek(0)
         return output
 
+    def write_detailed_excel_report_stream(self, results, output):
+        """Потоково пишет детальный отчёт в файл (openpyxl write-only)
+
+        Строки из iter_detailed_report_rows пишутся сразу, без DataFrame и
+        объектной модели книги, поэтому пиковая память не зависит от
+        количества результатов. Возвращает False, если результатов нет.
+        """
+        results = iter(results)
+        first_result = next(results, None)
+        if first_result is None:
+            return False
+        
+        workbook = Workbook(write_only=True)
+        sheets = {name: workbook.create_sheet(name) for name in DETAILED_REPORT_SHEETS}
+        for sheet_name, row in self.iter_detailed_report_rows(chain([first_result], results)):
+            sheets[sheet_name].append(row)
+        
+        workbook.save(output)
+        return True
+
 # Создаем глобальный экземпляр калькулятора
 fll_calculator = FLLCalculator()
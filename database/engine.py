@@ -1,20 +1,106 @@
 import os
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from database.models import Base
 
-async_engine = create_async_engine('sqlite+aiosqlite:///mydatabase.db',
+DATABASE_FILE = 'mydatabase.db'
+
+async_engine = create_async_engine(f'sqlite+aiosqlite:///{DATABASE_FILE}',
                                    echo=False)  # echo=True для логирования SQL-запросов
 async_session_factory = async_sessionmaker(async_engine, expire_on_commit=False, class_=AsyncSession)
 
+# Профиль SQLite для каждого нового соединения. WAL позволяет читать во время записи,
+# synchronous=NORMAL в режиме WAL не теряет целостность, но не делает fsync на каждый commit.
+# Пустое значение переменной окружения отключает соответствующую настройку.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    # Отрицательное значение — размер кэша страниц в КиБ
+    "cache_size": os.getenv("SQLITE_CACHE_SIZE", "-65536"),
+    "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "busy_timeout": os.getenv("SQLITE_BUSY_TIMEOUT", "5000"),
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+    "foreign_keys": os.getenv("SQLITE_FOREIGN_KEYS", "ON"),
+}
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Применяет SQLITE_PRAGMAS к новому соединению."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            if value:
+                cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+_sync_engine = None
+
+
+def get_sync_engine():
+    """Синхронный движок для кода вне event loop (например, процессов пула отчётов)."""
+    global _sync_engine
+    if _sync_engine is None:
+        _sync_engine = create_engine(f'sqlite:///{DATABASE_FILE}')
+        event.listen(_sync_engine, "connect", _set_sqlite_pragmas)
+    return _sync_engine
+
+
+def _create_missing_indexes(connection):
+    """Создает индексы, добавленные в модели после создания таблиц."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                with connection.begin_nested():
+                    index.create(connection, checkfirst=True)
+            except OperationalError as e:
+                # Например, таблица создана старой версией схемы и колонки нет
+                print(f"Не удалось создать индекс {index.name}: {e.orig}")
+
+
+def _add_missing_columns(connection):
+    """Добавляет в существующие таблицы колонки, появившиеся в моделях позже."""
+    inspector = inspect(connection)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            default = getattr(column.server_default, 'arg', None)
+            # SQLite умеет добавлять только колонки с NULL или константой по умолчанию
+            if not isinstance(default, str) and not (default is None and column.nullable):
+                print(f"Колонку {table.name}.{column.name} нужно добавить вручную")
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+            if default is not None:
+                ddl += f" NOT NULL DEFAULT '{default}'"
+            connection.execute(text(ddl))
+
 
 async def proceed_schemas():
     """Создает таблицы в базе данных, если их нет."""
     print("async_main() was started")
-    print(f"Using DB file at: {os.path.abspath('mydatabase.db')}")
+    print(f"Using DB file at: {os.path.abspath(DATABASE_FILE)}")
     try:
         async with async_engine.begin() as conn:
             # Только создаем недостающие таблицы. НИЧЕГО не удаляем.
             await conn.run_sync(Base.metadata.create_all)
+            # create_all не трогает уже существующие таблицы — досоздаем новые колонки и индексы
+            await conn.run_sync(_add_missing_columns)
+            await conn.run_sync(_create_missing_indexes)
+        # Денормализованное расписание напоминаний заполняем по уже существующим доработкам
+        from database.requests import backfill_reminder_schedule
+        async with async_session_factory() as session:
+            filled = await backfill_reminder_schedule(session)
+        if filled:
+            print(f"Заполнено расписание напоминаний: {filled} пользователей")
         print("База данных готова. Недостающие таблицы созданы (если были).")
     except Exception as e:
         print(f"Произошла ошибка: {e}")
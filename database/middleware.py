@@ -1,13 +1,66 @@
-from typing import Callable, Dict, Any, Awaitable, Union
+from dataclasses import dataclass
+from typing import Callable, Dict, Any, Awaitable, Optional, Union
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
+from sqlalchemy import event as sa_event
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+
+@dataclass
+class SessionStats:
+    """Сколько обновлений прошло через middleware, сколько из них создали сессию и сколько реально ходили в БД"""
+    requested: int = 0
+    opened: int = 0
+    used: int = 0
+
+
+session_stats = SessionStats()
+
+
+@sa_event.listens_for(Session, "after_begin")
+def _mark_connection_used(session, transaction, connection):
+    # Соединение берется из пула только при первой транзакции сессии
+    session.info["connection_used"] = True
+
+
+class LazySession:
+    """Заместитель AsyncSession: настоящая сессия создается при первом обращении к ней
+
+    Обработчики получают его вместо сессии и работают с ним так же
+    (execute, add, commit, begin и т.д.), а обновления, которым БД не нужна,
+    не создают сессию вовсе.
+    """
+
+    __slots__ = ("_session_pool", "_session", "_stats")
+
+    def __init__(self, session_pool: async_sessionmaker, stats: SessionStats):
+        self._session_pool = session_pool
+        self._session: Optional[AsyncSession] = None
+        self._stats = stats
+
+    def _get_session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._session_pool()
+            self._stats.opened += 1
+        return self._session
+
+    def __getattr__(self, name: str):
+        return getattr(self._get_session(), name)
+
+    async def close(self):
+        if self._session is None:
+            return
+        if self._session.sync_session.info.get("connection_used"):
+            self._stats.used += 1
+        await self._session.close()
 
 
 class DbSessionMiddleware(BaseMiddleware):
-    def __init__(self, session_pool: async_sessionmaker):
+    def __init__(self, session_pool: async_sessionmaker, stats: SessionStats = session_stats):
         super().__init__()
         self.session_pool = session_pool
+        self.stats = stats
 
     async def __call__(
             self,
@@ -15,6 +68,10 @@ class DbSessionMiddleware(BaseMiddleware):
             event: Union[Message, CallbackQuery],  # Event может быть Message или CallbackQuery
             data: Dict[str, Any],
     ) -> Any:
-        async with self.session_pool() as session:
-            data["session"] = session  # Добавляем сессию в данные, доступные хэндлеру
+        self.stats.requested += 1
+        session = LazySession(self.session_pool, self.stats)
+        data["session"] = session  # Добавляем сессию в данные, доступные хэндлеру
+        try:
             return await handler(event, data)
+        finally:
+            await session.close()
@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import Optional, List
 
-from sqlalchemy import BigInteger, String, ForeignKey, Integer, JSON, Boolean, DateTime, func
+from sqlalchemy import BigInteger, String, ForeignKey, Integer, JSON, Boolean, DateTime, Index, UniqueConstraint, func
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.ext.asyncio import AsyncAttrs
 """
@@ -22,6 +22,14 @@ class User(Base, AsyncAttrs):
     team_id: Mapped[Optional[int]] = mapped_column(ForeignKey('teams.id'), nullable=True)
     last_photo_reminder: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
 
+    # Доставляемость: когда пользователь заблокировал бота и сколько отправок подряд не удалось
+    blocked_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    consecutive_failures: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+
+    # Денормализация для напоминаний: есть ли доработки и когда следующее напоминание
+    has_improvements: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
+    next_reminder_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True, index=True)
+
     team: Mapped['UserTeams'] = relationship(back_populates='users')
 
     def __repr__(self):
@@ -88,6 +96,11 @@ class FLLResult(Base, AsyncAttrs):
     # Метаданные
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     name: Mapped[Optional[str]] = mapped_column(String(100), nullable=True)  # Название результата
+
+    # Отчёты за период — это диапазон по created_at внутри одного пользователя
+    __table_args__ = (
+        Index('ix_fll_results_user_tg_id_created_at', 'user_tg_id', 'created_at'),
+    )
     
     def __repr__(self):
         return f"<FLLResult(id={self.id}, user_tg_id={self.user_tg_id}, total_score={self.total_score})>"
@@ -143,4 +156,45 @@ class SubmittedRecord(Base, AsyncAttrs):
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
     def __repr__(self):
-        return f"<SubmittedRecord(record_id='{self.record_id}', user_tg_id={self.user_tg_id}, status='{self.status}')>"
\ No newline at end of file
+        return f"<SubmittedRecord(record_id='{self.record_id}', user_tg_id={self.user_tg_id}, status='{self.status}')>"
+
+class BroadcastJob(Base, AsyncAttrs):
+    __tablename__ = 'broadcast_jobs'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    text: Mapped[str] = mapped_column(String(4096))
+    parse_mode: Mapped[Optional[str]] = mapped_column(String(20), nullable=True)
+
+    # pending / running / paused / cancelled / done
+    status: Mapped[str] = mapped_column(String(20), default="pending", index=True)
+
+    # Сообщение админа, в котором показывается прогресс
+    admin_chat_id: Mapped[int] = mapped_column(BigInteger)
+    progress_message_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<BroadcastJob(id={self.id}, status='{self.status}')>"
+
+
+class BroadcastRecipient(Base, AsyncAttrs):
+    __tablename__ = 'broadcast_recipients'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    job_id: Mapped[int] = mapped_column(ForeignKey('broadcast_jobs.id', ondelete='CASCADE'))
+    user_tg_id: Mapped[int] = mapped_column(BigInteger)
+
+    # pending / sending / sent / blocked / failed
+    status: Mapped[str] = mapped_column(String(20), default="pending")
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    # Один получатель на рассылку; воркер выбирает очередную пачку по (job_id, status)
+    __table_args__ = (
+        UniqueConstraint('job_id', 'user_tg_id', name='uq_broadcast_recipients_job_user'),
+        Index('ix_broadcast_recipients_job_id_status', 'job_id', 'status'),
+    )
+
+    def __repr__(self):
+        return f"<BroadcastRecipient(job_id={self.job_id}, user_tg_id={self.user_tg_id}, status='{self.status}')>"
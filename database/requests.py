@@ -1,8 +1,12 @@
-from typing import List
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert, update, func, literal, and_, case, bindparam
 
-from database.models import Patent, User, UserTeams, FLLResult  # Убедитесь, что User импортирован!
+from database.models import Patent, User, UserTeams, FLLResult, Improvement, BroadcastJob, BroadcastRecipient  # Убедитесь, что User импортирован!
 
 
 # from db.engine import async_session_factory # Эта строка нужна, только если функция НЕ получает session как аргумент
@@ -57,6 +61,39 @@ async def add_patent_to_db(
     session.add(new_patent)
 
 
+# Кэш tg_id -> team_id: регистрация проверяется почти в каждом обработчике рекордов,
+# а меняется только в обработчиках регистрации, которые сбрасывают запись
+USER_TEAM_CACHE_TTL = float(os.getenv("USER_TEAM_CACHE_TTL", 300))
+USER_TEAM_CACHE_SIZE = 10000
+_user_team_cache: "OrderedDict[int, Tuple[float, Optional[int]]]" = OrderedDict()
+
+
+async def get_user_team_id(user_tg_id: int, session: AsyncSession) -> Optional[int]:
+    """Возвращает team_id пользователя (None — не зарегистрирован), найденную команду кэширует"""
+    now = time.monotonic()
+    cached = _user_team_cache.get(user_tg_id)
+    if cached is not None and cached[0] > now:
+        _user_team_cache.move_to_end(user_tg_id)
+        return cached[1]
+
+    team_id = await session.scalar(select(User.team_id).where(User.tg_id == user_tg_id))
+    if team_id is None:
+        # «Не зарегистрирован» не кэшируем: сбросить кэш после регистрации можно
+        # только в своем процессе, а в остальных воркерах пользователь был бы заблокирован
+        _user_team_cache.pop(user_tg_id, None)
+        return None
+    _user_team_cache[user_tg_id] = (now + USER_TEAM_CACHE_TTL, team_id)
+    _user_team_cache.move_to_end(user_tg_id)
+    while len(_user_team_cache) > USER_TEAM_CACHE_SIZE:
+        _user_team_cache.popitem(last=False)
+    return team_id
+
+
+def invalidate_user_team_cache(user_tg_id: int) -> None:
+    """Сбрасывает кэш team_id пользователя (после регистрации или смены команды)"""
+    _user_team_cache.pop(user_tg_id, None)
+
+
 # Функции для работы с результатами FLL калькулятора
 async def save_fll_result(
         user_tg_id: int,
@@ -84,6 +121,8 @@ async def save_fll_result(
         mission_scores=mission_scores,
         total_score=total_score,
         max_possible_score=max_possible_score,
+        # Локальное время, как и в фильтрах отчётов по периоду
+        created_at=datetime.now(),
         name=name
     )
     
@@ -109,15 +148,92 @@ async def get_user_fll_results(
     return results_query.scalars().all()
 
 
+async def get_user_fll_results_by_period(
+        user_tg_id: int,
+        start_date: Optional[datetime] = None,
+        session: AsyncSession = None
+) -> List[FLLResult]:
+    """Получает результаты пользователя начиная с start_date (новые сначала)"""
+
+    # Запрос покрывается индексом (user_tg_id, created_at)
+    query = select(FLLResult).where(FLLResult.user_tg_id == user_tg_id)
+    if start_date is not None:
+        query = query.where(FLLResult.created_at >= start_date)
+
+    results_query = await session.execute(query.order_by(FLLResult.created_at.desc()))
+
+    return results_query.scalars().all()
+
+
+def _fll_results_period_filter(user_tg_id: int, start_date: Optional[datetime]):
+    conditions = [FLLResult.user_tg_id == user_tg_id]
+    if start_date is not None:
+        conditions.append(FLLResult.created_at >= start_date)
+    return and_(*conditions)
+
+
+async def get_user_fll_results_period_stats(
+        user_tg_id: int,
+        start_date: Optional[datetime] = None,
+        session: AsyncSession = None
+) -> Tuple[int, Optional[int]]:
+    """Количество результатов пользователя за период и id самого нового из них"""
+
+    stats_query = await session.execute(
+        select(func.count(FLLResult.id), func.max(FLLResult.id))
+        .where(_fll_results_period_filter(user_tg_id, start_date))
+    )
+    count, newest_id = stats_query.one()
+    return count, newest_id
+
+
+def iter_user_fll_results_by_period(
+        user_tg_id: int,
+        start_date: Optional[datetime],
+        connection,
+        batch_size: int = 500
+):
+    """Потоково отдает результаты пользователя за период (новые сначала) через синхронное соединение
+
+    Строки читаются из курсора пачками по batch_size, весь период в памяти не держится.
+    """
+
+    query = (
+        select(
+            FLLResult.id, FLLResult.mission_scores, FLLResult.total_score,
+            FLLResult.max_possible_score, FLLResult.created_at, FLLResult.name
+        )
+        .where(_fll_results_period_filter(user_tg_id, start_date))
+        .order_by(FLLResult.created_at.desc())
+    )
+    yield from connection.execution_options(yield_per=batch_size).execute(query)
+
+
+async def bulk_insert_fll_results(
+        rows: List[dict],
+        session: AsyncSession,
+        batch_size: int = 500
+) -> int:
+    """Вставляет результаты пачками (executemany) и возвращает их количество"""
+
+    for start in range(0, len(rows), batch_size):
+        await session.execute(insert(FLLResult), rows[start:start + batch_size])
+    await session.commit()
+
+    return len(rows)
+
+
 async def get_fll_result_by_id(
         result_id: int,
-        session: AsyncSession = None
+        session: AsyncSession = None,
+        user_tg_id: Optional[int] = None
 ) -> FLLResult:
-    """Получает конкретный результат по ID"""
+    """Получает конкретный результат по ID (при указании user_tg_id — только свой)"""
     
-    result_query = await session.execute(
-        select(FLLResult).where(FLLResult.id == result_id)
-    )
+    query = select(FLLResult).where(FLLResult.id == result_id)
+    if user_tg_id is not None:
+        query = query.where(FLLResult.user_tg_id == user_tg_id)
+    result_query = await session.execute(query)
     
     return result_query.scalar_one_or_none()
 
@@ -232,4 +348,300 @@ async def get_user_submitted_records(user_tg_id: int, session: AsyncSession) ->
         .order_by(SubmittedRecord.created_at.desc())
     )
     
-    return query.scalars().all()
\ No newline at end of file
+    return query.scalars().all()
+
+# Напоминания о фото
+# Интервал между напоминаниями
+REMINDER_INTERVAL = timedelta(weeks=2)
+
+
+def _next_reminder_at(last_reminder: Optional[datetime], first_improvement: Optional[datetime]) -> Optional[datetime]:
+    """Через 2 недели после последнего напоминания/фото, а если их не было — после первой доработки"""
+    if first_improvement is None:
+        return None
+    return (last_reminder or first_improvement) + REMINDER_INTERVAL
+
+
+async def refresh_reminder_schedule(user_tg_id: int, session: AsyncSession) -> Optional[datetime]:
+    """Пересчитывает has_improvements и next_reminder_at после добавления/удаления доработки"""
+    query = await session.execute(
+        select(User.last_photo_reminder, func.min(Improvement.created_at))
+        .outerjoin(Improvement, Improvement.user_tg_id == User.tg_id)
+        .where(User.tg_id == user_tg_id)
+        .group_by(User.id)
+    )
+    row = query.one_or_none()
+    if row is None:
+        return None
+
+    last_reminder, first_improvement = row
+    next_at = _next_reminder_at(last_reminder, first_improvement)
+    await session.execute(
+        update(User)
+        .where(User.tg_id == user_tg_id)
+        .values(has_improvements=first_improvement is not None, next_reminder_at=next_at)
+    )
+    await session.commit()
+    return next_at
+
+
+async def mark_photo_received(user_tg_id: int, received_at: datetime, session: AsyncSession) -> Optional[datetime]:
+    """Сдвигает напоминание после присланного фото и возвращает новое next_reminder_at"""
+    query = await session.execute(
+        update(User)
+        .where(User.tg_id == user_tg_id)
+        .values(
+            last_photo_reminder=received_at,
+            next_reminder_at=case((User.has_improvements, received_at + REMINDER_INTERVAL), else_=None)
+        )
+        .returning(User.next_reminder_at)
+    )
+    next_at = query.scalar_one_or_none()
+    await session.commit()
+    return next_at
+
+
+async def mark_photos_received(received: Dict[int, datetime], session: AsyncSession,
+                               chunk_size: int = 500) -> List[Tuple[int, Optional[datetime]]]:
+    """Записывает накопленные фото пачкой (одна транзакция) и возвращает новые next_reminder_at"""
+    users = User.__table__
+    rows = [
+        {'b_tg_id': user_tg_id, 'b_received_at': received_at, 'b_next_at': received_at + REMINDER_INTERVAL}
+        for user_tg_id, received_at in received.items()
+    ]
+    await session.execute(
+        update(users)
+        .where(users.c.tg_id == bindparam('b_tg_id'))
+        .values(
+            last_photo_reminder=bindparam('b_received_at'),
+            next_reminder_at=case((users.c.has_improvements, bindparam('b_next_at')), else_=None)
+        ),
+        rows
+    )
+    await session.commit()
+
+    user_ids = list(received)
+    next_times = []
+    for start in range(0, len(user_ids), chunk_size):
+        query = await session.execute(
+            select(User.tg_id, User.next_reminder_at).where(User.tg_id.in_(user_ids[start:start + chunk_size]))
+        )
+        next_times.extend(query.all())
+    return next_times
+
+
+async def mark_reminders_sent(user_tg_ids: List[int], sent_at: datetime, session: AsyncSession,
+                              chunk_size: int = 500) -> None:
+    """Отмечает доставленные напоминания пачками (UPDATE ... WHERE tg_id IN (...))"""
+    for start in range(0, len(user_tg_ids), chunk_size):
+        await session.execute(
+            update(User)
+            .where(User.tg_id.in_(user_tg_ids[start:start + chunk_size]))
+            .values(
+                last_photo_reminder=sent_at,
+                next_reminder_at=case((User.has_improvements, sent_at + REMINDER_INTERVAL), else_=None)
+            )
+        )
+
+
+async def backfill_reminder_schedule(session: AsyncSession, batch_size: int = 500) -> int:
+    """Заполняет has_improvements и next_reminder_at у пользователей с доработками, где они не заполнены"""
+    query = await session.execute(
+        select(User.tg_id, User.last_photo_reminder, func.min(Improvement.created_at))
+        .join(Improvement, Improvement.user_tg_id == User.tg_id)
+        .where(User.has_improvements.is_(False))
+        .group_by(User.id)
+    )
+    rows = [
+        {'b_tg_id': user_tg_id, 'has_improvements': True,
+         'next_reminder_at': _next_reminder_at(last_reminder, first_improvement)}
+        for user_tg_id, last_reminder, first_improvement in query.all()
+    ]
+    statement = update(User.__table__).where(User.__table__.c.tg_id == bindparam('b_tg_id'))
+    for start in range(0, len(rows), batch_size):
+        await session.execute(statement, rows[start:start + batch_size])
+    await session.commit()
+    return len(rows)
+
+
+# Доставляемость сообщений
+# Сколько неудачных отправок подряд допускаем, прежде чем перестать писать пользователю
+MAX_DELIVERY_FAILURES = int(os.getenv("MAX_DELIVERY_FAILURES", 5))
+
+
+def reachable_user_condition():
+    """Условие для пользователей, которым имеет смысл отправлять сообщения"""
+    return and_(User.blocked_at.is_(None), User.consecutive_failures < MAX_DELIVERY_FAILURES)
+
+
+async def record_delivery_results(statuses: Dict[int, str], session: AsyncSession, chunk_size: int = 500) -> None:
+    """Обновляет доставляемость пользователей по итогам отправки (sent / blocked / failed)"""
+    by_status: Dict[str, List[int]] = {}
+    for user_tg_id, status in statuses.items():
+        by_status.setdefault(status, []).append(user_tg_id)
+
+    now = datetime.now()
+    for status, user_ids in by_status.items():
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            if status == "sent":
+                # Пишем только тем, у кого были ошибки, — обычно это пустой UPDATE
+                await session.execute(
+                    update(User)
+                    .where(User.tg_id.in_(chunk), User.consecutive_failures > 0)
+                    .values(consecutive_failures=0)
+                )
+            elif status == "blocked":
+                await session.execute(
+                    update(User).where(User.tg_id.in_(chunk)).values(blocked_at=now)
+                )
+            elif status == "failed":
+                await session.execute(
+                    update(User)
+                    .where(User.tg_id.in_(chunk))
+                    .values(consecutive_failures=User.consecutive_failures + 1)
+                )
+    await session.commit()
+
+
+async def mark_user_reachable(user_tg_id: int, session: AsyncSession) -> None:
+    """Снова включает пользователя в рассылки (например, после повторного /start)"""
+    await session.execute(
+        update(User)
+        .where(User.tg_id == user_tg_id, (User.blocked_at.isnot(None)) | (User.consecutive_failures > 0))
+        .values(blocked_at=None, consecutive_failures=0)
+    )
+    await session.commit()
+
+
+async def count_unreachable_users(session: AsyncSession) -> Dict[str, int]:
+    """Количество пропускаемых при рассылке пользователей: заблокировали бота / много ошибок подряд"""
+    query = await session.execute(
+        select(
+            func.count(User.blocked_at),
+            func.count().filter(
+                and_(User.blocked_at.is_(None), User.consecutive_failures >= MAX_DELIVERY_FAILURES)
+            )
+        )
+    )
+    blocked, failing = query.one()
+    return {'blocked': blocked, 'failing': failing}
+
+
+# Функции для работы с рассылками
+async def create_broadcast_job(
+        text: str,
+        parse_mode: Optional[str],
+        admin_chat_id: int,
+        progress_message_id: Optional[int],
+        session: AsyncSession
+) -> Tuple[BroadcastJob, int]:
+    """Создает рассылку и список получателей (все доступные пользователи) и возвращает её вместе с числом получателей"""
+
+    job = BroadcastJob(
+        text=text,
+        parse_mode=parse_mode,
+        status="running",
+        admin_chat_id=admin_chat_id,
+        progress_message_id=progress_message_id,
+        created_at=datetime.now()
+    )
+    session.add(job)
+    await session.flush()
+
+    # Получатели фиксируются в момент создания одним INSERT ... SELECT
+    result = await session.execute(
+        insert(BroadcastRecipient).from_select(
+            ['job_id', 'user_tg_id', 'status'],
+            select(literal(job.id), User.tg_id, literal("pending")).where(reachable_user_condition())
+        )
+    )
+    await session.commit()
+
+    return job, result.rowcount
+
+
+async def get_broadcast_job(job_id: int, session: AsyncSession) -> Optional[BroadcastJob]:
+    """Получает рассылку по ID"""
+    return await session.get(BroadcastJob, job_id)
+
+
+async def get_recent_broadcast_jobs(session: AsyncSession, limit: int = 5) -> List[BroadcastJob]:
+    """Получает последние рассылки"""
+    query = await session.execute(
+        select(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(limit)
+    )
+    return query.scalars().all()
+
+
+async def set_broadcast_job_status(job_id: int, status: str, session: AsyncSession) -> None:
+    """Меняет статус рассылки"""
+    values = {'status': status}
+    if status in ("done", "cancelled"):
+        values['finished_at'] = datetime.now()
+    await session.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(**values))
+    await session.commit()
+
+
+async def claim_broadcast_recipients(job_id: int, limit: int, session: AsyncSession) -> List[int]:
+    """Забирает очередную пачку получателей: переводит их в статус sending до отправки
+
+    Выборка и смена статуса — один UPDATE, поэтому воркеры в разных
+    процессах не заберут одних и тех же получателей.
+    """
+    batch = (
+        select(BroadcastRecipient.id)
+        .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == "pending")
+        .order_by(BroadcastRecipient.id)
+        .limit(limit)
+    )
+    result = await session.execute(
+        update(BroadcastRecipient)
+        .where(BroadcastRecipient.id.in_(batch), BroadcastRecipient.status == "pending")
+        .values(status="sending", updated_at=datetime.now())
+        .returning(BroadcastRecipient.user_tg_id)
+    )
+    user_ids = list(result.scalars().all())
+    await session.commit()
+    return user_ids
+
+
+async def save_broadcast_results(job_id: int, statuses: Dict[int, str], session: AsyncSession) -> None:
+    """Сохраняет итоги отправки пачки (по одному UPDATE на статус)"""
+    by_status: Dict[str, List[int]] = {}
+    for user_tg_id, status in statuses.items():
+        by_status.setdefault(status, []).append(user_tg_id)
+
+    now = datetime.now()
+    for status, user_ids in by_status.items():
+        await session.execute(
+            update(BroadcastRecipient)
+            .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.user_tg_id.in_(user_ids))
+            .values(status=status, updated_at=now)
+        )
+    await session.commit()
+
+
+async def release_unconfirmed_recipients(job_id: int, session: AsyncSession) -> int:
+    """Помечает получателей, зависших в sending после падения, как unknown
+
+    Доставка им не подтверждена, но могла произойти, поэтому повторно им
+    не отправляем — лучше пропустить сообщение, чем прислать его дважды.
+    """
+    result = await session.execute(
+        update(BroadcastRecipient)
+        .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == "sending")
+        .values(status="unknown", updated_at=datetime.now())
+    )
+    await session.commit()
+    return result.rowcount
+
+
+async def get_broadcast_job_counts(job_id: int, session: AsyncSession) -> Dict[str, int]:
+    """Количество получателей рассылки по статусам"""
+    query = await session.execute(
+        select(BroadcastRecipient.status, func.count())
+        .where(BroadcastRecipient.job_id == job_id)
+        .group_by(BroadcastRecipient.status)
+    )
+    return dict(query.all())
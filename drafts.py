@@ -0,0 +1,124 @@
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List
+
+from aiogram.fsm.context import FSMContext
+
+from fsm_storage import modify_fsm_data
+
+
+class DraftTooLarge(Exception):
+    """Черновик превысил допустимый размер"""
+
+
+@dataclass
+class DraftMetrics:
+    """Счетчики одного хранилища черновиков"""
+    loads: int = 0
+    saves: int = 0
+    clears: int = 0
+    expired: int = 0
+    rejected: int = 0
+    max_bytes_seen: int = 0
+
+
+class DraftStore:
+    """Черновик многошагового сценария внутри данных FSM пользователя
+
+    Черновик лежит в данных FSM под ключом draft:<name>, поэтому хранится
+    там же, где состояние (SQLite/Redis), виден всем процессам бота и
+    удаляется вместе с state.clear(). Срок жизни ttl отсчитывается от
+    последней записи; просроченный черновик читается как пустой. Размер
+    черновика в JSON ограничен max_bytes. modify и update меняют черновик
+    атомарно в самом хранилище, поэтому части альбома, пришедшие в разные
+    воркеры, не затирают друг друга.
+    """
+
+    def __init__(self, name: str, ttl: float = 24 * 3600, max_bytes: int = 32 * 1024):
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.metrics = DraftMetrics()
+        self._field = f"draft:{name}"
+        _draft_stores.append(self)
+
+    async def get(self, state: FSMContext) -> Dict[str, Any]:
+        """Возвращает копию черновика (пустой словарь, если его нет или он просрочен)"""
+        self.metrics.loads += 1
+        item = await state.get_value(self._field)
+        if not item:
+            return {}
+        if item["expires_at"] <= time.time():
+            self.metrics.expired += 1
+            await self._drop(state)
+            return {}
+        return item["data"]
+
+    async def set(self, state: FSMContext, data: Dict[str, Any]):
+        """Полностью заменяет черновик"""
+        await state.update_data({self._field: self._wrap(data)})
+
+    def _wrap(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        size = len(json.dumps(data, ensure_ascii=False).encode())
+        if size > self.max_bytes:
+            self.metrics.rejected += 1
+            raise DraftTooLarge(f"Черновик {self.name} занимает {size} байт (максимум {self.max_bytes})")
+        self.metrics.saves += 1
+        self.metrics.max_bytes_seen = max(self.metrics.max_bytes_seen, size)
+        return {"expires_at": time.time() + self.ttl, "data": data}
+
+    async def update(self, state: FSMContext, **values) -> Dict[str, Any]:
+        """Дополняет черновик значениями (как dict.update)"""
+        return await self.modify(state, lambda draft: draft.update(values))
+
+    async def modify(self, state: FSMContext, change: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:
+        """Атомарно изменяет черновик: change правит переданный словарь на месте
+
+        Чтение и запись выполняются одной транзакцией хранилища FSM, поэтому
+        change должен быть синхронным (при конфликте в Redis он вызывается
+        повторно). Пустой после изменения черновик удаляется. Возвращает
+        новое содержимое черновика.
+        """
+        draft: Dict[str, Any] = {}
+
+        def apply(data: Dict[str, Any]) -> Dict[str, Any]:
+            nonlocal draft
+            item = data.pop(self._field, None)
+            draft = item["data"] if item and item["expires_at"] > time.time() else {}
+            change(draft)
+            if draft:
+                data[self._field] = self._wrap(draft)
+            return data
+
+        self.metrics.loads += 1
+        await modify_fsm_data(state.storage, state.key, apply)
+        return draft
+
+    async def clear(self, state: FSMContext):
+        """Удаляет черновик"""
+        self.metrics.clears += 1
+        await self._drop(state)
+
+    async def _drop(self, state: FSMContext):
+        data = await state.get_data()
+        if data.pop(self._field, None) is not None:
+            await state.set_data(data)
+
+
+_draft_stores: List[DraftStore] = []
+
+
+def get_draft_metrics() -> Dict[str, Dict[str, int]]:
+    """Счетчики всех хранилищ черновиков по именам"""
+    return {store.name: asdict(store.metrics) for store in _draft_stores}
+
+
+DRAFT_TTL = float(os.getenv("DRAFT_TTL", 24 * 3600))
+DRAFT_MAX_BYTES = int(os.getenv("DRAFT_MAX_BYTES", 32 * 1024))
+
+record_drafts = DraftStore("record", ttl=DRAFT_TTL, max_bytes=DRAFT_MAX_BYTES)
+improvement_drafts = DraftStore("improvement", ttl=DRAFT_TTL, max_bytes=DRAFT_MAX_BYTES)
+# Альбом собирается за доли секунды, дольше его держать незачем
+album_drafts = DraftStore("album", ttl=60, max_bytes=DRAFT_MAX_BYTES)
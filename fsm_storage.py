@@ -0,0 +1,218 @@
+import asyncio
+import copy
+import json
+import os
+import time
+from typing import Any, Callable, Dict, Mapping, Optional
+
+import aiosqlite
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в файле SQLite (WAL) — переживает перезапуск и общее для процессов на одной машине
+
+    Состояние и данные пользователя хранятся одной строкой. Каждая запись
+    продлевает срок жизни на ttl секунд; просроченные строки не читаются и
+    периодически удаляются, так что брошенные на полпути сценарии не копятся.
+    modify_data меняет данные атомарно, в том числе между процессами.
+    """
+
+    def __init__(self, path: str = "fsm_states.db", ttl: Optional[float] = 24 * 3600,
+                 key_builder: Optional[KeyBuilder] = None, purge_interval: float = 600):
+        self.path = path
+        self.ttl = ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.purge_interval = purge_interval
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        # Соединение одно на процесс: пока идет транзакция modify_data,
+        # чужая запись через него попала бы в эту транзакцию
+        self._write_lock = asyncio.Lock()
+        self._last_purge = 0.0
+
+    async def _get_conn(self) -> aiosqlite.Connection:
+        # Соединение открываем лениво — конструктор вызывается вне event loop.
+        # Первые запросы приходят одновременно, поэтому открытие под блокировкой
+        if self._conn is None:
+            async with self._connect_lock:
+                if self._conn is None:
+                    conn = await aiosqlite.connect(self.path, isolation_level=None)
+                    await conn.execute("PRAGMA journal_mode=WAL")
+                    await conn.execute("PRAGMA synchronous=NORMAL")
+                    await conn.execute("PRAGMA busy_timeout=5000")
+                    await conn.execute(
+                        "CREATE TABLE IF NOT EXISTS fsm_states ("
+                        "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}', expires_at REAL)"
+                    )
+                    await conn.execute("CREATE INDEX IF NOT EXISTS ix_fsm_states_expires_at ON fsm_states (expires_at)")
+                    self._conn = conn
+                    await self.purge_expired()
+        return self._conn
+
+    def _expires_at(self, now: float) -> Optional[float]:
+        return now + self.ttl if self.ttl else None
+
+    async def _read(self, key: StorageKey) -> Optional[tuple]:
+        conn = await self._get_conn()
+        async with conn.execute(
+            "SELECT state, data FROM fsm_states WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (self.key_builder.build(key), time.time())
+        ) as cursor:
+            return await cursor.fetchone()
+
+    async def _write(self, key: StorageKey, column: str, value: Optional[str]):
+        conn = await self._get_conn()
+        async with self._write_lock:
+            await self._upsert(conn, self.key_builder.build(key), column, value, time.time())
+            if time.time() - self._last_purge >= self.purge_interval:
+                await self.purge_expired()
+
+    async def _upsert(self, conn: aiosqlite.Connection, storage_key: str, column: str,
+                      value: Optional[str], now: float):
+        # Просроченная строка не должна «воскресить» старое состояние или данные
+        await conn.execute(
+            "DELETE FROM fsm_states WHERE key = ? AND expires_at IS NOT NULL AND expires_at <= ?",
+            (storage_key, now)
+        )
+        await conn.execute(
+            f"INSERT INTO fsm_states (key, {column}, expires_at) VALUES (?, ?, ?) "
+            f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, expires_at = excluded.expires_at",
+            (storage_key, value, self._expires_at(now))
+        )
+        # Пустую запись (нет ни состояния, ни данных) не храним
+        await conn.execute(
+            "DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data = '{}'",
+            (storage_key,)
+        )
+
+    async def modify_data(self, key: StorageKey,
+                          modify: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+        """Читает данные, передает их в modify и записывает результат одной транзакцией
+
+        BEGIN IMMEDIATE берет блокировку записи сразу, поэтому одновременные
+        изменения из разных процессов выполняются по очереди и не затирают друг друга.
+        """
+        conn = await self._get_conn()
+        storage_key = self.key_builder.build(key)
+        async with self._write_lock:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                async with conn.execute(
+                    "SELECT data FROM fsm_states WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                    (storage_key, now)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                data = modify(json.loads(row[0]) if row else {})
+                if not isinstance(data, dict):
+                    raise TypeError(f"Data must be a dict, not {type(data).__name__}")
+                await self._upsert(conn, storage_key, "data", json.dumps(data, ensure_ascii=False), now)
+                await conn.execute("COMMIT")
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+        return data
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._write(key, "state", value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._read(key)
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise TypeError(f"Data must be a dict, not {type(data).__name__}")
+        await self._write(key, "data", json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._read(key)
+        return json.loads(row[1]) if row else {}
+
+    async def purge_expired(self) -> int:
+        """Удаляет просроченные состояния, возвращает их количество"""
+        conn = await self._get_conn()
+        now = time.time()
+        self._last_purge = now
+        cursor = await conn.execute(
+            "DELETE FROM fsm_states WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,)
+        )
+        return cursor.rowcount
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+async def modify_fsm_data(storage: BaseStorage, key: StorageKey,
+                          modify: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    """Атомарно изменяет данные FSM: modify получает текущие данные и возвращает новые
+
+    modify может вызываться повторно (при конфликте в Redis), поэтому должен
+    быть синхронным и без побочных эффектов, кроме изменения данных.
+    """
+    if isinstance(storage, SQLiteStorage):
+        return await storage.modify_data(key, modify)
+    redis = getattr(storage, "redis", None)
+    if redis is not None:
+        return await _modify_redis_data(storage, key, modify)
+    # MemoryStorage не переключает задачи между чтением и записью; get_data отдает
+    # поверхностную копию, а вложенные словари modify менять не должен до записи
+    data = modify(copy.deepcopy(await storage.get_data(key)))
+    await storage.set_data(key, data)
+    return data
+
+
+async def _modify_redis_data(storage: BaseStorage, key: StorageKey,
+                             modify: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    # Оптимистичная блокировка: если ключ изменили между WATCH и EXEC, повторяем
+    from redis.exceptions import WatchError
+
+    redis_key = storage.key_builder.build(key, "data")
+    async with storage.redis.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(redis_key)
+                value = await pipe.get(redis_key)
+                if isinstance(value, bytes):
+                    value = value.decode("utf-8")
+                data = modify(storage.json_loads(value) if value is not None else {})
+                pipe.multi()
+                if data:
+                    pipe.set(redis_key, storage.json_dumps(data), ex=storage.data_ttl)
+                else:
+                    pipe.delete(redis_key)
+                await pipe.execute()
+                return data
+            except WatchError:
+                continue
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Создает FSM-хранилище по переменным окружения FSM_STORAGE_*"""
+    backend = os.getenv("FSM_STORAGE_BACKEND", "sqlite")
+    # 0 — хранить состояния бессрочно
+    ttl = float(os.getenv("FSM_STATE_TTL", 24 * 3600)) or None
+
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        return SQLiteStorage(path=os.getenv("FSM_SQLITE_PATH", "fsm_states.db"), ttl=ttl)
+    if backend == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise ImportError("Для FSM_STORAGE_BACKEND=redis установите пакет redis") from e
+        ttl = int(ttl) if ttl else None
+        return RedisStorage.from_url(
+            os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+            state_ttl=ttl,
+            data_ttl=ttl,
+        )
+    raise ValueError(f"Неизвестный FSM_STORAGE_BACKEND: {backend}")
@@ -4,13 +4,20 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.models import User, UserTeams
+from database.models import UserTeams
 from calculator import fll_calculator
-from sqlalchemy import select, update
+from sqlalchemy import select
 from datetime import datetime
-from database.models import FLLResult, User
+from database.models import FLLResult
 from aiogram import types
-from local_storage import local_storage
+from aiogram.exceptions import TelegramBadRequest
+from collections import OrderedDict
+from scheduler import photo_batcher
+from reports import report_cache, report_executor, ReportQueueFull, ReportAlreadyRunning
+from database.requests import (
+    save_fll_result, get_user_fll_results, get_user_fll_results_by_period,
+    get_fll_result_by_id, delete_fll_result, mark_photo_received, get_user_fll_results_period_stats
+)
 
 
 
@@ -20,17 +27,49 @@ class Register(StatesGroup):
 
 router = Router()
 
+# Последнее отрисованное состояние сообщений калькулятора:
+# (chat_id, message_id) -> (text, markup, текст сообщения в том виде, в каком его вернул Telegram)
+_rendered_messages = OrderedDict()
+_RENDERED_MESSAGES_LIMIT = 10000
+
+
+async def edit_calculator_message(callback: CallbackQuery, text: str, reply_markup: InlineKeyboardMarkup) -> bool:
+    """Редактирует сообщение калькулятора, пропуская запрос к Telegram, если ничего не изменилось"""
+    key = (callback.message.chat.id, callback.message.message_id)
+    rendered = _rendered_messages.get(key)
+    # И текст, и клавиатуру сверяем и с кешем, и с тем, что сейчас видит пользователь:
+    # если сообщение редактировал другой обработчик, они будут отличаться
+    if (rendered is not None and rendered[:2] == (text, reply_markup)
+            and callback.message.text == rendered[2] and callback.message.reply_markup == reply_markup):
+        _rendered_messages.move_to_end(key)
+        return False
+
+    try:
+        edited = await callback.message.edit_text(text, reply_markup=reply_markup, parse_mode="Markdown")
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+        # Сообщение уже в нужном виде, но кеш о нем знал не то — забываем запись
+        _rendered_messages.pop(key, None)
+        return False
+
+    _rendered_messages[key] = (text, reply_markup, getattr(edited, "text", None))
+    _rendered_messages.move_to_end(key)
+    if len(_rendered_messages) > _RENDERED_MESSAGES_LIMIT:
+        _rendered_messages.popitem(last=False)
+    return True
+
 
 @router.callback_query(F.data == "missions")
 async def show_calculator(callback: CallbackQuery):
     """Показывает главное меню калькулятора"""
     try:
-        keyboard = fll_calculator.get_main_keyboard(callback.from_user.id)
-        await callback.message.edit_text(
+        keyboard = await fll_calculator.get_main_keyboard(callback.from_user.id)
+        await edit_calculator_message(
+            callback,
             "🧮 Калькулятор миссий Лиги Решений - Безопасный маршрут\n\n"
             "Выберите миссию для установки очков:",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
+            keyboard
         )
         await callback.answer()
     except Exception as e:
@@ -47,15 +86,15 @@ async def show_mission_detail(callback: CallbackQuery):
             return
 
         mission_name = fll_calculator.missions[mission_id]["name"]
-        current_score = fll_calculator.get_mission_score(callback.from_user.id, mission_id)
+        current_score = await fll_calculator.get_mission_score(callback.from_user.id, mission_id)
 
         keyboard = fll_calculator.get_mission_keyboard(mission_id)
-        await callback.message.edit_text(
+        await edit_calculator_message(
+            callback,
             f"🎯 **{mission_name}**\n\n"
             f"Текущие очки: {current_score}\n"
             f"Выберите количество очков:",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
+            keyboard
         )
         await callback.answer()
     except Exception as e:
@@ -74,15 +113,15 @@ async def set_mission_score(callback: CallbackQuery):
         mission_id = f"{parts[2]}_{parts[3]}"
         score = int(parts[4])
 
-        success = fll_calculator.set_mission_score(callback.from_user.id, mission_id, score)
+        success = await fll_calculator.set_mission_score(callback.from_user.id, mission_id, score)
 
         if success:
-            keyboard = fll_calculator.get_main_keyboard(callback.from_user.id)
-            await callback.message.edit_text(
+            keyboard = await fll_calculator.get_main_keyboard(callback.from_user.id)
+            await edit_calculator_message(
+                callback,
                 "🧮 **Калькулятор миссий FLL - Богатый урожай**\n\n"
                 "Выберите миссию для установки очков:",
-                reply_markup=keyboard,
-                parse_mode="Markdown"
+                keyboard
             )
             await callback.answer(f"✅ Очки обновлены: {score}")
         else:
@@ -95,13 +134,13 @@ async def set_mission_score(callback: CallbackQuery):
 async def show_total_score(callback: CallbackQuery):
     """Показывает детальную разбивку очков"""
     try:
-        breakdown = fll_calculator.get_score_breakdown(callback.from_user.id)
-        keyboard = fll_calculator.get_main_keyboard(callback.from_user.id)
+        breakdown = await fll_calculator.get_score_breakdown(callback.from_user.id)
+        keyboard = await fll_calculator.get_main_keyboard(callback.from_user.id)
 
-        await callback.message.edit_text(
+        await edit_calculator_message(
+            callback,
             breakdown,
-            reply_markup=keyboard,
-            parse_mode="Markdown"
+            keyboard
         )
         await callback.answer()
     except Exception as e:
@@ -112,14 +151,14 @@ async def show_total_score(callback: CallbackQuery):
 async def reset_calculator(callback: CallbackQuery):
     """Сбрасывает все очки"""
     try:
-        fll_calculator.reset_scores(callback.from_user.id)
-        keyboard = fll_calculator.get_main_keyboard(callback.from_user.id)
+        await fll_calculator.reset_scores(callback.from_user.id)
+        keyboard = await fll_calculator.get_main_keyboard(callback.from_user.id)
 
-        await callback.message.edit_text(
+        await edit_calculator_message(
+            callback,
             "🧮 **Калькулятор миссий Лиги Решений - Богатый урожай**\n\n"
             "Все очки сброшены! Выберите миссию для установки очков:",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
+            keyboard
         )
         await callback.answer("🔄 Калькулятор сброшен!")
     except Exception as e:
@@ -130,12 +169,12 @@ async def reset_calculator(callback: CallbackQuery):
 async def back_to_calculator(callback: CallbackQuery):
     """Возвращает к главному меню калькулятора"""
     try:
-        keyboard = fll_calculator.get_main_keyboard(callback.from_user.id)
-        await callback.message.edit_text(
+        keyboard = await fll_calculator.get_main_keyboard(callback.from_user.id)
+        await edit_calculator_message(
+            callback,
             "🧮 **Калькулятор миссий FLL - Богатый урожай**\n\n"
             "Выберите миссию для установки очков:",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
+            keyboard
         )
         await callback.answer()
     except Exception as e:
@@ -148,7 +187,7 @@ async def show_save_options(callback: CallbackQuery):
     """Показывает опции сохранения результатов"""
     try:
         user_id = callback.from_user.id
-        total_score = fll_calculator.get_total_score(user_id)
+        total_score = await fll_calculator.get_total_score(user_id)
         
         if total_score == 0:
             await callback.answer("❌ Нет результатов для сохранения! Сначала наберите очки.")
@@ -169,11 +208,11 @@ async def show_save_options(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "calc_save_simple")
-async def save_results(callback: CallbackQuery):
-    """Сохраняет результаты локально"""
+async def save_results(callback: CallbackQuery, session: AsyncSession):
+    """Сохраняет результаты в базу данных"""
     try:
         user_id = callback.from_user.id
-        total_score = fll_calculator.get_total_score(user_id)
+        total_score = await fll_calculator.get_total_score(user_id)
         
         if total_score == 0:
             await callback.answer("❌ Нет результатов для сохранения!")
@@ -183,24 +222,25 @@ async def save_results(callback: CallbackQuery):
         current_datetime = datetime.now()
         formatted_datetime = current_datetime.strftime('%d.%m.%Y в %H:%M')
         
-        # Сохраняем результат локально
-        new_result = local_storage.save_result(
-            user_id=user_id,
-            mission_scores=fll_calculator.get_user_scores_dict(user_id),
+        # Сохраняем результат в базу данных
+        new_result = await save_fll_result(
+            user_tg_id=user_id,
+            mission_scores=await fll_calculator.get_user_scores_dict(user_id),
             total_score=total_score,
             max_possible_score=fll_calculator.get_max_possible_score(),
-            name=f"Результат от {formatted_datetime}"
+            name=f"Результат от {formatted_datetime}",
+            session=session
         )
         
         # Возвращаемся к калькулятору
-        keyboard = fll_calculator.get_main_keyboard(user_id)
-        await callback.message.edit_text(
+        keyboard = await fll_calculator.get_main_keyboard(user_id)
+        await edit_calculator_message(
+            callback,
             "🧮 **Калькулятор миссий FLL - Богатый урожай**\n\n"
             f"✅ Результаты успешно сохранены!\n"
             f"📅 Дата: {formatted_datetime}\n"
             "Выберите миссию для установки очков:",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
+            keyboard
         )
         await callback.answer("✅ Результаты сохранены!")
         
@@ -212,25 +252,22 @@ async def save_results(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "calc_my_results")
-async def show_my_results(callback: CallbackQuery):
+async def show_my_results(callback: CallbackQuery, session: AsyncSession):
     """Показывает сохраненные результаты пользователя"""
     try:
         user_id = callback.from_user.id
         
-        # Получаем результаты пользователя из локального хранилища
-        results = local_storage.get_user_results(user_id)
-        
-        # Сортируем по дате создания (новые сначала)
-        results.sort(key=lambda x: x.created_at, reverse=True)
+        # Получаем результаты пользователя (новые сначала)
+        results = await get_user_fll_results(user_id, session=session)
         
         if not results:
-            keyboard = fll_calculator.get_main_keyboard(user_id)
-            await callback.message.edit_text(
+            keyboard = await fll_calculator.get_main_keyboard(user_id)
+            await edit_calculator_message(
+                callback,
                 "🧮 **Калькулятор миссий Лиги Решений - Богатый урожай**\n\n"
                 "📋 У вас пока нет сохраненных результатов.\n"
                 "Выберите миссию для установки очков:",
-                reply_markup=keyboard,
-                parse_mode="Markdown"
+                keyboard
             )
             await callback.answer("📋 Нет сохраненных результатов")
             return
@@ -250,21 +287,21 @@ async def show_my_results(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("calc_view_result_"))
-async def view_result_detail(callback: CallbackQuery):
+async def view_result_detail(callback: CallbackQuery, session: AsyncSession):
     """Показывает детали конкретного результата"""
     try:
         result_id = int(callback.data.replace("calc_view_result_", ""))
         user_id = callback.from_user.id
         
-        # Получаем результат из локального хранилища
-        result = local_storage.get_result_by_id(user_id, result_id)
+        # Получаем результат из базы данных (только свой)
+        result = await get_fll_result_by_id(result_id, session=session, user_tg_id=user_id)
         
         if not result:
             await callback.answer("❌ Результат не найден!")
             return
         
         # Формируем детальную информацию с улучшенным отображением даты
-        created_at = datetime.fromisoformat(result.created_at)
+        created_at = result.created_at
         detail_text = f"📊 **Детали результата**\n\n"
         detail_text += f"📅 Дата и время: {created_at.strftime('%d.%m.%Y в %H:%M')}\n"
         detail_text += f"🎯 Общий счет: {result.total_score}/{result.max_possible_score}\n"
@@ -289,14 +326,14 @@ async def view_result_detail(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("calc_delete_result_"))
-async def delete_result(callback: CallbackQuery):
+async def delete_result(callback: CallbackQuery, session: AsyncSession):
     """Удаляет сохраненный результат"""
     try:
         result_id = int(callback.data.replace("calc_delete_result_", ""))
         user_id = callback.from_user.id
         
-        # Удаляем результат из локального хранилища
-        success = local_storage.delete_result(user_id, result_id)
+        # Удаляем результат из базы данных
+        success = await delete_fll_result(result_id, user_id, session=session)
         
         if not success:
             await callback.answer("❌ Результат не найден!")
@@ -305,7 +342,7 @@ async def delete_result(callback: CallbackQuery):
         await callback.answer("🗑️ Результат удален!")
         
         # Возвращаемся к списку результатов
-        await show_my_results(callback)
+        await show_my_results(callback, session)
         
     except Exception as e:
         await callback.answer(f"Ошибка при удалении: {str(e)}")
@@ -361,7 +398,7 @@ async def show_detailed_report_period(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("calc_brief_report_"))
-async def generate_brief_report_with_period(callback: CallbackQuery):
+async def generate_brief_report_with_period(callback: CallbackQuery, session: AsyncSession):
     """Генерирует краткий отчёт с фильтрацией по периоду"""
     try:
         user_id = callback.from_user.id
@@ -390,11 +427,8 @@ async def generate_brief_report_with_period(callback: CallbackQuery):
             await callback.answer("❌ Неверный период!")
             return
         
-        # Получаем результаты пользователя с фильтрацией по дате
-        results = local_storage.get_results_by_period(user_id, start_date)
-        
-        # Сортируем по дате создания (новые сначала)
-        results.sort(key=lambda x: x.created_at, reverse=True)
+        # Получаем результаты пользователя за период (новые сначала) одним диапазонным запросом
+        results = await get_user_fll_results_by_period(user_id, start_date, session=session)
         
         if not results:
             back_button = [InlineKeyboardButton(text="◀️ Назад к выбору периода", callback_data="calc_brief_report")]
@@ -428,8 +462,9 @@ async def generate_brief_report_with_period(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("calc_detailed_report_"))
-async def generate_detailed_report_with_period(callback: CallbackQuery):
+async def generate_detailed_report_with_period(callback: CallbackQuery, session: AsyncSession):
     """Генерирует детальный Excel отчёт с фильтрацией по периоду"""
+    answered = False
     try:
         user_id = callback.from_user.id
         period = callback.data.replace("calc_detailed_report_", "")
@@ -457,23 +492,14 @@ async def generate_detailed_report_with_period(callback: CallbackQuery):
             await callback.answer("❌ Неверный период!")
             return
         
-        # Получаем результаты пользователя с фильтрацией по дате
-        results = local_storage.get_results_by_period(user_id, start_date)
-        
-        # Сортируем по дате создания (новые сначала)
-        results.sort(key=lambda x: x.created_at, reverse=True)
+        # Сами результаты читает процесс, который строит отчёт; здесь нужны только
+        # количество и id самого нового — по ним проверяется кэш
+        results_count, newest_id = await get_user_fll_results_period_stats(user_id, start_date, session=session)
         
-        if not results:
+        if not results_count:
             await callback.answer(f"❌ Нет результатов за {period_name} для создания отчёта!")
             return
         
-        # Генерируем Excel отчёт
-        excel_file = fll_calculator.generate_detailed_excel_report(results)
-        
-        if excel_file is None:
-            await callback.answer("❌ Ошибка при создании отчёта!")
-            return
-        
         # Создаём имя файла с периодом и текущей датой
         current_date = datetime.now().strftime('%Y-%m-%d_%H-%M')
         period_suffix = {
@@ -484,24 +510,71 @@ async def generate_detailed_report_with_period(callback: CallbackQuery):
             "all": "все_время"
         }.get(period, period)
         filename = f"FLL_отчёт_{period_suffix}_{current_date}.xlsx"
-        
-        # Отправляем файл
-        await callback.message.answer_document(
-            document=types.BufferedInputFile(
-                excel_file.getvalue(),
-                filename=filename
-            ),
-            caption=f"📊 **Детальный отчёт по выполненным миссиям за {period_name}**\n\n"
+        caption = (f"📊 **Детальный отчёт по выполненным миссиям за {period_name}**\n\n"
                    "Файл содержит:\n"
                    "• Общую статистику\n"
                    "• Разбивку по миссиям\n"
-                   "• Сводку по миссиям"
-        )
-        
-        await callback.answer("✅ Отчёт отправлен!")
+                   "• Сводку по миссиям")
+        
+        # Если результаты не менялись, отдаём готовый отчёт: по file_id Telegram без повторной загрузки.
+        # Отчёт закреплён в кэше до конца отправки, чтобы его файл не вытеснили
+        cache_key = report_cache.make_key(user_id, period, newest_id, results_count)
+        cached = report_cache.get(cache_key, pin=True)
+        try:
+            if cached is not None and cached.file_id:
+                try:
+                    await callback.message.answer_document(document=cached.file_id, caption=caption)
+                    await callback.answer()
+                    return
+                except TelegramBadRequest:
+                    report_cache.forget_file_id(cache_key)
+            
+            status_message = None
+            if cached is None:
+                # Генерируем Excel отчёт в отдельном пуле, чтобы не блокировать остальных пользователей
+                await callback.answer("⏳ Формируем отчёт...")
+                answered = True
+                status_message = await callback.message.answer(
+                    f"⏳ Формируем детальный отчёт за {period_name}, это может занять некоторое время..."
+                )
+                # Отчёт пишется потоково во временный файл, чтобы не держать результаты и книгу в памяти
+                try:
+                    report = await report_executor.render_detailed_report_to_file(user_id, start_date)
+                except ReportAlreadyRunning:
+                    await status_message.edit_text("⏳ Ваш предыдущий отчёт ещё формируется, дождитесь его.")
+                    return
+                except ReportQueueFull:
+                    await status_message.edit_text("⏳ Сейчас формируется слишком много отчётов. Попробуйте через минуту.")
+                    return
+                
+                if report is None:
+                    await status_message.edit_text("❌ Ошибка при создании отчёта!")
+                    return
+                
+                cached = report_cache.put_file(cache_key, report)
+            else:
+                await callback.answer()
+                answered = True
+            
+            # Отправляем файл и запоминаем его file_id для повторных запросов
+            sent_message = await callback.message.answer_document(
+                document=types.FSInputFile(cached.path, filename=filename),
+                caption=caption
+            )
+            if sent_message.document:
+                report_cache.set_file_id(cache_key, sent_message.document.file_id)
+            if status_message is not None:
+                await status_message.delete()
+        finally:
+            if cached is not None:
+                report_cache.release(cache_key)
         
     except Exception as e:
-        await callback.answer(f"Ошибка при создании отчёта: {str(e)}")
+        if answered:
+            # На callback уже ответили, второй ответ Telegram отклонит
+            await callback.message.answer(f"Ошибка при создании отчёта: {str(e)}")
+        else:
+            await callback.answer(f"Ошибка при создании отчёта: {str(e)}")
 
 
 @router.message(F.photo)
@@ -518,12 +591,12 @@ async def handle_photo(message: Message, session: AsyncSession, state: FSMContex
         user_tg_id = message.from_user.id
         
         # Обновляем время последнего напоминания, так как пользователь прислал фото
-        await session.execute(
-            update(User)
-            .where(User.tg_id == user_tg_id)
-            .values(last_photo_reminder=datetime.now())
-        )
-        await session.commit()
+        # Фото из альбома приходят пачкой — они копятся в памяти воркера
+        # и записываются в БД одной транзакцией раз в несколько секунд
+        if photo_batcher.is_running:
+            photo_batcher.record(user_tg_id, datetime.now())
+        else:
+            await mark_photo_received(user_tg_id, datetime.now(), session)
         
     except Exception as e:
         # Не отправляем ответное сообщение, чтобы не мешать пользователю
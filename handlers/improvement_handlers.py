@@ -18,6 +18,9 @@ from keybords.improvement_kb import (
     get_improvement_edit_keyboard
 )
 from keybords.keybord_client import kb_client
+from scheduler import get_reminder_scheduler
+from database.requests import refresh_reminder_schedule
+from drafts import DraftTooLarge, improvement_drafts
 
 router = Router()
 
@@ -29,9 +32,6 @@ class ImprovementStates(StatesGroup):
     waiting_for_edit_description = State()
     waiting_for_edit_files = State()
 
-# Временное хранилище для данных доработки
-improvement_temp_data = {}
-
 @router.callback_query(F.data == "changes")
 async def show_improvement_menu(callback: CallbackQuery):
     """Показывает главное меню доработок"""
@@ -78,9 +78,7 @@ async def start_adding_improvement(callback: CallbackQuery, state: FSMContext):
         await state.update_data(improvement_type=improvement_type)
         
         # Очищаем временные данные
-        user_id = callback.from_user.id
-        if user_id in improvement_temp_data:
-            del improvement_temp_data[user_id]
+        await improvement_drafts.clear(state)
         
         # Шаг 1: запрашиваем название
         await state.set_state(ImprovementStates.waiting_for_title)
@@ -155,15 +153,6 @@ async def handle_improvement_description(message: Message, state: FSMContext):
 async def handle_improvement_files(message: Message, state: FSMContext):
     """Обрабатывает файлы доработки"""
     try:
-        user_id = message.from_user.id
-        
-        # Инициализируем временное хранилище для пользователя
-        if user_id not in improvement_temp_data:
-            improvement_temp_data[user_id] = {
-                "file_ids": [],
-                "files_info": []
-            }
-        
         # Обрабатываем разные типы файлов
         if message.photo:
             file_id = message.photo[-1].file_id
@@ -178,18 +167,23 @@ async def handle_improvement_files(message: Message, state: FSMContext):
             await message.answer("❌ Поддерживаются только фото, видео и документы!")
             return
         
-        # Сохраняем информацию о файле
-        improvement_temp_data[user_id]["file_ids"].append(file_id)
-        improvement_temp_data[user_id]["files_info"].append({
-            "type": file_type,
-            "file_id": file_id
-        })
+        # Сохраняем информацию о файле (файлы альбома могут прийти в разные воркеры)
+        def add_file(temp_data):
+            temp_data.setdefault("file_ids", []).append(file_id)
+            temp_data.setdefault("files_info", []).append({
+                "type": file_type,
+                "file_id": file_id
+            })
+        
+        temp_data = await improvement_drafts.modify(state, add_file)
         
         await message.answer(
             f"✅ {file_type.capitalize()} добавлен!\n"
-            f"Всего файлов: {len(improvement_temp_data[user_id]['file_ids'])}"
+            f"Всего файлов: {len(temp_data['file_ids'])}"
         )
         
+    except DraftTooLarge:
+        await message.answer("❌ Слишком много файлов для одной доработки.")
     except Exception as e:
         await message.answer(f"Ошибка при обработке файла: {str(e)}")
 
@@ -197,11 +191,10 @@ async def handle_improvement_files(message: Message, state: FSMContext):
 async def finish_adding_files(callback: CallbackQuery, state: FSMContext):
     """Завершает добавление файлов и показывает предварительный просмотр"""
     try:
-        user_id = callback.from_user.id
         data = await state.get_data()
         
         # Получаем временные данные
-        temp_data = improvement_temp_data.get(user_id, {})
+        temp_data = await improvement_drafts.get(state)
         file_ids = temp_data.get("file_ids", [])
         files_info = temp_data.get("files_info", [])
         
@@ -252,7 +245,7 @@ async def confirm_improvement(callback: CallbackQuery, state: FSMContext, sessio
         data = await state.get_data()
         
         # Получаем временные данные
-        temp_data = improvement_temp_data.get(user_id, {})
+        temp_data = await improvement_drafts.get(state)
         file_ids = temp_data.get("file_ids", [])
         
         improvement_type = data.get("improvement_type")
@@ -271,7 +264,7 @@ async def confirm_improvement(callback: CallbackQuery, state: FSMContext, sessio
         
         # Создаем новую доработку
         # Сохраняем детальную информацию о файлах (тип + file_id), если она есть
-        files_info = improvement_temp_data.get(user_id, {}).get("files_info")
+        files_info = temp_data.get("files_info")
         files_payload = files_info if files_info else (file_ids if file_ids else None)
 
         new_improvement = Improvement(
@@ -286,11 +279,13 @@ async def confirm_improvement(callback: CallbackQuery, state: FSMContext, sessio
         session.add(new_improvement)
         await session.commit()
         
-        # Очищаем временные данные
-        if user_id in improvement_temp_data:
-            del improvement_temp_data[user_id]
+        # Первая доработка ставит пользователя в очередь напоминаний
+        next_reminder_at = await refresh_reminder_schedule(user_id, session)
+        scheduler = get_reminder_scheduler()
+        if scheduler:
+            scheduler.reschedule(user_id, next_reminder_at)
         
-        # Очищаем состояние
+        # Очищаем состояние (временные данные хранятся в нем же)
         await state.clear()
         
         # Показываем сообщение об успехе
@@ -590,6 +585,11 @@ async def delete_improvement(callback: CallbackQuery, session: AsyncSession):
         await session.delete(improvement)
         await session.commit()
         
+        next_reminder_at = await refresh_reminder_schedule(user_id, session)
+        scheduler = get_reminder_scheduler()
+        if scheduler:
+            scheduler.reschedule(user_id, next_reminder_at)
+        
         await callback.answer("🗑️ Доработка удалена!")
         
         # Возвращаемся к списку доработок
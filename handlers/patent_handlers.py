@@ -1,5 +1,6 @@
 from aiogram import F, Router
 import asyncio
+import time
 from aiogram.client.bot import Bot
 from typing import Dict, Optional, Union, List, Tuple
 
@@ -18,12 +19,16 @@ from keybords.patent_kb import (
 from keybords.registration_keyboard import keyboard_error as kb_er
 from keybords.keybord_client import kb_client
 import database.requests as rq
+from drafts import album_drafts
 
 router = Router()
 
 approved_missions = False
 proceed_missions = None
-album_collector: Dict[int, Dict[str, Union[str, List[str], asyncio.Task]]] = {}
+# Отложенная обработка альбомов: сами медиа копятся в черновике, здесь только таймеры этого процесса.
+# Части альбома могут прийти в разные воркеры — завершает альбом тот таймер,
+# после которого новых частей не было (см. _take_finished_album)
+album_tasks: Dict[int, asyncio.Task] = {}
 ALBUM_PROCESSING_DELAY = 0.2
 
 
@@ -466,21 +471,47 @@ async def process_mission_number(message: Message, state: FSMContext):
     )
 
 
+async def _take_finished_album(state: FSMContext, media_group_id: str) -> Optional[dict]:
+    """Атомарно забирает альбом из черновика, если за ALBUM_PROCESSING_DELAY не пришло новых частей
+
+    Забрать альбом может только один таймер, даже если они запущены в разных воркерах.
+    """
+    taken = {}
+
+    def take(album):
+        taken.clear()
+        if (album.get("media_group_id") == media_group_id
+                and time.time() - album["last_part_at"] >= ALBUM_PROCESSING_DELAY):
+            taken.update(album)
+            album.clear()
+
+    await album_drafts.modify(state, take)
+    return taken or None
+
+
 async def _finalize_album_processing(bot_instance: Bot, chat_id: int, state: FSMContext, media_group_id: str):
     """Собирает медиа из альбома и переводит пользователя к вводу названия."""
     try:
         await asyncio.sleep(ALBUM_PROCESSING_DELAY)
-        if chat_id in album_collector and album_collector[chat_id]["media_group_id"] == media_group_id:
-            collected_photos = album_collector[chat_id]["photos"]
-            collected_videos = album_collector[chat_id]["videos"]
-            await state.update_data(images_ids=collected_photos, video_ids=collected_videos)
+        album = await _take_finished_album(state, media_group_id)
+        if album is not None:
+            await state.update_data(images_ids=album["photos"], video_ids=album["videos"])
             await state.set_state(Publish.caption)
             await bot_instance.send_message(chat_id, "Введите название насадки.")
-            del album_collector[chat_id]
     except asyncio.CancelledError:
         pass
     except Exception as e:
         print(f"Ошибка в _finalize_album_processing для чата {chat_id}: {e}")
+    finally:
+        if album_tasks.get(chat_id) is asyncio.current_task():
+            del album_tasks[chat_id]
+
+
+def _cancel_album_processing(chat_id: int):
+    """Отменяет ожидающую обработку альбома в этом чате."""
+    task = album_tasks.pop(chat_id, None)
+    if task and not task.done():
+        task.cancel()
 
 
 @router.message(Publish.media)
@@ -496,38 +527,31 @@ async def process_media_and_ask_caption(message: Message, state: FSMContext):
     current_bot_instance = message.bot
 
     if not current_media_group_id:
+        _cancel_album_processing(chat_id)
+        await album_drafts.clear(state)
         images_ids = [message.photo[-1].file_id] if message.photo else []
         video_ids = [message.video.file_id] if message.video else []
         await state.update_data(images_ids=images_ids, video_ids=video_ids)
         await state.set_state(Publish.caption)
         await message.answer("Введите название насадки.")
-        if chat_id in album_collector:
-            if album_collector[chat_id].get("processing_task") and not album_collector[chat_id]["processing_task"].done():
-                album_collector[chat_id]["processing_task"].cancel()
-            del album_collector[chat_id]
         return
 
-    if chat_id not in album_collector or album_collector[chat_id]["media_group_id"] != current_media_group_id:
-        if chat_id in album_collector and album_collector[chat_id].get("processing_task") and not \
-                album_collector[chat_id]["processing_task"].done():
-            album_collector[chat_id]["processing_task"].cancel()
-        album_collector[chat_id] = {
-            "media_group_id": current_media_group_id,
-            "photos": [],
-            "videos": [],
-            "processing_task": None
-        }
-
-    collector_data = album_collector[chat_id]
-    if message.photo:
-        collector_data["photos"].append(message.photo[-1].file_id)
-    elif message.video:
-        collector_data["videos"].append(message.video.file_id)
-
-    if collector_data["processing_task"] and not collector_data["processing_task"].done():
-        collector_data["processing_task"].cancel()
-
-    collector_data["processing_task"] = asyncio.create_task(
+    # Сообщения альбома приходят почти одновременно, в том числе в разные воркеры —
+    # modify() добавляет их атомарно в хранилище FSM
+    def add_part(album):
+        if album.get("media_group_id") != current_media_group_id:
+            album.clear()
+            album.update(media_group_id=current_media_group_id, photos=[], videos=[])
+        if message.photo:
+            album["photos"].append(message.photo[-1].file_id)
+        elif message.video:
+            album["videos"].append(message.video.file_id)
+        album["last_part_at"] = time.time()
+
+    await album_drafts.modify(state, add_part)
+
+    _cancel_album_processing(chat_id)
+    album_tasks[chat_id] = asyncio.create_task(
         _finalize_album_processing(current_bot_instance, chat_id, state, current_media_group_id)
     )
 
@@ -10,8 +10,8 @@ from sqlalchemy import select
 from datetime import datetime
 from database.models import FLLResult, User
 from aiogram import types
-from local_storage import local_storage
 from keybords.registration_keyboard import keyboard
+from database.requests import invalidate_user_team_cache
 
 
 class FullRegister(StatesGroup):
@@ -137,6 +137,9 @@ async def register2(message: Message, state: FSMContext, session: AsyncSession):
                 await message.answer("Вы зарегистрированы и можете начать пользоваться ботом!\n По даному паролю любой участник команды сможет войти в аккаунт команды:)")
                 await state.clear()  # Очищаем состояние после успешной регистрации
 
+        # Команда пользователя могла измениться — сбрасываем кэш проверки регистрации
+        invalidate_user_team_cache(user_tg_id)
+
     except Exception as e:
         # Если произошла любая ошибка (например, уникальность на команде, если team не unique)
         # print(f"Ошибка при регистрации: {e}")
@@ -201,6 +204,8 @@ async def register3(message: Message, state: FSMContext, session: AsyncSession):
                 await message.answer("Вы зарегистрированы и можете начать пользоваться ботом!\n По даному паролю любой участник команды сможет войти в аккаунт команды:)")
                 await state.clear() 
 
+        invalidate_user_team_cache(user_tg_id)
+
     except Exception as e:
         await message.answer(f"Произошла ошибка при регистрации: {e}.\nПожалуйста, попробуйте еще раз.")
         print(f"ERROR in register2 for user {user_tg_id}: {e}")
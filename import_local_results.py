@@ -0,0 +1,78 @@
+import asyncio
+import re
+from datetime import datetime
+from pathlib import Path
+from sqlalchemy import select
+from database.engine import proceed_schemas, async_session_factory
+from database.models import FLLResult, User
+from database.requests import bulk_insert_fll_results
+from local_storage import read_legacy_results, read_log_results
+
+
+def read_user_results(storage_path: Path, user_id: int):
+    """Читает результаты пользователя из журнала или старого JSON, ничего не изменяя в user_data/"""
+    log_file = storage_path / f"user_{user_id}.log"
+    if log_file.exists():
+        return read_log_results(log_file)
+    json_file = storage_path / f"user_{user_id}.json"
+    try:
+        return read_legacy_results(json_file)
+    except ValueError as e:
+        print(f"Пропускаем {json_file}: {e}")
+        return []
+
+
+async def import_local_results(storage_dir: str = "user_data"):
+    """Переносит результаты калькулятора из user_data/ в таблицу fll_results.
+
+    Повторный запуск безопасен: результаты, уже перенесенные ранее
+    (тот же пользователь и то же время создания), пропускаются.
+    """
+    await proceed_schemas()
+    storage_path = Path(storage_dir)
+
+    user_ids = set()
+    for path in storage_path.iterdir():
+        match = re.fullmatch(r"user_(\d+)\.(json|log)", path.name)
+        if match:
+            user_ids.add(int(match.group(1)))
+
+    if not user_ids:
+        print("Локальных результатов не найдено.")
+        return
+
+    async with async_session_factory() as session:
+        # Команды пользователей и уже перенесенные результаты — одним запросом каждое
+        teams_query = await session.execute(
+            select(User.tg_id, User.team_id).where(User.tg_id.in_(user_ids))
+        )
+        team_by_user = dict(teams_query.all())
+
+        existing_query = await session.execute(
+            select(FLLResult.user_tg_id, FLLResult.created_at).where(FLLResult.user_tg_id.in_(user_ids))
+        )
+        existing = set(existing_query.all())
+
+        rows = []
+        for user_id in sorted(user_ids):
+            for result in read_user_results(storage_path, user_id):
+                created_at = datetime.fromisoformat(result.created_at)
+                if (user_id, created_at) in existing:
+                    continue
+                rows.append({
+                    'user_tg_id': user_id,
+                    'team_id': team_by_user.get(user_id),
+                    'mission_scores': result.mission_scores,
+                    'total_score': result.total_score,
+                    'max_possible_score': result.max_possible_score,
+                    'created_at': created_at,
+                    'name': result.name,
+                })
+
+        imported = await bulk_insert_fll_results(rows, session)
+
+    print(f"Перенесено результатов: {imported} (пользователей: {len(user_ids)})")
+
+
+if __name__ == "__main__":
+    asyncio.run(import_local_results())
@@ -1,7 +1,7 @@
 import asyncio
+import os
 from config import TOKEN
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.filters import CommandStart
 from aiogram.types import Message
 from keybords import kb_client
@@ -10,18 +10,38 @@ from handlers.patent_handlers import router as patent_router
 from admins_panel.admin_keyboard import router as admin_router
 from records.record_handler import router as record_router
 from handlers.registration_handlers import router as reg_router
-from database.engine import proceed_schemas, async_session_factory
-from database.middleware import DbSessionMiddleware
+from database.engine import proceed_schemas, async_session_factory, async_engine
+from database.middleware import DbSessionMiddleware, session_stats
 from database.models import User
+from database.requests import mark_user_reachable
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from scheduler import init_reminder_scheduler
+from aiogram.fsm.storage.memory import MemoryStorage
+from scheduler import get_reminder_scheduler, init_reminder_scheduler, photo_batcher
 from handlers.improvement_handlers import router as improvement_router
+from reports import report_cache, report_executor
+from calculator import fll_calculator
+from score_storage import MemoryScoreStorage
+from broadcast import get_broadcast_runner, init_broadcast_runner
+from fsm_storage import create_fsm_storage
+from drafts import get_draft_metrics
+from metrics import add_metrics_route, handler_metrics, setup_metrics, start_metrics_server
+from webhook import (
+    WEBHOOK_WORKERS, create_leader_lock, create_webhook_app, run_leader_election,
+    run_workers, serve_webhook_app, set_webhook, wait_for_shutdown_signal
+)
 
+# polling — один процесс опрашивает Telegram; webhook — aiohttp-сервер и WEBHOOK_WORKERS процессов
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# В режиме polling /metrics поднимается на отдельном порту, если он задан;
+# в режиме webhook метрики отдает сам webhook-сервер
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
 
 
 bot = Bot(TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Состояния сценариев хранятся вне процесса и переживают перезапуск (см. FSM_STORAGE_BACKEND)
+dp = Dispatcher(storage=create_fsm_storage())
 
 
 @dp.message(CommandStart())
@@ -38,15 +58,15 @@ async def cmd_start(message: Message, session: AsyncSession):
         new_user = User(tg_id=user_tg_id, team_id=None)  # Создаем пользователя без привязки к команде
         session.add(new_user)
         await session.commit()
+    elif user_obj.blocked_at is not None or user_obj.consecutive_failures:
+        # Пользователь вернулся (например, разблокировал бота) — снова включаем его в рассылки
+        await mark_user_reachable(user_tg_id, session)
 
     await message.answer("Привет! Этот бот был разработан для Лиги Решений и предоставляет следующие полезные функции: \nЕсли вы столкнулись с проблемой, напишите нам в чат: https://t.me/+544PCMqLwrU3NWEy  ", reply_markup=kb_client)
 
 
-async def main():
-    # Инициализация базы данных (создание таблиц)
-    await proceed_schemas()
-    print("База данных и таблицы готовы.")
-
+def setup_dispatcher():
+    """Подключает middleware и роутеры (один раз в каждом процессе)"""
     # РЕГИСТРАЦИЯ MIDDLEWARE ДЛЯ СЕССИЙ БД
     # Это КРИТИЧЕСКИ ВАЖНО. Middleware должно быть зарегистрировано
     # ДО включения роутеров и запуска polling.
@@ -63,21 +83,127 @@ async def main():
         improvement_router
     )
     print("Роутеры включены в диспетчер.")
-    
+
+    # Время обработчиков, запросов к БД и к Telegram API
+    setup_metrics(dp, bot, async_engine)
+    handler_metrics.add_counter("bot_db_sessions_requested_total", "Updates that passed DbSessionMiddleware.",
+                                lambda: session_stats.requested)
+    handler_metrics.add_counter("bot_db_sessions_opened_total", "Lazy sessions a handler actually touched.",
+                                lambda: session_stats.opened)
+    handler_metrics.add_counter("bot_db_sessions_used_total", "Sessions that checked out a connection.",
+                                lambda: session_stats.used)
+    # Черновики сценариев: чтения, записи, удаления, просроченные и отклоненные по размеру
+    for name in get_draft_metrics():
+        for field in ("loads", "saves", "clears", "expired", "rejected"):
+            handler_metrics.add_counter(f"bot_draft_{name}_{field}_total", f"Draft store '{name}': {field}.",
+                                        lambda name=name, field=field: get_draft_metrics()[name][field])
+
+
+async def start_background_services():
+    """Запускает задачи, которые должны работать в единственном экземпляре"""
     # Инициализация и запуск планировщика напоминаний
     scheduler = init_reminder_scheduler(bot)
     await scheduler.start()
     print("Планировщик напоминаний запущен.")
-    
+
+    # Фоновые рассылки: продолжаем те, что были прерваны перезапуском
+    await get_broadcast_runner().start()
+
+
+async def stop_background_services():
+    # Останавливаем планировщик при завершении работы
+    scheduler = get_reminder_scheduler()
+    if scheduler:
+        await scheduler.stop()
+    await get_broadcast_runner().stop()
+    # Не теряем фото, пришедшие после последней пачки
+    await photo_batcher.stop()
+    report_executor.shutdown()
+    await fll_calculator.score_storage.close()
+
+
+async def main():
+    # Инициализация базы данных (создание таблиц)
+    await proceed_schemas()
+    print("База данных и таблицы готовы.")
+
+    setup_dispatcher()
+    init_broadcast_runner(bot)
+    photo_batcher.start()
+    await start_background_services()
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+
     try:
+        # Если раньше бот работал через webhook, getUpdates без этого не работает
+        await bot.delete_webhook()
         await dp.start_polling(bot)
     finally:
-        # Останавливаем планировщик при завершении работы
-        await scheduler.stop()
+        await stop_background_services()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+
+async def webhook_worker(worker_index: int):
+    """Воркер webhook-режима: принимает обновления, а планировщик запускает только ведущий"""
+    setup_dispatcher()
+    if WEBHOOK_WORKERS > 1:
+        # Кэш отчётов свой у каждого воркера, файлы — в отдельном каталоге
+        report_cache.set_worker(worker_index)
+    # Рассылки выполняет только ведущий; остальные воркеры лишь меняют их статус в БД
+    init_broadcast_runner(bot)
+    # Фото пачками пишет каждый воркер сам, независимо от ведущего
+    photo_batcher.start()
+    stop_event = wait_for_shutdown_signal()
+
+    lock = create_leader_lock()
+    election = asyncio.create_task(run_leader_election(lock, worker_index, start_background_services))
+    app = create_webhook_app(dp, bot)
+    add_metrics_route(app)
+    runner = await serve_webhook_app(app, worker_index)
+    try:
+        await stop_event.wait()
+    finally:
+        election.cancel()
+        await stop_background_services()
+        await runner.cleanup()
+        if lock:
+            lock.release()
+        await bot.session.close()
+
+
+def run_webhook_worker(worker_index: int):
+    asyncio.run(webhook_worker(worker_index))
+
+
+def check_multi_worker_storage():
+    """Состояния в памяти процесса не видны другим воркерам — такой конфиг не запускаем"""
+    if isinstance(dp.storage, MemoryStorage):
+        raise ValueError("При WEBHOOK_WORKERS > 1 FSM_STORAGE_BACKEND=memory недопустим: задайте sqlite или redis")
+    if isinstance(fll_calculator.score_storage, MemoryScoreStorage):
+        raise ValueError("При WEBHOOK_WORKERS > 1 CALC_STATE_BACKEND=memory недопустим: задайте sqlite или redis")
+
+
+async def prepare_webhook():
+    """Готовит БД и регистрирует webhook перед запуском воркеров"""
+    await proceed_schemas()
+    print("База данных и таблицы готовы.")
+    setup_dispatcher()
+    await set_webhook(bot, dp)
+    await bot.session.close()
 
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        if BOT_MODE == "webhook":
+            if WEBHOOK_WORKERS > 1:
+                check_multi_worker_storage()
+            # Секрет, сгенерированный здесь, воркеры унаследуют через окружение
+            asyncio.run(prepare_webhook())
+            if WEBHOOK_WORKERS > 1:
+                run_workers(run_webhook_worker, WEBHOOK_WORKERS)
+            else:
+                run_webhook_worker(0)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print('Exit')
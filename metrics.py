@@ -0,0 +1,286 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Границы корзин гистограммы времени обработки, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами в формате Prometheus"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+@dataclass
+class HandlerStats:
+    """Статистика одного обработчика"""
+    latency: Histogram = field(default_factory=Histogram)
+    errors: int = 0
+    db_seconds: float = 0.0
+    db_queries: int = 0
+    api_seconds: float = 0.0
+    api_calls: int = 0
+    api_errors: int = 0
+
+
+@dataclass
+class _Timing:
+    """Время, набежавшее за обработку одного события"""
+    db_seconds: float = 0.0
+    db_queries: int = 0
+    api_seconds: float = 0.0
+    api_calls: int = 0
+    api_errors: int = 0
+
+
+_current_timing: ContextVar[Optional[_Timing]] = ContextVar("handler_timing", default=None)
+
+
+class HandlerMetrics:
+    """Метрики обработчиков: время, ошибки, время в БД и в Telegram API"""
+
+    def __init__(self):
+        self.handlers: Dict[tuple, HandlerStats] = {}
+        self.api_methods: Dict[str, Histogram] = {}
+        self.api_method_errors: Dict[str, int] = {}
+        self.counters: List[tuple] = []
+        self.started_at = time.monotonic()
+
+    def add_counter(self, name: str, help_text: str, getter: Callable[[], float]):
+        """Добавляет в /metrics счетчик, который ведется в другом модуле"""
+        self.counters.append((name, help_text, getter))
+
+    def observe_handler(self, event_type: str, name: str, seconds: float, timing: _Timing, failed: bool):
+        stats = self.handlers.get((event_type, name))
+        if stats is None:
+            stats = self.handlers[(event_type, name)] = HandlerStats()
+        stats.latency.observe(seconds)
+        stats.errors += failed
+        stats.db_seconds += timing.db_seconds
+        stats.db_queries += timing.db_queries
+        stats.api_seconds += timing.api_seconds
+        stats.api_calls += timing.api_calls
+        stats.api_errors += timing.api_errors
+
+    def observe_api_call(self, method: str, seconds: float, failed: bool):
+        histogram = self.api_methods.get(method)
+        if histogram is None:
+            histogram = self.api_methods[method] = Histogram()
+        histogram.observe(seconds)
+        if failed:
+            self.api_method_errors[method] = self.api_method_errors.get(method, 0) + 1
+
+    def top_handlers(self, limit: int = 10) -> List[tuple]:
+        """Обработчики с наибольшим суммарным временем: (тип события, имя, статистика)"""
+        items = sorted(self.handlers.items(), key=lambda item: item[1].latency.sum, reverse=True)
+        return [(event_type, name, stats) for (event_type, name), stats in items[:limit]]
+
+    def render_prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        lines = [
+            "# HELP bot_handler_duration_seconds Handler execution time.",
+            "# TYPE bot_handler_duration_seconds histogram",
+        ]
+        for (event_type, name), stats in self.handlers.items():
+            labels = f'event="{event_type}",handler="{name}"'
+            cumulative = 0
+            for bound, count in zip(stats.latency.buckets, stats.latency.counts):
+                cumulative += count
+                lines.append(f'bot_handler_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'bot_handler_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.latency.count}')
+            lines.append(f"bot_handler_duration_seconds_sum{{{labels}}} {stats.latency.sum}")
+            lines.append(f"bot_handler_duration_seconds_count{{{labels}}} {stats.latency.count}")
+
+        counters = [
+            ("bot_handler_errors_total", "Handler calls that raised an exception.", "errors"),
+            ("bot_handler_db_seconds_total", "Time spent in database queries.", "db_seconds"),
+            ("bot_handler_db_queries_total", "Database queries executed.", "db_queries"),
+            ("bot_handler_api_seconds_total", "Time spent in Telegram Bot API calls.", "api_seconds"),
+            ("bot_handler_api_calls_total", "Telegram Bot API calls made.", "api_calls"),
+            ("bot_handler_api_errors_total", "Telegram Bot API calls that failed.", "api_errors"),
+        ]
+        for metric, help_text, attr in counters:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (event_type, name), stats in self.handlers.items():
+                lines.append(f'{metric}{{event="{event_type}",handler="{name}"}} {getattr(stats, attr)}')
+
+        lines.append("# HELP bot_api_request_duration_seconds Telegram Bot API request time by method.")
+        lines.append("# TYPE bot_api_request_duration_seconds histogram")
+        for method, histogram in self.api_methods.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'bot_api_request_duration_seconds_bucket{{method="{method}",le="{bound}"}} {cumulative}')
+            lines.append(f'bot_api_request_duration_seconds_bucket{{method="{method}",le="+Inf"}} {histogram.count}')
+            lines.append(f'bot_api_request_duration_seconds_sum{{method="{method}"}} {histogram.sum}')
+            lines.append(f'bot_api_request_duration_seconds_count{{method="{method}"}} {histogram.count}')
+        lines.append("# HELP bot_api_request_errors_total Failed Telegram Bot API requests by method.")
+        lines.append("# TYPE bot_api_request_errors_total counter")
+        for method, errors in self.api_method_errors.items():
+            lines.append(f'bot_api_request_errors_total{{method="{method}"}} {errors}')
+
+        for name, help_text, getter in self.counters:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {getter()}")
+
+        lines.append("# HELP bot_uptime_seconds Time since the process started collecting metrics.")
+        lines.append("# TYPE bot_uptime_seconds gauge")
+        lines.append(f"bot_uptime_seconds {time.monotonic() - self.started_at}")
+        return "\n".join(lines) + "\n"
+
+
+handler_metrics = HandlerMetrics()
+
+
+def _handler_name(handler) -> str:
+    callback = handler.callback
+    return f"{callback.__module__}.{getattr(callback, '__qualname__', repr(callback))}"
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет время каждого сработавшего обработчика
+
+    Регистрируется как inner-middleware событий диспетчера, поэтому
+    срабатывает только после фильтров и знает, какой обработчик выбран.
+    """
+
+    def __init__(self, metrics: HandlerMetrics = handler_metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = _handler_name(handler_object) if handler_object is not None else "unknown"
+        timing = _Timing()
+        token = _current_timing.set(timing)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(event, data)
+            failed = False
+            return result
+        finally:
+            _current_timing.reset(token)
+            self.metrics.observe_handler(type(event).__name__, name, time.perf_counter() - started, timing, failed)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет запросы к Telegram Bot API и относит их к текущему обработчику"""
+
+    def __init__(self, metrics: HandlerMetrics = handler_metrics):
+        self.metrics = metrics
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await make_request(bot, method)
+            failed = False
+            return response
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.observe_api_call(type(method).__name__, elapsed, failed)
+            timing = _current_timing.get()
+            if timing is not None:
+                timing.api_seconds += elapsed
+                timing.api_calls += 1
+                timing.api_errors += failed
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Учитывает время SQL-запросов в обработчике, который их выполнил"""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        timing = _current_timing.get()
+        if timing is not None:
+            timing.db_seconds += time.perf_counter() - started
+            timing.db_queries += 1
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(context):
+        # after_cursor_execute после ошибки не вызывается — убираем отметку, иначе
+        # она останется в info соединения, вернувшегося в пул
+        connection = context.connection
+        if connection is not None and connection.info.get("query_started"):
+            connection.info["query_started"].pop()
+
+
+def setup_metrics(dispatcher: Dispatcher, bot: Bot, engine: AsyncEngine):
+    """Подключает сбор метрик к диспетчеру, боту и движку БД"""
+    middleware = HandlerMetricsMiddleware()
+    for name, observer in dispatcher.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(middleware)
+    bot.session.middleware(ApiMetricsMiddleware())
+    instrument_engine(engine)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=handler_metrics.render_prometheus(), content_type="text/plain")
+
+
+def add_metrics_route(app: web.Application, path: str = "/metrics"):
+    app.router.add_get(path, metrics_handler)
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Отдельный HTTP-сервер с /metrics (для режима polling)"""
+    app = web.Application()
+    add_metrics_route(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -5,12 +5,11 @@ from aiogram.fsm.state import State, StatesGroup
 from datetime import datetime, timedelta
 from keybords.keybord_client import kb_client
 import re
-import sqlite3
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from database.engine import async_session_factory
-from database.requests import save_submitted_record, get_top_records, get_russia_record, get_user_records, get_user_submitted_records
+from database.requests import get_user_team_id, save_submitted_record, get_top_records, get_russia_record, get_user_records, get_user_submitted_records
 from database.models import User, UserTeams
+from drafts import DraftTooLarge, record_drafts
 
 from records.record_kb import (
     get_record_main_menu, get_record_submission_menu, get_date_input_keyboard,
@@ -20,23 +19,10 @@ from records.record_kb import (
 
 router = Router()
 
-def check_user_registration_simple(user_id: int) -> bool:
-    """Простая проверка регистрации пользователя в системе"""
+async def check_user_registration_simple(user_id: int, session: AsyncSession) -> bool:
+    """Простая проверка регистрации пользователя в системе (через кэш team_id)"""
     try:
-        conn = sqlite3.connect('mydatabase.db')
-        cursor = conn.cursor()
-        
-        # Проверяем, есть ли пользователь в таблице users и привязан ли он к команде
-        cursor.execute("""
-            SELECT u.tg_id, u.team_id 
-            FROM users u 
-            WHERE u.tg_id = ? AND u.team_id IS NOT NULL
-        """, (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        return result is not None
+        return await get_user_team_id(user_id, session) is not None
     except Exception:
         return False
 
@@ -95,17 +81,15 @@ class RecordSubmissionStates(StatesGroup):
     waiting_for_video = State()
     confirming_submission = State()
 
-# Временное хранилище данных о рекорде (в реальном проекте лучше использовать Redis или базу данных)
-user_record_data = {}
 submitted_records = []  # Список отправленных рекордов
 
 @router.callback_query(F.data == "records")
-async def show_records_menu(callback: CallbackQuery):
+async def show_records_menu(callback: CallbackQuery, session: AsyncSession):
     """Показать главное меню рекордов"""
     user_id = callback.from_user.id
     
     # Проверяем регистрацию пользователя
-    if not check_user_registration_simple(user_id):
+    if not await check_user_registration_simple(user_id, session):
         await callback.message.edit_text(
             "🏆 Меню рекордов Лиги Решений\n\n"
             "❌ Доступ ограничен\n\n"
@@ -134,12 +118,12 @@ async def show_records_menu(callback: CallbackQuery):
     )
 
 @router.callback_query(F.data == "submit_record")
-async def start_record_submission(callback: CallbackQuery, state: FSMContext):
+async def start_record_submission(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Начать процесс отправки рекорда"""
     user_id = callback.from_user.id
     
     # Проверяем регистрацию пользователя
-    if not check_user_registration_simple(user_id):
+    if not await check_user_registration_simple(user_id, session):
         await callback.answer(
             "❌ Для отправки рекорда необходимо зарегистрироваться в системе!", 
             show_alert=True
@@ -153,10 +137,6 @@ async def start_record_submission(callback: CallbackQuery, state: FSMContext):
         )
         return
     
-    # Инициализируем данные пользователя
-    if user_id not in user_record_data:
-        user_record_data[user_id] = {}
-
     # Запускаем пошаговый сценарий с запроса даты
     await state.set_state(RecordSubmissionStates.waiting_for_date)
     await callback.message.edit_text(
@@ -188,7 +168,6 @@ async def set_record_date(callback: CallbackQuery, state: FSMContext):
 @router.message(RecordSubmissionStates.waiting_for_date)
 async def process_date_input(message: Message, state: FSMContext):
     """Обработать ввод даты"""
-    user_id = message.from_user.id
     text = message.text
     
     try:
@@ -234,7 +213,7 @@ async def process_date_input(message: Message, state: FSMContext):
                 return
         
         # Сохраняем дату
-        user_record_data[user_id]['date'] = record_date
+        await record_drafts.update(state, date=record_date)
         
         # Переходим к следующему шагу — очки
         await state.set_state(RecordSubmissionStates.waiting_for_score)
@@ -275,7 +254,6 @@ async def set_record_score(callback: CallbackQuery, state: FSMContext):
 @router.message(RecordSubmissionStates.waiting_for_score)
 async def process_score_input(message: Message, state: FSMContext):
     """Обработать ввод очков"""
-    user_id = message.from_user.id
     text = message.text
     
     if text == "🔙 Отмена":
@@ -307,7 +285,7 @@ async def process_score_input(message: Message, state: FSMContext):
             return
         
         # Сохраняем очки
-        user_record_data[user_id]['score'] = score
+        await record_drafts.update(state, score=score)
         
         # Переходим к следующему шагу — видео
         await state.set_state(RecordSubmissionStates.waiting_for_video)
@@ -372,22 +350,21 @@ async def process_video_upload(message: Message, state: FSMContext):
         return
     
     # Сохраняем информацию о видео
-    user_record_data[user_id]['video'] = {
+    user_data = await record_drafts.update(state, video={
         'type': 'file',
         'file_id': message.video.file_id,
         'file_unique_id': message.video.file_unique_id,
         'duration': message.video.duration,
         'file_size': message.video.file_size,
         'file_name': message.video.file_name or "video.mp4"
-    }
+    })
     
     # Переходим к подтверждению
     await state.set_state(RecordSubmissionStates.confirming_submission)
     await message.answer(
-        f"✅ Видео файл загружен: {user_record_data[user_id]['video']['file_name']}",
+        f"✅ Видео файл загружен: {user_data['video']['file_name']}",
         reply_markup=remove_keyboard()
     )
-    user_data = user_record_data[user_id]
     video_info = f"📹 {user_data['video']['file_name']} ({user_data['video']['duration']}с, {user_data['video']['file_size'] // 1024 // 1024}МБ)"
     confirmation_text = (
         "✅ **ПОДТВЕРЖДЕНИЕ ОТПРАВКИ РЕКОРДА**\n"
@@ -428,11 +405,18 @@ async def process_video_input(message: Message, state: FSMContext):
     # Проверяем, является ли текст ссылкой на видео
     if is_video_url(text):
         # Сохраняем ссылку на видео
-        user_record_data[user_id]['video'] = {
-            'type': 'url',
-            'url': text,
-            'platform': get_video_platform(text)
-        }
+        try:
+            user_data = await record_drafts.update(state, video={
+                'type': 'url',
+                'url': text,
+                'platform': get_video_platform(text)
+            })
+        except DraftTooLarge:
+            await message.answer(
+                "❌ Ссылка слишком длинная.",
+                reply_markup=get_video_upload_keyboard()
+            )
+            return
         
         # Переходим к подтверждению
         await state.set_state(RecordSubmissionStates.confirming_submission)
@@ -440,7 +424,6 @@ async def process_video_input(message: Message, state: FSMContext):
             f"✅ Ссылка на видео сохранена: {text}",
             reply_markup=remove_keyboard()
         )
-        user_data = user_record_data[user_id]
         video_info = f"🔗 {user_data['video']['platform']}: {user_data['video']['url']}"
         confirmation_text = (
             "✅ **ПОДТВЕРЖДЕНИЕ ОТПРАВКИ РЕКОРДА**\n"
@@ -473,12 +456,12 @@ async def process_video_input(message: Message, state: FSMContext):
     )
 
 @router.callback_query(F.data == "submit_for_review")
-async def submit_for_review(callback: CallbackQuery):
+async def submit_for_review(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Отправить рекорд на проверку"""
     user_id = callback.from_user.id
     
     # Проверяем регистрацию пользователя еще раз для безопасности
-    if not check_user_registration_simple(user_id):
+    if not await check_user_registration_simple(user_id, session):
         await callback.answer(
             "❌ Для отправки рекорда необходимо зарегистрироваться в системе!", 
             show_alert=True
@@ -486,12 +469,11 @@ async def submit_for_review(callback: CallbackQuery):
         return
     
     # Проверяем, что все данные заполнены
-    if user_id not in user_record_data:
+    user_data = await record_drafts.get(state)
+    if not user_data:
         await callback.answer("❌ Нет данных для отправки", show_alert=True)
         return
     
-    user_data = user_record_data[user_id]
-    
     if not all(key in user_data for key in ['date', 'score', 'video']):
         missing = []
         if 'date' not in user_data:
@@ -535,50 +517,47 @@ async def submit_for_review(callback: CallbackQuery):
     )
 
 @router.callback_query(F.data == "confirm_submit")
-async def confirm_submit_record(callback: CallbackQuery):
+async def confirm_submit_record(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Подтвердить отправку рекорда"""
     user_id = callback.from_user.id
     
     # Проверяем регистрацию пользователя еще раз для безопасности
-    if not check_user_registration_simple(user_id):
+    if not await check_user_registration_simple(user_id, session):
         await callback.answer(
             "❌ Для отправки рекорда необходимо зарегистрироваться в системе!", 
             show_alert=True
         )
         return
     
-    user_data = user_record_data[user_id]
+    user_data = await record_drafts.get(state)
+    if not all(key in user_data for key in ['date', 'score', 'video']):
+        await callback.answer("❌ Нет данных для отправки", show_alert=True)
+        return
     
     # Создаем уникальный ID для рекорда
     import time
     record_id = f"record_{user_id}_{int(time.time())}"
     
     try:
-        # Получаем team_id пользователя
-        conn = sqlite3.connect('mydatabase.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT team_id FROM users WHERE tg_id = ?", (user_id,))
-        result = cursor.fetchone()
-        team_id = result[0] if result else None
-        conn.close()
+        # team_id уже в кэше после проверки регистрации выше
+        team_id = await get_user_team_id(user_id, session)
         
         if not team_id:
             await callback.answer("❌ Ошибка: пользователь не привязан к команде!", show_alert=True)
             return
         
         # Сохраняем рекорд в БД
-        async with async_session_factory() as session:
-            await save_submitted_record(
-                record_id=record_id,
-                user_tg_id=user_id,
-                team_id=team_id,
-                username=callback.from_user.username or "Не указан",
-                first_name=callback.from_user.first_name or "Неизвестно",
-                date=user_data['date'],
-                score=user_data['score'],
-                video_data=user_data['video'],
-                session=session
-            )
+        await save_submitted_record(
+            record_id=record_id,
+            user_tg_id=user_id,
+            team_id=team_id,
+            username=callback.from_user.username or "Не указан",
+            first_name=callback.from_user.first_name or "Неизвестно",
+            date=user_data['date'],
+            score=user_data['score'],
+            video_data=user_data['video'],
+            session=session
+        )
         
         # Создаем данные для уведомления админов (совместимость)
         record_data = {
@@ -598,7 +577,7 @@ async def confirm_submit_record(callback: CallbackQuery):
         await send_record_to_admins(callback.message.bot, record_data)
         
         # Очищаем данные пользователя
-        del user_record_data[user_id]
+        await record_drafts.clear(state)
         
     except Exception as e:
         await callback.answer(f"❌ Ошибка при сохранении рекорда: {str(e)}", show_alert=True)
@@ -730,7 +709,7 @@ async def show_my_records(callback: CallbackQuery, session: AsyncSession):
     user_id = callback.from_user.id
     
     # Проверяем регистрацию пользователя
-    if not check_user_registration_simple(user_id):
+    if not await check_user_registration_simple(user_id, session):
         await callback.answer("❌ Для просмотра рекордов необходимо зарегистрироваться в системе!", show_alert=True)
         return
     
@@ -0,0 +1,275 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+
+def _render_detailed_report_to_file(user_tg_id: int, start_date: Optional[datetime]) -> Optional[str]:
+    """Потоково пишет Excel-отчёт во временный файл и возвращает путь к нему (выполняется в пуле)
+
+    Результаты читаются из БД пачками прямо в процессе пула и сразу пишутся в
+    книгу, поэтому память не растёт с количеством результатов.
+    """
+    from calculator import fll_calculator
+    from database.engine import get_sync_engine
+    from database.requests import iter_user_fll_results_by_period
+
+    fd, path = tempfile.mkstemp(prefix="fll_report_", suffix=".xlsx")
+    try:
+        with os.fdopen(fd, "wb") as output, get_sync_engine().connect() as connection:
+            results = iter_user_fll_results_by_period(user_tg_id, start_date, connection)
+            written = fll_calculator.write_detailed_excel_report_stream(results, output)
+    except Exception:
+        os.remove(path)
+        raise
+    if not written:
+        os.remove(path)
+        return None
+    return path
+
+
+class ReportQueueFull(Exception):
+    """Очередь отчётов заполнена"""
+
+
+class ReportAlreadyRunning(Exception):
+    """У пользователя уже формируется отчёт"""
+
+
+class ReportExecutor:
+    """Ограниченная очередь генерации отчётов вне event loop
+
+    Одновременно выполняется не больше max_workers задач, ещё max_pending
+    ждут своей очереди, остальные запросы сразу отклоняются. У одного
+    пользователя может быть только один отчёт в работе.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 8, use_processes: bool = True):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.use_processes = use_processes
+        self._executor: Optional[Executor] = None
+        self._active = 0
+        self._active_users = set()
+
+    def _get_executor(self) -> Executor:
+        # Пул создаем лениво, чтобы не поднимать процессы при импорте
+        if self._executor is None:
+            if self.use_processes:
+                # fork из процесса с потоками (aiosqlite, пулы) может зависнуть — запускаем чистые процессы
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="reports")
+        return self._executor
+
+    async def run(self, user_id: int, func, *args):
+        """Выполняет func(*args) в пуле, соблюдая лимиты очереди"""
+        if user_id in self._active_users:
+            raise ReportAlreadyRunning()
+        if self._active >= self.max_workers + self.max_pending:
+            raise ReportQueueFull()
+
+        self._active += 1
+        self._active_users.add(user_id)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._active -= 1
+            self._active_users.discard(user_id)
+
+    async def render_detailed_report_to_file(self, user_id: int, start_date: Optional[datetime]) -> Optional[str]:
+        """Генерирует детальный Excel-отчёт за период во временный файл; удалить файл должен вызывающий"""
+        return await self.run(user_id, _render_detailed_report_to_file, user_id, start_date)
+
+    def shutdown(self):
+        """Останавливает пул"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+@dataclass
+class CachedReport:
+    """Готовый отчёт в кэше"""
+    path: Path
+    size: int
+    file_id: Optional[str] = None
+    # Сколько отправок сейчас загружают этот файл: закрепленный отчёт не вытесняется
+    pins: int = 0
+    # Заменен более новым отчётом, удалить после снятия последнего закрепления
+    stale: bool = False
+
+
+ReportKey = Tuple[int, str, int, int]
+
+
+class ReportCache:
+    """LRU-кэш готовых отчётов на диске
+
+    Ключ — (пользователь, период, id самого нового результата, количество
+    результатов), поэтому новый или удалённый результат автоматически даёт
+    промах. Для уже отправленного отчёта запоминается file_id Telegram, чтобы
+    повторная отправка не загружала файл заново. Общий размер файлов
+    ограничен max_bytes, количество — max_entries. Отчёт, который сейчас
+    загружается в Telegram, закреплён (get(pin=True) или put_file) и не
+    удаляется до release().
+
+    Кэш свой в каждом процессе: в webhook-режиме с WEBHOOK_WORKERS > 1
+    каждый воркер держит отдельный каталог (set_worker), иначе один воркер
+    удалял бы файлы, которые загружает другой. Повторный запрос, попавший в
+    другой воркер, сформирует отчёт заново.
+    """
+
+    def __init__(self, cache_dir: str = "report_cache", max_bytes: int = 200 * 1024 * 1024,
+                 max_entries: int = 1000):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[ReportKey, CachedReport]" = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+
+    def set_worker(self, worker_index: int):
+        """Переключает кэш на каталог воркера (до первого обращения к кэшу)"""
+        self.cache_dir = self.cache_dir / f"worker_{worker_index}"
+
+    @staticmethod
+    def make_key(user_id: int, period: str, newest_id: Optional[int], count: int) -> ReportKey:
+        """Ключ кэша по id самого нового результата периода и их количеству"""
+        return (user_id, period, newest_id or 0, count)
+
+    def _path(self, key: ReportKey) -> Path:
+        user_id, period, newest_id, count = key
+        return self.cache_dir / f"{user_id}_{period}_{newest_id}_{count}.xlsx"
+
+    def _load(self):
+        """Восстанавливает кэш после перезапуска (порядок LRU — по времени изменения)"""
+        # Загружаем лениво: модуль импортируется и в процессах пула отчётов
+        if self._loaded:
+            return
+        self._loaded = True
+        self.cache_dir.mkdir(exist_ok=True)
+        files = []
+        for path in self.cache_dir.glob("*.xlsx"):
+            try:
+                user_id, rest = path.stem.split("_", 1)
+                period, newest_id, count = rest.rsplit("_", 2)
+                key = (int(user_id), period, int(newest_id), int(count))
+                stat = path.stat()
+            except (ValueError, OSError):
+                continue
+            files.append((stat.st_mtime, key, path, stat.st_size))
+        for _, key, path, size in sorted(files):
+            self._entries[key] = CachedReport(path=path, size=size)
+            self._total_bytes += size
+        self._evict()
+
+    def get(self, key: ReportKey, pin: bool = False) -> Optional[CachedReport]:
+        """Возвращает отчёт из кэша или None; с pin=True закрепляет его до release()"""
+        self._load()
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if not entry.path.exists():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        if pin:
+            entry.pins += 1
+        return entry
+
+    def put_file(self, key: ReportKey, file_path: str) -> CachedReport:
+        """Переносит в кэш отчёт, записанный во временный файл, и закрепляет его до release()"""
+        self._load()
+        path = self._path(key)
+        shutil.move(file_path, path)
+        entry = self._add(key, path)
+        entry.pins += 1
+        return entry
+
+    def release(self, key: ReportKey):
+        """Снимает закрепление после отправки (после set_file_id/forget_file_id)"""
+        entry = self._entries.get(key)
+        if entry is None or entry.pins == 0:
+            return
+        entry.pins -= 1
+        if entry.pins == 0:
+            if entry.stale:
+                self._remove(key)
+            else:
+                self._evict()
+
+    def set_file_id(self, key: ReportKey, file_id: str):
+        """Запоминает file_id Telegram для отправленного отчёта"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.file_id = file_id
+
+    def forget_file_id(self, key: ReportKey):
+        """Сбрасывает file_id, если Telegram его больше не принимает"""
+        self.set_file_id(key, None)
+
+    def _add(self, key: ReportKey, path: Path) -> CachedReport:
+        user_id, period = key[0], key[1]
+        # Отчёты этого же пользователя за тот же период устарели
+        for old_key in [k for k in self._entries if k[0] == user_id and k[1] == period and k != key]:
+            if self._entries[old_key].pins:
+                self._entries[old_key].stale = True
+            else:
+                self._remove(old_key)
+        entry = self._entries.get(key)
+        if entry is not None:
+            # Тот же файл перезаписан: закрепления относятся к пути, он не меняется
+            self._total_bytes -= entry.size
+            entry.size = path.stat().st_size
+            entry.file_id = None
+            entry.stale = False
+        else:
+            entry = self._entries[key] = CachedReport(path=path, size=path.stat().st_size)
+        self._entries.move_to_end(key)
+        self._total_bytes += entry.size
+        self._evict(keep=key)
+        return entry
+
+    def _remove(self, key: ReportKey):
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry.size
+        try:
+            entry.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep: Optional[ReportKey] = None):
+        """Удаляет самые давние отчёты сверх лимитов (только что добавленный и закреплённые не трогаем)"""
+        if self._total_bytes <= self.max_bytes and len(self._entries) <= self.max_entries:
+            return
+        for key in [k for k, entry in self._entries.items() if k != keep and not entry.pins]:
+            if self._total_bytes <= self.max_bytes and len(self._entries) <= self.max_entries:
+                break
+            self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+report_executor = ReportExecutor(
+    max_workers=int(os.getenv("REPORT_WORKERS", 2)),
+    max_pending=int(os.getenv("REPORT_QUEUE_SIZE", 8)),
+    use_processes=os.getenv("REPORT_EXECUTOR", "process") == "process",
+)
+
+report_cache = ReportCache(
+    cache_dir=os.getenv("REPORT_CACHE_DIR", "report_cache"),
+    max_bytes=int(os.getenv("REPORT_CACHE_MAX_MB", 200)) * 1024 * 1024,
+    max_entries=int(os.getenv("REPORT_CACHE_MAX_ENTRIES", 1000)),
+)
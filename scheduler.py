@@ -1,22 +1,220 @@
 import asyncio
+import heapq
 import logging
+import os
 from datetime import datetime, timedelta
-from typing import List
+from typing import Dict, Iterable, List, Optional, Tuple
 from aiogram import Bot
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update, exists, and_, or_
-from database.models import User, Improvement
+from sqlalchemy import select, and_, case, func
+from database.models import User
 from database.engine import async_session_factory
+from database.requests import (
+    REMINDER_INTERVAL,
+    mark_photos_received,
+    mark_reminders_sent,
+    reachable_user_condition,
+    record_delivery_results,
+)
+from broadcast import broadcast_engine, send_with_limits, SEND_OK, SEND_BLOCKED
+from webhook import WEBHOOK_WORKERS
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+REMINDER_TEXT = (
+    "📸 Привет! Напоминаю о важном!\n\n"
+    "Уже прошло 2 недели с последнего напоминания. "
+    "Не забудь прислать фотографию! 📷\n\n"
+    "Присылай фото своего робота через бота - это поможет тебе отслеживать прогресс! 😊"
+)
+
+# Через сколько повторить напоминание, если его не удалось доставить
+REMINDER_RETRY_DELAY = timedelta(hours=1)
+# Как часто полностью пересобирать очередь из БД (на случай изменений в обход бота
+# или в других воркерах webhook-режима: доработки и фото, сохраненные не в ведущем,
+# попадают в его очередь только так, поэтому с несколькими воркерами — чаще)
+RESYNC_INTERVAL = timedelta(minutes=float(
+    os.getenv("REMINDER_RESYNC_MINUTES", 10 if WEBHOOK_WORKERS > 1 else 24 * 60)
+))
+# Фото пользователей записываются в БД пачками раз в PHOTO_FLUSH_INTERVAL секунд
+PHOTO_FLUSH_INTERVAL = float(os.getenv("PHOTO_FLUSH_INTERVAL", 5))
+PHOTO_FLUSH_MAX_PENDING = int(os.getenv("PHOTO_FLUSH_MAX_PENDING", 5000))
+
+class PhotoBatcher:
+    """Копит фото пользователей и записывает их в БД пачкой раз в PHOTO_FLUSH_INTERVAL секунд
+
+    Работает в каждом процессе бота (в webhook-режиме — в каждом воркере),
+    а не только в ведущем: пачка этого воркера никому больше не видна.
+    Новое время напоминания передается планировщику, если он запущен в
+    этом же процессе; иначе ведущий узнает его из БД при проверке перед отправкой.
+    """
+
+    def __init__(self):
+        self.is_running = False
+        self.flush_task = None
+        # Фото, еще не записанные в БД: tg_id -> время последнего фото
+        self._pending: Dict[int, datetime] = {}
+        self._flush_needed = asyncio.Event()
+        
+    def record(self, user_tg_id: int, received_at: datetime):
+        """Запоминает фото пользователя; в БД оно попадет со следующей пачкой"""
+        self._pending[user_tg_id] = received_at
+        if len(self._pending) >= PHOTO_FLUSH_MAX_PENDING:
+            self._flush_needed.set()
+            
+    async def flush(self):
+        """Записывает накопленные фото в БД одной транзакцией"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            async with async_session_factory() as session:
+                next_times = await mark_photos_received(pending, session)
+        except Exception:
+            # Возвращаем несохраненное, не затирая более свежие фото
+            for user_tg_id, received_at in pending.items():
+                self._pending.setdefault(user_tg_id, received_at)
+            raise
+        scheduler = get_reminder_scheduler()
+        if scheduler:
+            for user_tg_id, next_reminder_at in next_times:
+                scheduler.reschedule(user_tg_id, next_reminder_at)
+                
+    async def _run(self):
+        """Периодически сбрасывает накопленные фото в БД"""
+        while self.is_running:
+            try:
+                try:
+                    await asyncio.wait_for(self._flush_needed.wait(), timeout=PHOTO_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_needed.clear()
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении фото: {e}")
+                
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self.flush_task = asyncio.create_task(self._run())
+        
+    async def stop(self):
+        """Останавливает сброс и записывает фото, пришедшие после последней пачки"""
+        if not self.is_running:
+            return
+        self.is_running = False
+        self.flush_task.cancel()
+        try:
+            await self.flush_task
+        except asyncio.CancelledError:
+            pass
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении фото: {e}")
+
+
+# Фото копятся в каждом процессе отдельно
+photo_batcher = PhotoBatcher()
+
 class ReminderScheduler:
+    """Планировщик напоминаний по времени следующего напоминания каждого пользователя
+
+    Очередь (куча по времени) заполняется одним запросом при старте и
+    обновляется вместе с User.next_reminder_at при загрузке фото и
+    изменении доработок, поэтому планировщик спит ровно до ближайшего
+    напоминания вместо ежечасного перебора всех пользователей. Перед отправкой условия напоминания
+    перепроверяются в БД только для наступивших пользователей.
+    """
+
     def __init__(self, bot: Bot):
         self.bot = bot
         self.is_running = False
         self.reminder_task = None
+        self._heap: List[Tuple[datetime, int]] = []
+        # Актуальное время напоминания; записи кучи с другим временем устарели
+        self._due_at: Dict[int, datetime] = {}
+        self._wakeup = asyncio.Event()
+        self._last_sync: Optional[datetime] = None
+        
+    def schedule(self, user_tg_id: int, due_at: datetime):
+        """Планирует (или переносит) напоминание пользователю"""
+        if self._due_at.get(user_tg_id) == due_at:
+            return
+        self._due_at[user_tg_id] = due_at
+        heapq.heappush(self._heap, (due_at, user_tg_id))
+        # Будим цикл, если новое напоминание раньше того, до которого он спит
+        if self._heap[0][1] == user_tg_id:
+            self._wakeup.set()
+        if len(self._heap) > 2 * len(self._due_at) + 1000:
+            self._compact()
+            
+    def unschedule(self, user_tg_id: int):
+        """Убирает пользователя из очереди (запись в куче удалится лениво)"""
+        self._due_at.pop(user_tg_id, None)
+        
+    def reschedule(self, user_tg_id: int, next_reminder_at: Optional[datetime]):
+        """Обновляет очередь по новому next_reminder_at (фото, добавление/удаление доработок)"""
+        if next_reminder_at is not None:
+            self.schedule(user_tg_id, self._naive(next_reminder_at))
+        else:
+            self.unschedule(user_tg_id)
+            
+    def _compact(self):
+        """Пересобирает кучу без устаревших записей"""
+        self._heap = [(due_at, user_tg_id) for user_tg_id, due_at in self._due_at.items()]
+        heapq.heapify(self._heap)
+        
+    def _pop_due(self, now: datetime, limit: int = 500) -> List[int]:
+        """Достает из очереди пользователей, чье время напоминания наступило"""
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            due_at, user_tg_id = heapq.heappop(self._heap)
+            if self._due_at.get(user_tg_id) == due_at:
+                del self._due_at[user_tg_id]
+                due.append(user_tg_id)
+        return due
+        
+    async def _load_due_times(self, session: AsyncSession,
+                              user_tg_ids: Optional[Iterable[int]] = None) -> List[Tuple[int, datetime]]:
+        """Время следующего напоминания для пользователей с доработками (одним запросом)"""
+        query = select(User.tg_id, User.next_reminder_at).where(
+            User.next_reminder_at.isnot(None),
+            reachable_user_condition()
+        )
+        if user_tg_ids is not None:
+            query = query.where(User.tg_id.in_(list(user_tg_ids)))
+        result = await session.execute(query)
+        return result.all()
+        
+    async def _reschedule_from_db(self, session: AsyncSession, user_tg_ids: Iterable[int]):
+        """Возвращает в очередь пользователей, которым напоминание еще рано отправлять"""
+        now = datetime.now()
+        for user_tg_id, due_at in await self._load_due_times(session, user_tg_ids):
+            due_at = self._naive(due_at)
+            if due_at > now:
+                self.schedule(user_tg_id, due_at)
+                
+    async def _sync_queue(self):
+        """Заполняет очередь из БД"""
+        async with async_session_factory() as session:
+            rows = await self._load_due_times(session)
+        self._due_at = {}
+        for user_tg_id, due_at in rows:
+            self._due_at[user_tg_id] = self._naive(due_at)
+        self._compact()
+        self._last_sync = datetime.now()
+        logger.info(f"Очередь напоминаний загружена: {len(self._due_at)} пользователей")
+        
+    @staticmethod
+    def _naive(value: datetime) -> datetime:
+        # SQLite возвращает время без часового пояса, но на всякий случай приводим к одному виду
+        return value.replace(tzinfo=None) if value.tzinfo else value
         
     async def start(self):
         """Запускает планировщик напоминаний"""
@@ -43,150 +241,188 @@ class ReminderScheduler:
         logger.info("Планировщик напоминаний остановлен")
         
     async def _run_scheduler(self):
-        """Основной цикл планировщика"""
+        """Основной цикл планировщика: спит до ближайшего напоминания"""
         while self.is_running:
             try:
-                await self._check_and_send_reminders()
-                # Проверяем каждый час
-                await asyncio.sleep(3600)  # 1 час = 3600 секунд
+                now = datetime.now()
+                if self._last_sync is None or now - self._last_sync >= RESYNC_INTERVAL:
+                    await self._sync_queue()
+                    
+                due_users = self._pop_due(now)
+                if due_users:
+                    await self._check_and_send_reminders(due_users)
+                    continue
+                    
+                # Спим до ближайшего напоминания, следующей пересборки очереди или до пробуждения
+                wake_at = self._last_sync + RESYNC_INTERVAL
+                if self._heap:
+                    wake_at = min(wake_at, self._heap[0][0])
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max((wake_at - now).total_seconds(), 0))
+                except asyncio.TimeoutError:
+                    pass
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 logger.error(f"Ошибка в планировщике: {e}")
                 await asyncio.sleep(300)  # При ошибке ждем 5 минут
                 
-    async def _check_and_send_reminders(self):
-        """Проверяет и отправляет напоминания пользователям"""
+    async def _check_and_send_reminders(self, user_tg_ids: Optional[List[int]] = None):
+        """Проверяет и отправляет напоминания пользователям (всем или только user_tg_ids)"""
         try:
+            # Недавние фото должны попасть в БД до проверки, иначе напомним тем, кто только что прислал фото
+            # (пачки других воркеров попадают в БД не позже чем через PHOTO_FLUSH_INTERVAL)
+            await photo_batcher.flush()
+            
             async with async_session_factory() as session:
                 # Получаем всех пользователей, которым нужно отправить напоминание
-                users_to_remind = await self._get_users_needing_reminder(session)
+                users_to_remind = await self._get_users_needing_reminder(session, user_tg_ids)
                 
                 if not users_to_remind:
                     logger.info("Нет пользователей для напоминания")
+                    if user_tg_ids:
+                        await self._reschedule_from_db(session, user_tg_ids)
                     return
                     
                 logger.info(f"Найдено {len(users_to_remind)} пользователей для напоминания")
                 
-                # Отправляем напоминания
-                for user in users_to_remind:
-                    try:
-                        await self._send_reminder(user.tg_id)
-                        await self._update_reminder_time(session, user.tg_id)
-                        logger.info(f"Напоминание отправлено пользователю {user.tg_id}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при отправке напоминания пользователю {user.tg_id}: {e}")
-                        
+                # Отправляем напоминания параллельно под общим лимитом Telegram
+                statuses = {}
+                
+                async def collect(user_tg_id: int, status: str):
+                    statuses[user_tg_id] = status
+                    
+                stats = await broadcast_engine.run(
+                    [user.tg_id for user in users_to_remind], self._deliver_reminder, on_result=collect
+                )
+                logger.info(f"Напоминания отправлены: {stats.sent}, ошибок: {stats.errors}")
+                
+                # Время напоминания сдвигаем только тем, кому оно действительно доставлено
+                delivered = [user_tg_id for user_tg_id, status in statuses.items() if status == SEND_OK]
+                await self._update_reminder_times(session, delivered)
                 await session.commit()
                 
+                now = datetime.now()
+                for user_tg_id, status in statuses.items():
+                    if status == SEND_OK:
+                        self.schedule(user_tg_id, now + REMINDER_INTERVAL)
+                    elif status == SEND_BLOCKED:
+                        self.unschedule(user_tg_id)
+                    else:
+                        self.schedule(user_tg_id, now + REMINDER_RETRY_DELAY)
+                        
+                # Кто из очереди не прошел проверку — пересчитываем время по данным БД
+                if user_tg_ids is not None:
+                    skipped = set(user_tg_ids) - statuses.keys()
+                    if skipped:
+                        await self._reschedule_from_db(session, skipped)
+                # Заблокировавшие бота больше не попадут в выборку
+                await record_delivery_results(statuses, session)
+                
         except Exception as e:
             logger.error(f"Ошибка при проверке напоминаний: {e}")
             
-    async def _get_users_needing_reminder(self, session: AsyncSession) -> List[User]:
+    async def _get_users_needing_reminder(self, session: AsyncSession,
+                                          user_tg_ids: Optional[List[int]] = None) -> List[User]:
         """Получает список пользователей, которым нужно отправить напоминание"""
-        # Дата 2 недели назад
-        two_weeks_ago = datetime.now() - timedelta(weeks=2)
-        
-        # Условие: у пользователя есть хотя бы одна доработка
-        has_any_improvement = exists(
-            select(1).where(Improvement.user_tg_id == User.tg_id)
-        )
-
-        # Условие: у пользователя есть доработка, созданная 2+ недели назад
-        has_old_improvement = exists(
-            select(1).where(
-                and_(
-                    Improvement.user_tg_id == User.tg_id,
-                    Improvement.created_at <= two_weeks_ago
-                )
-            )
-        )
-
-        # Напоминания отправляются только тем, кто уже загружал доработки, и:
-        #  - либо напоминаний ещё не было, но первая/последняя доработка была 2+ недели назад
-        #  - либо последнее напоминание было 2+ недели назад
+        # next_reminder_at заполнен только у пользователей с доработками и поддерживается
+        # при добавлении/удалении доработок, фото и напоминаниях — это диапазон по индексу
         query = select(User).where(
             and_(
-                has_any_improvement,
-                or_(
-                    and_(User.last_photo_reminder.is_(None), has_old_improvement),
-                    (User.last_photo_reminder <= two_weeks_ago)
-                )
+                User.next_reminder_at <= datetime.now(),
+                reachable_user_condition()
             )
         )
+        if user_tg_ids is not None:
+            query = query.where(User.tg_id.in_(user_tg_ids))
         
         result = await session.execute(query)
         return result.scalars().all()
         
-    async def _send_reminder(self, user_tg_id: int):
-        """Отправляет напоминание конкретному пользователю"""
-        reminder_text = (
-            "📸 Привет! Напоминаю о важном!\n\n"
-            "Уже прошло 2 недели с последнего напоминания. "
-            "Не забудь прислать фотографию! 📷\n\n"
-            "Присылай фото своего робота через бота - это поможет тебе отслеживать прогресс! 😊"
+    async def _deliver_reminder(self, user_tg_id: int):
+        """Отправляет текст напоминания (ошибки Telegram пробрасываются)"""
+        await self.bot.send_message(
+            chat_id=user_tg_id,
+            text=REMINDER_TEXT
         )
         
-        try:
-            await self.bot.send_message(
-                chat_id=user_tg_id,
-                text=reminder_text
-            )
-        except Exception as e:
+    async def _send_reminder(self, user_tg_id: int) -> str:
+        """Отправляет напоминание конкретному пользователю и возвращает итог доставки (SEND_*)"""
+        status = await send_with_limits(self._deliver_reminder, user_tg_id)
+        if status != SEND_OK:
             # Если пользователь заблокировал бота или удалил аккаунт
-            logger.warning(f"Не удалось отправить сообщение пользователю {user_tg_id}: {e}")
+            logger.warning(f"Не удалось отправить сообщение пользователю {user_tg_id}: {status}")
+        return status
             
     async def _update_reminder_time(self, session: AsyncSession, user_tg_id: int):
         """Обновляет время последнего напоминания для пользователя"""
-        await session.execute(
-            update(User)
-            .where(User.tg_id == user_tg_id)
-            .values(last_photo_reminder=datetime.now())
-        )
+        await self._update_reminder_times(session, [user_tg_id])
+        
+    async def _update_reminder_times(self, session: AsyncSession, user_tg_ids: List[int]):
+        """Обновляет время последнего и следующего напоминания пачками"""
+        await mark_reminders_sent(user_tg_ids, datetime.now(), session)
         
     async def force_reminder_for_user(self, user_tg_id: int):
         """Принудительно отправляет напоминание конкретному пользователю (для админов)"""
         try:
-            await self._send_reminder(user_tg_id)
+            status = await self._send_reminder(user_tg_id)
             
             async with async_session_factory() as session:
-                await self._update_reminder_time(session, user_tg_id)
-                await session.commit()
+                if status == SEND_OK:
+                    await self._update_reminder_time(session, user_tg_id)
+                    await session.commit()
+                    self.schedule(user_tg_id, datetime.now() + REMINDER_INTERVAL)
+                await record_delivery_results({user_tg_id: status}, session)
                 
-            return True
+            return status == SEND_OK
         except Exception as e:
             logger.error(f"Ошибка при принудительном напоминании пользователю {user_tg_id}: {e}")
             return False
             
-    async def get_users_reminder_status(self) -> List[dict]:
-        """Получает статус напоминаний для всех пользователей (для админов)"""
+    async def get_reminder_status_summary(self) -> dict:
+        """Сводка по напоминаниям одним агрегирующим запросом (для админов)"""
+        now = datetime.now()
+        reachable = reachable_user_condition()
         try:
             async with async_session_factory() as session:
-                query = select(User)
-                result = await session.execute(query)
-                users = result.scalars().all()
-                
-                status_list = []
-                for user in users:
-                    status = {
-                        'tg_id': user.tg_id,
-                        'last_reminder': user.last_photo_reminder,
-                        'needs_reminder': self._user_needs_reminder(user.last_photo_reminder)
-                    }
-                    status_list.append(status)
-                    
-                return status_list
+                result = await session.execute(
+                    select(
+                        func.count(),
+                        func.count(case((and_(reachable, User.next_reminder_at <= now), 1))),
+                        func.count(case((and_(reachable, User.next_reminder_at > now), 1))),
+                        func.count(case((User.next_reminder_at.is_(None), 1))),
+                        func.count(case((and_(~reachable, User.next_reminder_at.isnot(None)), 1))),
+                    ).select_from(User)
+                )
+                total, due, scheduled, without_improvements, unreachable = result.one()
+                return {
+                    'total': total,
+                    'due': due,
+                    'scheduled': scheduled,
+                    'without_improvements': without_improvements,
+                    'unreachable': unreachable,
+                }
         except Exception as e:
             logger.error(f"Ошибка при получении статуса напоминаний: {e}")
-            return []
-            
-    def _user_needs_reminder(self, last_reminder: datetime = None) -> bool:
-        """Проверяет, нужно ли пользователю напоминание"""
-        if last_reminder is None:
-            return True
+            return {}
             
-        two_weeks_ago = datetime.now() - timedelta(weeks=2)
-        return last_reminder <= two_weeks_ago
+    async def get_users_needing_reminder_page(self, page: int = 0, page_size: int = 10) -> Tuple[List[tuple], bool]:
+        """Страница пользователей, ожидающих напоминания (самые давние сначала), и есть ли следующая"""
+        try:
+            async with async_session_factory() as session:
+                result = await session.execute(
+                    select(User.tg_id, User.last_photo_reminder, User.next_reminder_at)
+                    .where(User.next_reminder_at <= datetime.now(), reachable_user_condition())
+                    .order_by(User.next_reminder_at, User.tg_id)
+                    .offset(page * page_size)
+                    .limit(page_size + 1)
+                )
+                rows = result.all()
+                return rows[:page_size], len(rows) > page_size
+        except Exception as e:
+            logger.error(f"Ошибка при получении списка напоминаний: {e}")
+            return [], False
 
 # Глобальный экземпляр планировщика
 reminder_scheduler: ReminderScheduler = None
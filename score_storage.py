@@ -0,0 +1,221 @@
+import asyncio
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import aiosqlite
+
+
+class ScoreStorage(ABC):
+    """Хранилище незавершённых результатов калькулятора (user_id -> очки по миссиям)
+
+    Методы асинхронные: обращения к SQLite и Redis не блокируют event loop.
+    Очки меняются по одной миссии, поэтому одновременные нажатия (в том числе
+    в разных процессах бота) не затирают друг друга.
+    """
+
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[Dict[str, int]]:
+        """Возвращает очки пользователя или None, если сессии нет"""
+
+    @abstractmethod
+    async def set_score(self, user_id: int, mission_id: str, score: int):
+        """Сохраняет очки пользователя за одну миссию"""
+
+    @abstractmethod
+    async def delete(self, user_id: int):
+        """Удаляет сессию пользователя"""
+
+    async def close(self):
+        """Закрывает соединение с хранилищем"""
+
+
+class MemoryScoreStorage(ScoreStorage):
+    """LRU-хранилище в памяти процесса с вытеснением по TTL и по размеру"""
+
+    def __init__(self, max_users: int = 10000, ttl: float = 24 * 3600):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._data: "OrderedDict[int, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, user_id: int) -> Optional[Dict[str, int]]:
+        with self._lock:
+            scores = self._touch(user_id, time.monotonic())
+            return dict(scores) if scores is not None else None
+
+    async def set_score(self, user_id: int, mission_id: str, score: int):
+        with self._lock:
+            now = time.monotonic()
+            scores = self._touch(user_id, now)
+            if scores is None:
+                scores = {}
+                self._data[user_id] = (now + self.ttl, scores)
+            scores[mission_id] = score
+            self._evict(now)
+
+    async def delete(self, user_id: int):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def _touch(self, user_id: int, now: float) -> Optional[Dict[str, int]]:
+        """Возвращает живую сессию и продлевает её, просроченную удаляет"""
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+        expires_at, scores = item
+        if expires_at <= now:
+            del self._data[user_id]
+            return None
+        # Обращение продлевает жизнь сессии и делает её самой свежей
+        self._data[user_id] = (now + self.ttl, scores)
+        self._data.move_to_end(user_id)
+        return scores
+
+    def _evict(self, now: float):
+        """Удаляет просроченные сессии и самые старые сверх лимита"""
+        while self._data:
+            user_id, (expires_at, _) = next(iter(self._data.items()))
+            if len(self._data) <= self.max_users and expires_at > now:
+                break
+            del self._data[user_id]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteScoreStorage(ScoreStorage):
+    """Хранилище в отдельном файле SQLite — переживает перезапуск и общее для процессов на одной машине
+
+    Очки хранятся строкой на (пользователь, миссия) и обновляются через UPSERT.
+    """
+
+    def __init__(self, path: str = "calc_sessions.db", ttl: float = 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._conn: Optional[aiosqlite.Connection] = None
+        # Соединение открываем лениво — конструктор вызывается вне event loop
+        self._connect_lock = asyncio.Lock()
+        # Транзакции на общем соединении не должны перемешиваться
+        self._write_lock = asyncio.Lock()
+
+    async def _get_conn(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            async with self._connect_lock:
+                if self._conn is None:
+                    conn = await aiosqlite.connect(self.path, isolation_level=None)
+                    await conn.execute("PRAGMA journal_mode=WAL")
+                    await conn.execute("PRAGMA synchronous=NORMAL")
+                    await conn.execute("PRAGMA busy_timeout=5000")
+                    await conn.execute(
+                        "CREATE TABLE IF NOT EXISTS calc_scores ("
+                        "user_id INTEGER NOT NULL, mission_id TEXT NOT NULL, score INTEGER NOT NULL, "
+                        "expires_at REAL NOT NULL, PRIMARY KEY (user_id, mission_id))"
+                    )
+                    await conn.execute("CREATE INDEX IF NOT EXISTS ix_calc_scores_expires_at ON calc_scores (expires_at)")
+                    await conn.execute("DELETE FROM calc_scores WHERE expires_at <= ?", (time.time(),))
+                    self._conn = conn
+        return self._conn
+
+    async def get(self, user_id: int) -> Optional[Dict[str, int]]:
+        conn = await self._get_conn()
+        async with conn.execute(
+            "SELECT mission_id, score FROM calc_scores WHERE user_id = ? AND expires_at > ?",
+            (user_id, time.time())
+        ) as cursor:
+            rows = await cursor.fetchall()
+        return dict(rows) if rows else None
+
+    async def set_score(self, user_id: int, mission_id: str, score: int):
+        conn = await self._get_conn()
+        now = time.time()
+        async with self._write_lock:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Просроченная сессия не должна «воскреснуть» вместе с новой миссией
+                await conn.execute(
+                    "DELETE FROM calc_scores WHERE user_id = ? AND expires_at <= ?", (user_id, now)
+                )
+                await conn.execute(
+                    "INSERT INTO calc_scores (user_id, mission_id, score, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id, mission_id) DO UPDATE SET score = excluded.score",
+                    (user_id, mission_id, score, now + self.ttl)
+                )
+                # Любое изменение продлевает всю сессию пользователя
+                await conn.execute(
+                    "UPDATE calc_scores SET expires_at = ? WHERE user_id = ?", (now + self.ttl, user_id)
+                )
+                await conn.execute("COMMIT")
+            except Exception:
+                await conn.execute("ROLLBACK")
+                raise
+
+    async def delete(self, user_id: int):
+        conn = await self._get_conn()
+        async with self._write_lock:
+            await conn.execute("DELETE FROM calc_scores WHERE user_id = ?", (user_id,))
+
+    async def purge_expired(self):
+        """Удаляет просроченные сессии"""
+        conn = await self._get_conn()
+        async with self._write_lock:
+            await conn.execute("DELETE FROM calc_scores WHERE expires_at <= ?", (time.time(),))
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+class RedisScoreStorage(ScoreStorage):
+    """Хранилище в Redis (или совместимом сервере) — общее для нескольких процессов бота
+
+    Сессия пользователя — хеш миссия -> очки, изменяется через HSET.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", ttl: float = 24 * 3600,
+                 prefix: str = "fll:calc:"):
+        try:
+            from redis.asyncio import Redis
+        except ImportError as e:
+            raise ImportError("Для CALC_STATE_BACKEND=redis установите пакет redis") from e
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self._client = Redis.from_url(url)
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.prefix}{user_id}"
+
+    async def get(self, user_id: int) -> Optional[Dict[str, int]]:
+        raw = await self._client.hgetall(self._key(user_id))
+        return {mission_id.decode(): int(score) for mission_id, score in raw.items()} if raw else None
+
+    async def set_score(self, user_id: int, mission_id: str, score: int):
+        key = self._key(user_id)
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mission_id, score)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def delete(self, user_id: int):
+        await self._client.delete(self._key(user_id))
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def create_score_storage() -> ScoreStorage:
+    """Создает хранилище по переменным окружения CALC_STATE_*"""
+    backend = os.getenv("CALC_STATE_BACKEND", "memory")
+    ttl = float(os.getenv("CALC_STATE_TTL", 24 * 3600))
+
+    if backend == "memory":
+        return MemoryScoreStorage(max_users=int(os.getenv("CALC_STATE_MAX_USERS", 10000)), ttl=ttl)
+    if backend == "sqlite":
+        return SQLiteScoreStorage(path=os.getenv("CALC_STATE_SQLITE_PATH", "calc_sessions.db"), ttl=ttl)
+    if backend == "redis":
+        return RedisScoreStorage(url=os.getenv("REDIS_URL", "redis://localhost:6379/0"), ttl=ttl)
+    raise ValueError(f"Неизвестный CALC_STATE_BACKEND: {backend}")
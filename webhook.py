@@ -0,0 +1,179 @@
+import asyncio
+import multiprocessing
+import os
+import secrets
+import signal
+import time
+from multiprocessing.connection import wait
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# Адрес, который Telegram будет вызывать (например https://bot.example.org), без пути
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))
+# 1 — все воркеры слушают один порт (SO_REUSEPORT, ядро делит соединения);
+# 0 — воркер i слушает WEBHOOK_PORT + i, балансирует обратный прокси
+WEBHOOK_REUSE_PORT = os.getenv("WEBHOOK_REUSE_PORT", "1") == "1"
+LEADER_LOCK_PATH = os.getenv("BOT_LEADER_LOCK", "bot_leader.lock")
+LEADER_RETRY_INTERVAL = 5.0
+
+
+def get_webhook_secret() -> str:
+    """Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+
+    Если WEBHOOK_SECRET не задан, генерируется случайный и кладется в
+    окружение, чтобы его унаследовали запущенные после этого воркеры.
+    """
+    secret = os.getenv("WEBHOOK_SECRET")
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        os.environ["WEBHOOK_SECRET"] = secret
+    return secret
+
+
+class LeaderLock:
+    """Блокировка на файле, которую держит ровно один процесс на машине
+
+    Ядро снимает блокировку, если процесс-владелец упал, поэтому другой
+    воркер может подхватить лидерство.
+    """
+
+    def __init__(self, path: str = LEADER_LOCK_PATH):
+        self.path = path
+        self._file = None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+async def run_leader_election(lock: Optional[LeaderLock], worker_index: int,
+                              on_elected: Callable[[], Awaitable[None]]):
+    """Ждет лидерства и запускает on_elected (фоновые задачи, которые нужны в одном экземпляре)"""
+    if lock is None:
+        # Без fcntl лидером назначаем первый воркер
+        if worker_index == 0:
+            await on_elected()
+        return
+    while not lock.try_acquire():
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
+    print(f"Воркер {worker_index} стал ведущим")
+    await on_elected()
+
+
+def create_leader_lock() -> Optional[LeaderLock]:
+    return LeaderLock() if fcntl is not None else None
+
+
+def create_webhook_app(dispatcher: Dispatcher, bot: Bot) -> web.Application:
+    """aiohttp-приложение, принимающее обновления Telegram на WEBHOOK_PATH"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dispatcher,
+        bot=bot,
+        secret_token=get_webhook_secret(),
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=bot)
+    return app
+
+
+async def serve_webhook_app(app: web.Application, worker_index: int) -> web.AppRunner:
+    """Запускает приложение на адресе воркера и возвращает runner для остановки"""
+    port = WEBHOOK_PORT if WEBHOOK_REUSE_PORT else WEBHOOK_PORT + worker_index
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, port, reuse_port=WEBHOOK_REUSE_PORT or None)
+    await site.start()
+    print(f"Воркер {worker_index} принимает webhook на http://{WEBHOOK_HOST}:{port}{WEBHOOK_PATH}")
+    return runner
+
+
+async def set_webhook(bot: Bot, dispatcher: Dispatcher):
+    """Регистрирует webhook в Telegram (выполняется один раз, до запуска воркеров)"""
+    if not WEBHOOK_URL:
+        raise ValueError("Для BOT_MODE=webhook задайте WEBHOOK_URL")
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=get_webhook_secret(),
+        allowed_updates=dispatcher.resolve_used_update_types(),
+        max_connections=min(100, max(40, WEBHOOK_WORKERS * 10)),
+    )
+
+
+def wait_for_shutdown_signal() -> asyncio.Event:
+    """Событие, которое выставляется по SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+    return stop_event
+
+
+def run_workers(target: Callable[[int], None], workers: int = WEBHOOK_WORKERS):
+    """Запускает target(i) в workers процессах и перезапускает упавшие до остановки"""
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+
+    def spawn(index: int):
+        process = context.Process(target=target, args=(index,), name=f"bot-worker-{index}")
+        process.start()
+        processes[index] = process
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    for index in range(workers):
+        spawn(index)
+    try:
+        while True:
+            wait([process.sentinel for process in processes.values()])
+            for index, process in list(processes.items()):
+                if process.exitcode is None:
+                    continue
+                if process.exitcode == 0:
+                    # Штатная остановка (например, Ctrl+C в терминале)
+                    del processes[index]
+                    continue
+                print(f"Воркер {index} завершился с кодом {process.exitcode}, перезапускаем")
+                time.sleep(1)
+                spawn(index)
+            if not processes:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            process.join(timeout=30)